@@ -4,48 +4,420 @@ from __future__ import print_function
 import atexit
 import base64
 import binascii
-from copy import copy
+import codecs
+import hashlib
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
 from contextlib import contextmanager
+import importlib
+import itertools
 import json
 import logging
 import os
 from os.path import abspath
+from os.path import dirname
 from os.path import expanduser
+from os.path import isdir
 from os.path import isfile
+from os.path import join
+from os.path import normpath
+import re
+import signal
 import sys
+import threading
 import time
+import uuid
 from io import BytesIO
-from subprocess import CalledProcessError, check_output
+from subprocess import CalledProcessError, DEVNULL, Popen, check_output
 import tarfile
 
-import docker
-import dockerpty
-import yaml
-from boto3.session import Session
-from docker.errors import DockerException, ImageNotFound
-from requests.exceptions import ReadTimeout
+
+class _LazyModule(object):
+    """Imports the named module on first attribute access, so that commands
+    which never touch a heavy dependency don't pay to import it."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+asyncio = _LazyModule('asyncio')
+docker = _LazyModule('docker')
+dockerpty = _LazyModule('dockerpty')
+yaml = _LazyModule('yaml')
 
 CDFLOW_IMAGE_NAME = 'mergermarket/cdflow-commands'
 CDFLOW_IMAGE_TAG = 'latest'
 CDFLOW_IMAGE_ID = '{}:{}'.format(CDFLOW_IMAGE_NAME, CDFLOW_IMAGE_TAG)
 
 MANIFEST_PATH = 'cdflow.yml'
+DOCKER_CONFIG_CONTAINER_PATH = '/root/.docker/config.json'
+
+TIMINGS_FLAG = '--timings'
+VERBOSE_FLAGS = ('-v', '--verbose')
+FLAGS = ('-p', '--plan-only') + VERBOSE_FLAGS
+COMPONENT_OPTIONS = ('-c', '--component')
+PLATFORM_CONFIG_OPTION = '--platform-config'
+VERSION_INDEXES = {'deploy': 2, 'release': 1}
+GIT_CONFIG_SECTION = re.compile(
+    r'^\[\s*([A-Za-z0-9.-]+)(?:\s+"([^"\\]*)")?\s*\]$'
+)
+GIT_CONFIG_URL = re.compile(r'^url\s*=\s*(.*)$', re.IGNORECASE)
+GIT_CONFIG_UNSUPPORTED_SECTIONS = ('include', 'includeif', 'url')
+
+MANIFEST_SCHEMA = {
+    'account-scheme-url': (str,),
+    'team': (str,),
+    'terraform-version': (str, int, float),
+    'registry-mirrors': (list,),
+}
+# Looking up a release needs these, unlike running a command in a container.
+RELEASE_MANIFEST_KEYS = ('account-scheme-url', 'team')
+
+IMAGE_DIGEST_CACHE = 'image-digests.json'
+ACCOUNT_SCHEME_CACHE = 'account-schemes.json'
+RELEASE_INDEX_CACHE = 'release-index.json'
+IMAGE_USAGE_CACHE = 'image-usage.json'
+DAEMON_PROJECTS_CACHE = 'daemon-projects.json'
+
+S3_MAX_POOL_CONNECTIONS = 20
+
+BATCH_CONCURRENCY = 4
+SYNC_INDEX_CONCURRENCY = 10
+PREWARM_CONCURRENCY = 4
+PREWARM_SKIPPED_DIRECTORIES = ('node_modules',)
+GC_MAX_AGE_DAYS = 30
+GC_MAX_SIZE_GB = 20
+GC_MAX_PLUGIN_CACHE_SIZE_GB = 5
+
+TERRAFORM_PLUGIN_CACHE_PATH = '/root/.terraform.d/plugin-cache'
+TERRAFORM_PLUGIN_CACHE_VOLUME_PREFIX = 'cdflow-terraform-plugins-'
+
+DAEMON_COMMANDS = ('release', 'deploy', 'destroy')
+DAEMON_IDLE_TIMEOUT = 900
+DAEMON_LABEL = 'com.mergermarket.cdflow.daemon'
+DAEMON_PROJECT_ROOT_LABEL = 'com.mergermarket.cdflow.project-root'
+DAEMON_IMAGE_LABEL = 'com.mergermarket.cdflow.image'
+DAEMON_IDLE_TIMEOUT_LABEL = 'com.mergermarket.cdflow.idle-timeout'
+DAEMON_ENTRYPOINT_LABEL = 'com.mergermarket.cdflow.entrypoint'
+
+# Keeps a warm container alive until nothing has run in it for $1 seconds.
+WARM_CONTAINER_SCRIPT = '''
+touch /tmp/cdflow-last-used
+while [ $(( $(date +%s) - $(date -r /tmp/cdflow-last-used +%s) )) -lt "$1" ]
+do
+    if ls /tmp/cdflow-busy-* > /dev/null 2>&1; then
+        touch /tmp/cdflow-last-used
+    fi
+    sleep 5
+done
+'''
+
+# Runs a command in a warm container, marking it busy while it runs.
+WARM_EXEC_SCRIPT = '''
+touch /tmp/cdflow-busy-$$
+"$@"
+status=$?
+rm -f /tmp/cdflow-busy-$$
+touch /tmp/cdflow-last-used
+exit $status
+'''
+
+OTLP_EXPORT_TIMEOUT = 2
+
+DOCKERHUB_AUTH_KEY = 'https://index.docker.io/v1/'
+DOCKERHUB_REGISTRIES = ('docker.io', 'index.docker.io')
+REGISTRY_PROBE_TIMEOUT = 1
+
+PULL_ATTEMPTS = 3
+PULL_RETRY_DELAY = 2
+PULL_PROGRESS_INTERVAL = 5
+PULL_RENDER_INTERVAL = 0.2
+PULL_QUIET_STATUSES = ('Downloading', 'Extracting', 'Waiting')
+
+OUTPUT_BUFFER_SIZE = 64 * 1024
+OUTPUT_FLUSH_INTERVAL = 0.1
 
 logging.basicConfig(format='[%(asctime)s] %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+account_scheme_cache_stats = Counter()
+
+_aws_resources = {}
+_docker_config_archives = {}
+_registry_latencies = {}
+_registry_latencies_lock = threading.Lock()
+_image_usage_lock = threading.Lock()
+_running_containers = set()
+_running_containers_lock = threading.Lock()
+_aws_resources_lock = threading.Lock()
+_release_index_lock = threading.Lock()
+_manifests = {}
+_manifests_lock = threading.Lock()
+_git_remote_urls = {}
+
+
+_timings = []
+_timings_lock = threading.Lock()
+_span_stack = threading.local()
+_trace = {}
+
+
+@contextmanager
+def timed(name, span_id=None):
+    stack = _span_stack.__dict__.setdefault('span_ids', [])
+    span = {
+        'name': name,
+        'span_id': span_id or uuid.uuid4().hex[:16],
+        'parent_span_id': stack[-1] if stack else None,
+        'start': time.time(),
+    }
+    stack.append(span['span_id'])
+    try:
+        yield
+    finally:
+        stack.pop()
+        span['duration'] = time.time() - span['start']
+        with _timings_lock:
+            _timings.append(span)
+
+
+def timed_function(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report_timings(invocation, exit_status):
+    with _timings_lock:
+        spans = sorted(_timings, key=lambda span: span['start'])
+    started_at = spans[0]['start'] if spans else time.time()
+    report = {
+        'command': invocation.command,
+        'exit_status': exit_status,
+        'started_at': started_at,
+        'spans': [
+            {
+                'name': span['name'],
+                'start': round(span['start'] - started_at, 6),
+                'duration': round(span['duration'], 6),
+            }
+            for span in spans
+        ],
+    }
+    if invocation.timings:
+        print(json.dumps(report, indent=2), file=sys.stderr)
+    timings_file = os.getenv('CDFLOW_TIMINGS_FILE')
+    if timings_file:
+        _append_line(timings_file, json.dumps(report))
+
+
+def _append_line(path, line):
+    # Reports are best effort, and must not replace the real exit status.
+    try:
+        with open(path, 'a') as report_file:
+            report_file.write(line + '\n')
+    except (IOError, OSError) as e:
+        logger.debug('Could not write to {}: {}'.format(path, e))
+
+
+def start_trace():
+    del _timings[:]
+    _trace.clear()
+    _trace['attributes'] = {}
+    _trace['root_span_id'] = uuid.uuid4().hex[:16]
+    incoming = (os.getenv('TRACEPARENT') or '').split('-')
+    if len(incoming) == 4 and len(incoming[1]) == 32:
+        _trace['trace_id'] = incoming[1]
+        _trace['parent_span_id'] = incoming[2]
+    else:
+        _trace['trace_id'] = uuid.uuid4().hex
+        _trace['parent_span_id'] = None
+
+
+def tracing_enabled():
+    return bool(
+        os.getenv('CDFLOW_OTLP_FILE') or
+        os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT')
+    )
+
+
+def set_trace_attribute(key, value):
+    _trace['attributes'][key] = value
+
+
+def get_traceparent():
+    return '00-{}-{}-01'.format(_trace['trace_id'], _trace['root_span_id'])
+
+
+def export_trace(invocation, exit_status):
+    if not tracing_enabled():
+        return
+    payload = json.dumps(_build_otlp_payload(invocation, exit_status))
+    trace_file = os.getenv('CDFLOW_OTLP_FILE')
+    if trace_file:
+        _append_line(trace_file, payload)
+    endpoint = os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT')
+    if endpoint:
+        _post_otlp_payload(endpoint, payload)
+
+
+def _post_otlp_payload(endpoint, payload):
+    from urllib.request import Request, urlopen
+    request = Request(
+        '{}/v1/traces'.format(endpoint.rstrip('/')),
+        data=payload.encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    try:
+        urlopen(request, timeout=OTLP_EXPORT_TIMEOUT).close()
+    except (IOError, OSError) as e:
+        logger.debug('Could not export trace to {}: {}'.format(endpoint, e))
+
+
+def _build_otlp_payload(invocation, exit_status):
+    attributes = dict(_trace['attributes'])
+    attributes['cdflow.command'] = invocation.command
+    attributes['cdflow.exit_status'] = exit_status
+    if invocation.version:
+        attributes['cdflow.version'] = invocation.version
+    with _suppress(CDFlowWrapperException, OSError):
+        attributes['cdflow.component'] = get_component_name(invocation)
+    with _timings_lock:
+        spans = [_otlp_span(span, exit_status) for span in _timings]
+    return {'resourceSpans': [{
+        'resource': {'attributes': _otlp_attributes({
+            'service.name': 'cdflow',
+        })},
+        'scopeSpans': [{
+            'scope': {'name': 'cdflow'},
+            'spans': [
+                dict(span, attributes=_otlp_attributes(attributes))
+                if span['spanId'] == _trace['root_span_id'] else span
+                for span in spans
+            ],
+        }],
+    }]}
+
+
+def _otlp_span(span, exit_status):
+    root = span['span_id'] == _trace['root_span_id']
+    parent_span_id = _trace['parent_span_id'] if root else \
+        span['parent_span_id'] or _trace['root_span_id']
+    otlp_span = {
+        'traceId': _trace['trace_id'],
+        'spanId': span['span_id'],
+        'name': span['name'],
+        'kind': 1,
+        'startTimeUnixNano': str(int(span['start'] * 1e9)),
+        'endTimeUnixNano': str(int(
+            (span['start'] + span['duration']) * 1e9
+        )),
+        'status': {'code': 2 if root and exit_status else 0},
+    }
+    if parent_span_id:
+        otlp_span['parentSpanId'] = parent_span_id
+    return otlp_span
+
+
+def _otlp_attributes(attributes):
+    return [
+        {'key': key, 'value': (
+            {'intValue': str(value)} if isinstance(value, int)
+            else {'stringValue': str(value)}
+        )}
+        for key, value in sorted(attributes.items())
+        if value is not None
+    ]
+
+
+Invocation = namedtuple('Invocation', [
+    'argv', 'command', 'positional', 'version', 'component',
+    'platform_config_paths', 'verbose', 'timings',
+])
+
+
+def parse_invocation(argv):
+    parsed = {
+        'argv': [], 'positional': [], 'component': None,
+        'platform_config_paths': [], 'flags': set(),
+    }
+    iterator = iter(argv)
+    for arg in iterator:
+        _parse_argument(arg, iterator, parsed)
+    command_argv = parsed['argv']
+    return Invocation(
+        argv=tuple(command_argv),
+        command=_command(command_argv),
+        positional=tuple(parsed['positional']),
+        version=_get_version(parsed['positional']),
+        component=parsed['component'],
+        platform_config_paths=tuple(parsed['platform_config_paths']),
+        verbose=bool(parsed['flags'] & set(VERBOSE_FLAGS)),
+        timings=TIMINGS_FLAG in parsed['flags'],
+    )
+
+
+def _parse_argument(arg, iterator, parsed):
+    # Options consume their value first, so a value that looks like a flag
+    # is still a value. --timings is for the wrapper, so it isn't passed on.
+    if _parse_option_argument(arg, iterator, parsed):
+        return
+    if arg in FLAGS + (TIMINGS_FLAG,):
+        parsed['flags'].add(arg)
+    else:
+        parsed['positional'].append(arg)
+    if arg != TIMINGS_FLAG:
+        parsed['argv'].append(arg)
+
 
-def toggle_verbose_logging(argv):
-    if {'-v', '--verbose'} & set(argv):
+def _parse_option_argument(arg, iterator, parsed):
+    if arg in COMPONENT_OPTIONS:
+        parsed['component'] = _take_option_value(arg, iterator, parsed)
+    elif arg == PLATFORM_CONFIG_OPTION:
+        parsed['platform_config_paths'].append(
+            _take_option_value(arg, iterator, parsed),
+        )
+    elif arg.startswith(PLATFORM_CONFIG_OPTION + '='):
+        parsed['argv'].append(arg)
+        parsed['platform_config_paths'].append(arg.split('=', 1)[1])
+    else:
+        return False
+    return True
+
+
+def _take_option_value(option, iterator, parsed):
+    value = next(iterator, None)
+    parsed['argv'].extend([option] if value is None else [option, value])
+    return value
+
+
+def _get_version(positional):
+    version_index = VERSION_INDEXES.get(_command(positional))
+    if version_index is not None and version_index < len(positional):
+        return positional[version_index]
+
+
+def toggle_verbose_logging(invocation):
+    if invocation.verbose:
         logger.setLevel(logging.DEBUG)
         logger.debug('Debug logging enabled')
 
 
 class CDFlowWrapperException(Exception):
     def __str__(self):
-        return self.message or self.__class__.message
+        if self.args:
+            return str(self.args[0])
+        return self.message
 
 
 class GitRemoteError(CDFlowWrapperException):
@@ -56,10 +428,31 @@ class InvalidURLError(CDFlowWrapperException):
     pass
 
 
+class ImagePullError(CDFlowWrapperException):
+    pass
+
+
 class MissingPlatformConfigError(CDFlowWrapperException):
     message = 'error: --platform-config parameter is required'
 
 
+class MissingBatchManifestError(CDFlowWrapperException):
+    message = 'error: deploy-batch requires a manifest path'
+
+
+class InvalidBatchManifestError(CDFlowWrapperException):
+    pass
+
+
+class InvalidManifestError(CDFlowWrapperException):
+    pass
+
+
+class MissingReleaseVersionError(CDFlowWrapperException):
+    message = 'error: sync-index requires a version or --last <n>'
+
+
+@timed_function('fetch_release_metadata')
 def fetch_release_metadata(
     s3_resource, bucket_name, component_name, version, team_name=None,
 ):
@@ -74,31 +467,6 @@ def fetch_release_metadata(
     return release_object.metadata
 
 
-def get_version(argv):
-    local_argv = remove_argv_options(argv)
-    command = local_argv[0]
-    if command == 'deploy':
-        version_index = 2
-    elif command == 'release':
-        version_index = 1
-    try:
-        return local_argv[version_index]
-    except IndexError:
-        pass
-
-
-def remove_argv_options(argv):
-    local_argv = copy(argv)
-    for flag in ('-p', '-v', '--plan-only', '--verbose'):
-        with _suppress(ValueError):
-            local_argv.remove(flag)
-    for option in ('-c', '--component', '--platform-config'):
-        with _suppress(ValueError):
-            option_index = local_argv.index(option)
-            del local_argv[option_index:option_index+2]
-    return local_argv
-
-
 @contextmanager
 def _suppress(*exceptions):
     try:
@@ -107,26 +475,32 @@ def _suppress(*exceptions):
         pass
 
 
-def get_component_name(argv):
-    component_name = _get_component_name_from_cli_args(argv)
-    if component_name:
-        return component_name
+def get_component_name(invocation):
+    if invocation.component:
+        return invocation.component
     else:
         return _get_component_name_from_git_remote()
 
 
-def _get_component_name_from_cli_args(argv):
-    component_flag_index = -1
-    for flag in ('-c', '--component'):
-        try:
-            component_flag_index = argv.index(flag)
-        except ValueError:
-            pass
-    if component_flag_index > -1:
-        return argv[component_flag_index + 1]
+def _get_component_name_from_git_remote():
+    remote = _get_git_remote_url()
+    name = remote.strip('\t\n /').split('/')[-1]
+    if name.endswith('.git'):
+        return name[:-4]
+    return name
 
 
-def _get_component_name_from_git_remote():
+def _get_git_remote_url():
+    git_dir = None if os.getenv('GIT_DIR') else _find_git_dir(os.getcwd())
+    if git_dir is None:
+        return _get_git_remote_url_from_git()
+    if git_dir not in _git_remote_urls:
+        _git_remote_urls[git_dir] = \
+            _read_git_remote_url(git_dir) or _get_git_remote_url_from_git()
+    return _git_remote_urls[git_dir]
+
+
+def _get_git_remote_url_from_git():
     try:
         remote = check_output(['git', 'config', 'remote.origin.url'])
     except CalledProcessError:
@@ -134,30 +508,90 @@ def _get_component_name_from_git_remote():
             'error: could not get remote from git repo '
             ' (git config remote.origin.url)'
         )
-    name = remote.decode('utf-8').strip('\t\n /').split('/')[-1]
-    if name.endswith('.git'):
-        return name[:-4]
-    return name
+    return remote.decode('utf-8')
+
 
+def _find_git_dir(directory):
+    directory = abspath(directory)
+    while True:
+        dot_git = join(directory, '.git')
+        if isdir(dot_git):
+            return dot_git
+        if isfile(dot_git):
+            # Worktrees and submodules have a .git file pointing at the real
+            # git directory.
+            return _read_gitdir_file(dot_git)
+        if dirname(directory) == directory:
+            return None
+        directory = dirname(directory)
 
-def _get_platform_config_path_arg(iterator):
+
+def _read_gitdir_file(dot_git):
     try:
-        return next(iterator)
-    except StopIteration:
-        raise MissingPlatformConfigError()
+        with open(dot_git) as gitdir_file:
+            content = gitdir_file.read().strip()
+    except IOError:
+        return None
+    if content.startswith('gitdir:'):
+        return normpath(join(dirname(dot_git), content[7:].strip()))
 
 
-def get_platform_config_paths(argv):
-    paths = []
-    iterator = iter(argv)
-    for arg in iterator:
-        if arg == '--platform-config':
-            paths.append(abspath(_get_platform_config_path_arg(iterator)))
-        elif arg.startswith('--platform-config='):
-            paths.append(abspath(arg.split('=', 1)[1]))
-    if len(paths) == 0:
+def _get_git_common_dir(git_dir):
+    try:
+        with open(join(git_dir, 'commondir')) as commondir_file:
+            return normpath(join(git_dir, commondir_file.read().strip()))
+    except IOError:
+        return git_dir
+
+
+def _read_git_remote_url(git_dir):
+    config_path = join(_get_git_common_dir(git_dir), 'config')
+    try:
+        with open(config_path) as config_file:
+            return _parse_git_remote_url(config_file)
+    except (IOError, ValueError) as e:
+        logger.debug('Could not read remote from {}: {}'.format(
+            config_path, e,
+        ))
+
+
+def _parse_git_remote_url(config_lines):
+    # Only the plain subset of the git config syntax is handled; anything
+    # that could change the answer (includes, url rewrites, quoting) raises
+    # ValueError so the caller falls back to asking git.
+    section = None
+    url = None
+    for line in config_lines:
+        line = line.strip()
+        if line.startswith('['):
+            section = _parse_git_config_section(line)
+        elif section == ('remote', 'origin'):
+            url = _parse_git_config_url(line) or url
+    return url
+
+
+def _parse_git_config_section(line):
+    match = GIT_CONFIG_SECTION.match(line)
+    if not match or match.group(1).lower() in GIT_CONFIG_UNSUPPORTED_SECTIONS:
+        raise ValueError('unsupported section {}'.format(line))
+    return match.group(1).lower(), match.group(2)
+
+
+def _parse_git_config_url(line):
+    match = GIT_CONFIG_URL.match(line)
+    if not match:
+        return None
+    url = match.group(1).strip()
+    if any(character in url for character in '"\\;#'):
+        raise ValueError('unsupported url value {}'.format(url))
+    return url
+
+
+def get_platform_config_paths(invocation):
+    paths = invocation.platform_config_paths
+    if len(paths) == 0 or None in paths:
         raise MissingPlatformConfigError()
-    return paths
+    return [abspath(path) for path in paths]
 
 
 def _get_release_storage_key_classic(component_name, version):
@@ -170,6 +604,30 @@ def _get_release_storage_key(team_name, component_name, version):
     )
 
 
+def _get_release_storage_prefix(component_name, team_name=None):
+    if team_name:
+        return '{}/{}/{}-'.format(team_name, component_name, component_name)
+    return '{}/{}-'.format(component_name, component_name)
+
+
+def list_release_versions(
+    s3_resource, bucket_name, component_name, team_name=None,
+):
+    prefix = _get_release_storage_prefix(component_name, team_name)
+    logger.debug('Listing releases under {} in {} bucket'.format(
+        prefix, bucket_name,
+    ))
+    releases = sorted(
+        (
+            release for release in
+            s3_resource.Bucket(bucket_name).objects.filter(Prefix=prefix)
+            if release.key.endswith('.zip')
+        ),
+        key=lambda release: release.last_modified,
+    )
+    return [release.key[len(prefix):-len('.zip')] for release in releases]
+
+
 def _get_auth_config_from_env_vars():
     if os.getenv('DOCKERHUB_USERNAME') and \
        os.getenv('DOCKERHUB_PASSWORD'):
@@ -194,14 +652,7 @@ def _get_auth_config_from_users_docker_config():
         )
         try:
             data = json.load(open(users_docker_config))
-            base64data = data['auths']['https://index.docker.io/v1/']['auth']
-            decoded_data = base64.b64decode(
-                base64data.encode("utf-8")
-            ).decode('utf-8').split(':')
-            return {
-                'username': decoded_data[0],
-                'password': decoded_data[1],
-            }
+            return _decode_auth(data['auths'][DOCKERHUB_AUTH_KEY]['auth'])
         except ValueError as e:
             logger.debug(e)
             logger.info(
@@ -223,7 +674,45 @@ def _get_auth_config_from_users_docker_config():
     return None
 
 
-def _get_auth_config():
+def _decode_auth(base64data):
+    decoded_data = base64.b64decode(
+        base64data.encode("utf-8")
+    ).decode('utf-8').split(':')
+    return {
+        'username': decoded_data[0],
+        'password': decoded_data[1],
+    }
+
+
+def _get_registry_auth_config(registry):
+    try:
+        with open(_get_users_docker_config_location()) as config_file:
+            auths = json.load(config_file).get('auths', {})
+    except (IOError, OSError, ValueError) as e:
+        logger.debug(e)
+        return None
+    # `docker login <host>` stores the bare host, but hand written configs
+    # often use a URL.
+    for key in (registry, 'https://' + registry, 'http://' + registry):
+        if key in auths:
+            return _decode_registry_auth(registry, auths[key])
+    return None
+
+
+def _decode_registry_auth(registry, auth):
+    try:
+        return _decode_auth(auth['auth'])
+    except (KeyError, TypeError, binascii.Error) as e:
+        logger.debug(e)
+        logger.info(
+            'Error decoding the {} credentials from the users docker '
+            'config, pulling without auth'.format(registry)
+        )
+
+
+def _get_auth_config(registry=None):
+    if registry is not None:
+        return _get_registry_auth_config(registry)
     auth_config = _get_auth_config_from_env_vars()
     if auth_config:
         return auth_config
@@ -233,19 +722,204 @@ def _get_auth_config():
     return None
 
 
+def _get_pull_kwargs(registry=None):
+    auth_config = _get_auth_config(registry)
+    if auth_config:
+        logger.info('Pulling with auth')
+        return {'auth_config': auth_config}
+    logger.info('Pulling without auth')
+    return {}
+
+
+def get_registry_mirrors():
+    mirrors = os.getenv('CDFLOW_REGISTRY_MIRRORS')
+    if mirrors:
+        mirrors = mirrors.split(',')
+    else:
+        mirrors = get_manifest_data().get('registry-mirrors') or []
+    return [
+        str(mirror).strip().rstrip('/') for mirror in mirrors
+        if str(mirror).strip()
+    ]
+
+
+def _get_registry_host(mirror):
+    return mirror.split('://', 1)[-1]
+
+
+def rank_registry_mirrors(mirrors):
+    with _registry_latencies_lock:
+        unprobed = [
+            mirror for mirror in mirrors if mirror not in _registry_latencies
+        ]
+    if unprobed:
+        with ThreadPoolExecutor(max_workers=len(unprobed)) as executor:
+            latencies = list(executor.map(_probe_registry, unprobed))
+        with _registry_latencies_lock:
+            _registry_latencies.update(zip(unprobed, latencies))
+    with _registry_latencies_lock:
+        reachable = [
+            mirror for mirror in mirrors
+            if _registry_latencies[mirror] is not None
+        ]
+        # sorted is stable, so mirrors that answer equally fast keep the
+        # configured order.
+        return sorted(reachable, key=_registry_latencies.get)
+
+
+def _probe_registry(mirror):
+    from urllib.error import HTTPError, URLError
+    from urllib.request import urlopen
+    url = '{}/v2/'.format(mirror if '://' in mirror else 'https://' + mirror)
+    start = time.time()
+    try:
+        urlopen(url, timeout=REGISTRY_PROBE_TIMEOUT).close()
+    except HTTPError:
+        # Any response, including 401 from a registry that wants a token,
+        # shows the mirror is up.
+        pass
+    except (URLError, OSError) as e:
+        logger.info('Registry mirror {} is unreachable: {}'.format(mirror, e))
+        return None
+    latency = time.time() - start
+    logger.debug('Registry mirror {} answered in {:.3f}s'.format(
+        mirror, latency,
+    ))
+    return latency
+
+
+def _is_dockerhub_image(image_id):
+    from docker.auth import resolve_repository_name
+    from docker.utils import parse_repository_tag
+    repository, _ = parse_repository_tag(image_id)
+    registry, _ = resolve_repository_name(repository)
+    return registry in DOCKERHUB_REGISTRIES
+
+
+def _get_mirror_image_ids(image_id, mirrors):
+    # A pull-through cache proxies Docker Hub, so only Hub images are looked
+    # up on the mirrors.
+    if not mirrors or not _is_dockerhub_image(image_id):
+        return []
+    return [
+        '{}/{}'.format(_get_registry_host(mirror), image_id)
+        for mirror in mirrors
+    ]
+
+
+def _get_canonical_digest(docker_client, image_id):
+    if '@' in image_id:
+        return image_id.split('@', 1)[1]
+    return _get_remote_digest(docker_client, image_id)
+
+
+def _get_remote_digest(docker_client, image_id):
+    # Distribution inspect only fetches the manifest from the registry,
+    # which is a single small request compared to negotiating a pull.
+    try:
+        return docker_client.images.get_registry_data(
+            image_id, auth_config=_get_auth_config(),
+        ).id
+    except Exception as e:
+        logger.info('Could not look up the digest of {}: {}'.format(
+            image_id, e,
+        ))
+
+
+def _pull_from_mirrors(docker_client, image_id, digest=None):
+    mirror_image_ids = _get_mirror_image_ids(
+        image_id, rank_registry_mirrors(get_registry_mirrors()),
+    )
+    digest = mirror_image_ids and (
+        digest or _get_canonical_digest(docker_client, image_id)
+    )
+    if not digest:
+        return None
+    for mirror_image_id in mirror_image_ids:
+        if _pull_verified_mirror_image(docker_client, mirror_image_id, digest):
+            return mirror_image_id, digest
+    return None
+
+
+def _pull_verified_mirror_image(docker_client, mirror_image_id, digest):
+    logger.info('Pulling image {}'.format(mirror_image_id))
+    try:
+        image = _pull_image(
+            docker_client, mirror_image_id,
+            _get_pull_kwargs(mirror_image_id.split('/', 1)[0]),
+        )
+    except Exception as e:
+        logger.info('Could not pull {}: {}'.format(mirror_image_id, e))
+        return None
+    if not _has_repo_digest(image, digest):
+        logger.info('{} does not match {}, skipping the mirror'.format(
+            mirror_image_id, digest,
+        ))
+        return None
+    return image
+
+
+def _has_repo_digest(image, digest):
+    # The image may have been pulled through a registry mirror, so any
+    # repository's digest will do.
+    return any(
+        repo_digest.endswith('@' + digest)
+        for repo_digest in image.attrs['RepoDigests']
+    )
+
+
+@timed_function('get_image_sha')
 def get_image_sha(docker_client, image_id):
+    image_sha = _get_cached_image_sha(docker_client, image_id)
+    if image_sha:
+        return image_sha
+    image_sha, digest = _get_current_image_sha(docker_client, image_id)
+    image_sha = image_sha or _pull_image_sha(docker_client, image_id, digest)
+    _cache_image_sha(image_id, image_sha)
+    return image_sha
+
+
+def _get_current_image_sha(docker_client, image_id):
+    # Also returns the registry's digest, so a pull of a stale image can
+    # reuse it rather than asking the registry again.
+    from docker.errors import ImageNotFound
+    from docker.utils import parse_repository_tag
+    try:
+        image = docker_client.images.get(image_id)
+    except ImageNotFound:
+        return None, None
+    digest = _get_remote_digest(docker_client, image_id)
+    if not digest or not _has_repo_digest(image, digest):
+        return None, digest
+    image_sha = '{}@{}'.format(parse_repository_tag(image_id)[0], digest)
+    logger.info('{} is up to date ({})'.format(image_id, image_sha))
+    return image_sha, digest
+
+
+def _pull_image_sha(docker_client, image_id, digest=None):
+    mirrored = _pull_from_mirrors(docker_client, image_id, digest)
+    if mirrored:
+        return _use_mirror_image(docker_client, image_id, *mirrored)
+    return _pull_canonical_image_sha(docker_client, image_id)
+
+
+def _use_mirror_image(docker_client, image_id, mirror_image_id, digest):
+    from docker.utils import parse_repository_tag
+    repository, tag = parse_repository_tag(image_id)
+    if '@' not in image_id:
+        # Tag it under the canonical name too, so containers can be
+        # created from the image ID the wrapper was given.
+        docker_client.images.get(mirror_image_id).tag(
+            repository, tag or 'latest',
+        )
+    return '{}@{}'.format(repository, digest)
+
+
+def _pull_canonical_image_sha(docker_client, image_id):
+    from docker.errors import ImageNotFound
     logger.info('Pulling image {}'.format(image_id))
     try:
-        auth_config = _get_auth_config()
-        if auth_config:
-            logger.info('Pulling with auth')
-            image = docker_client.images.pull(
-                image_id,
-                auth_config=auth_config,
-            )
-        else:
-            logger.info('Pulling without auth')
-            image = docker_client.images.pull(image_id)
+        image = _pull_image(docker_client, image_id, _get_pull_kwargs())
     except ImageNotFound as e:
         logger.debug(e)
         logger.info(
@@ -254,32 +928,307 @@ def get_image_sha(docker_client, image_id):
             )
         )
         image = docker_client.images.get(image_id)
+    return _get_repo_digest(image, image_id)
+
+
+def _get_repo_digest(image, image_id):
+    # An image pulled from a mirror before also has the mirror's digest, so
+    # prefer the one for the repository that was asked for.
+    from docker.utils import parse_repository_tag
+    repository, _ = parse_repository_tag(image_id)
     digests = image.attrs['RepoDigests']
+    for digest in digests:
+        if parse_repository_tag(digest)[0] == repository:
+            return digest
     return digests[0] if len(digests) else image_id
 
 
+def _pull_image(docker_client, image_id, kwargs):
+    from docker.utils import parse_repository_tag
+    repository, tag = parse_repository_tag(image_id)
+    tag = tag or 'latest'
+    progress = PullProgress(image_id)
+    for attempt in range(1, PULL_ATTEMPTS + 1):
+        try:
+            _stream_pull(docker_client, repository, tag, kwargs, progress)
+            break
+        except Exception as e:
+            if attempt == PULL_ATTEMPTS or not _is_retryable_pull_error(e):
+                raise
+            delay = PULL_RETRY_DELAY * 2 ** (attempt - 1)
+            logger.info('Pulling {} failed ({}), retrying in {}s'.format(
+                image_id, e, delay,
+            ))
+            time.sleep(delay)
+    progress.finish()
+    separator = '@' if tag.startswith('sha256:') else ':'
+    return docker_client.images.get(
+        '{}{}{}'.format(repository, separator, tag)
+    )
+
+
+def _stream_pull(docker_client, repository, tag, kwargs, progress):
+    # The daemon keeps layers that finished downloading, so a retried pull
+    # only fetches the layers that failed.
+    for event in docker_client.api.pull(
+        repository, tag=tag, stream=True, decode=True, **kwargs
+    ):
+        if 'error' in event:
+            raise ImagePullError('error: pulling {}: {}'.format(
+                progress.image_id, event['error'],
+            ))
+        progress.update(event)
+
+
+def _is_retryable_pull_error(error):
+    from docker.errors import APIError
+    from requests.exceptions import ConnectionError, ReadTimeout
+    if isinstance(error, APIError):
+        return error.is_server_error()
+    return isinstance(error, (ImagePullError, ConnectionError, ReadTimeout))
+
+
+class PullProgress(object):
+    """Follows the event stream of an image pull.
+
+    On an interactive terminal the status of each layer is redrawn in place.
+    Otherwise, and for pulls on worker threads, layer changes are logged at
+    debug level with a progress summary every PULL_PROGRESS_INTERVAL
+    seconds. The total downloaded and the throughput are logged at the end.
+    """
+
+    def __init__(self, image_id):
+        self.image_id = image_id
+        self.layers = {}
+        self.start = self.last_report = time.time()
+        self.rendered_lines = 0
+        self.interactive = sys.stderr.isatty() and \
+            threading.current_thread() is threading.main_thread()
+
+    def update(self, event):
+        layer_id = event.get('id')
+        if layer_id and 'progressDetail' in event:
+            self._update_layer(layer_id, event)
+        now = time.time()
+        if self.interactive and now - self.last_report >= \
+                PULL_RENDER_INTERVAL:
+            self.last_report = now
+            self._render()
+        elif not self.interactive and now - self.last_report >= \
+                PULL_PROGRESS_INTERVAL:
+            self.last_report = now
+            logger.info('Pulling {}: {}'.format(
+                self.image_id, self._summary(),
+            ))
+
+    def _update_layer(self, layer_id, event):
+        layer = self.layers.setdefault(layer_id, {'current': 0, 'total': 0})
+        if event['status'] != layer.get('status') and \
+                event['status'] not in PULL_QUIET_STATUSES:
+            logger.debug('{} {}: {}'.format(
+                self.image_id, layer_id, event['status'],
+            ))
+        layer['status'] = event['status']
+        if event['status'] == 'Downloading':
+            layer['current'] = event['progressDetail'].get('current', 0)
+            layer['total'] = event['progressDetail'].get('total', 0)
+        elif event['status'] == 'Download complete':
+            layer['current'] = layer['total']
+
+    def _render(self):
+        lines = [
+            '{}: {} {}'.format(
+                layer_id, layer['status'], _format_progress(layer),
+            ).rstrip()
+            for layer_id, layer in self.layers.items()
+        ]
+        output = '\x1b[{}A'.format(self.rendered_lines) \
+            if self.rendered_lines else ''
+        output += ''.join('\x1b[2K{}\n'.format(line) for line in lines)
+        sys.stderr.write(output)
+        sys.stderr.flush()
+        self.rendered_lines = len(lines)
+
+    def _summary(self):
+        done = sum(
+            layer['status'] in ('Pull complete', 'Already exists')
+            for layer in self.layers.values()
+        )
+        return '{}/{} layers, {}'.format(
+            done, len(self.layers), _format_progress({
+                'current': self._downloaded(),
+                'total': sum(
+                    layer['total'] for layer in self.layers.values()
+                ),
+            }),
+        )
+
+    def _downloaded(self):
+        return sum(layer['current'] for layer in self.layers.values())
+
+    def finish(self):
+        if self.interactive and self.layers:
+            self._render()
+        downloaded = self._downloaded()
+        if not downloaded:
+            return
+        elapsed = max(time.time() - self.start, 0.001)
+        logger.info(
+            'Pulled {}: {:.1f} MB in {:.1f}s ({:.1f} MB/s)'.format(
+                self.image_id, downloaded / 1e6, elapsed,
+                downloaded / 1e6 / elapsed,
+            )
+        )
+
+
+def _format_progress(layer):
+    if not layer['total']:
+        return ''
+    return '{:.1f}/{:.1f} MB'.format(
+        layer['current'] / 1e6, layer['total'] / 1e6,
+    )
+
+
+def ensure_image(docker_client, image_id):
+    if '@' not in image_id:
+        get_image_sha(docker_client, image_id)
+        return image_id
+    # A digest reference is immutable, so a local copy is always current,
+    # whichever registry it was pulled from. Docker only resolves a digest
+    # under the repository it was pulled as, so the reference to run may be
+    # the mirror's.
+    local_image_id = _find_local_image(
+        docker_client,
+        [image_id] + _get_mirror_image_ids(image_id, get_registry_mirrors()),
+    )
+    if local_image_id:
+        return local_image_id
+    mirrored = _pull_from_mirrors(docker_client, image_id)
+    if mirrored:
+        return mirrored[0]
+    _pull_canonical_image_sha(docker_client, image_id)
+    return image_id
+
+
+def _find_local_image(docker_client, image_ids):
+    from docker.errors import ImageNotFound
+    for image_id in image_ids:
+        try:
+            docker_client.images.get(image_id)
+            return image_id
+        except ImageNotFound:
+            pass
+
+
+def _get_cache_dir():
+    overridden_cache_dir = os.getenv('CDFLOW_CACHE_DIR')
+    if overridden_cache_dir:
+        return overridden_cache_dir
+    return expanduser('~') + '/.cdflow/cache'
+
+
+def _read_json_cache(name):
+    try:
+        with open('{}/{}'.format(_get_cache_dir(), name)) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError) as e:
+        logger.debug('Could not read cache {}: {}'.format(name, e))
+        return {}
+
+
+def _write_json_cache(name, data):
+    cache_dir = _get_cache_dir()
+    path = '{}/{}'.format(cache_dir, name)
+    # Write then rename so concurrent cdflow processes never see a partial
+    # cache file.
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(temporary_path, 'w') as cache_file:
+            json.dump(data, cache_file)
+        os.replace(temporary_path, path)
+    except (IOError, OSError) as e:
+        logger.debug('Could not write cache {}: {}'.format(name, e))
+
+
+def _get_image_cache_ttl():
+    try:
+        return int(os.getenv('CDFLOW_IMAGE_CACHE_TTL') or 0)
+    except ValueError:
+        logger.info(
+            'CDFLOW_IMAGE_CACHE_TTL must be a number of seconds, '
+            'ignoring the image digest cache'
+        )
+        return 0
+
+
+def _get_fresh_image_cache_entry(image_id):
+    ttl = _get_image_cache_ttl()
+    if ttl <= 0:
+        return None
+    entry = _read_json_cache(IMAGE_DIGEST_CACHE).get(image_id)
+    if entry and time.time() - entry['timestamp'] <= ttl:
+        return entry
+
+
+def _get_cached_image_sha(docker_client, image_id):
+    from docker.errors import ImageNotFound
+    entry = _get_fresh_image_cache_entry(image_id)
+    if not entry:
+        return None
+    try:
+        image = docker_client.images.get(image_id)
+    except ImageNotFound:
+        return None
+    if not _has_repo_digest(image, entry['digest'].partition('@')[2]):
+        return None
+    logger.info('Using cached digest {} for {}'.format(
+        entry['digest'], image_id,
+    ))
+    return entry['digest']
+
+
+def _cache_image_sha(image_id, image_sha):
+    if _get_image_cache_ttl() <= 0 or image_sha == image_id:
+        return
+    cache = _read_json_cache(IMAGE_DIGEST_CACHE)
+    cache[image_id] = {'digest': image_sha, 'timestamp': time.time()}
+    _write_json_cache(IMAGE_DIGEST_CACHE, cache)
+
+
+def record_image_usage(image_id):
+    # Read by `cdflow gc` to decide which images are still in use.
+    with _image_usage_lock:
+        usage = _read_json_cache(IMAGE_USAGE_CACHE)
+        usage[image_id] = time.time()
+        _write_json_cache(IMAGE_USAGE_CACHE, usage)
+
+
+def clear_image_cache(invocation):
+    image_ids = invocation.positional[1:]
+    cache = _read_json_cache(IMAGE_DIGEST_CACHE)
+    for image_id in image_ids or list(cache):
+        cache.pop(image_id, None)
+    _write_json_cache(IMAGE_DIGEST_CACHE, cache)
+    print('Image digest cache cleared')
+    return 0
+
+
+@timed_function('docker_run')
 def docker_run(
     docker_client, image_id, command, project_root,
-    environment_variables, platform_config_paths=[],
+    environment_variables, platform_config_paths=[], output_prefix=None,
 ):
+    from docker.errors import DockerException
     exit_status = 0
     output = 'Done'
+    record_image_usage(image_id)
+    plugin_cache_lock = None
     try:
-        volumes = {
-            project_root: {
-                'bind': project_root,
-                'mode': 'rw',
-            },
-            '/var/run/docker.sock': {
-                'bind': '/var/run/docker.sock',
-                'mode': 'ro',
-            }
-        }
-        for platform_config_path in platform_config_paths:
-            volumes[platform_config_path] = {
-                'bind': platform_config_path,
-                'mode': 'ro',
-            }
+        volumes = _get_volumes(project_root, platform_config_paths)
+        plugin_cache_lock = _mount_plugin_cache(
+            docker_client, image_id, volumes, environment_variables,
+        )
         if _command(command) == 'shell':
             columns = int(check_output(['tput', 'cols']))
             lines = int(check_output(['tput', 'lines']))
@@ -293,57 +1242,213 @@ def docker_run(
                 working_dir=project_root,
                 tty=True,
                 stdin_open=True,
+                auto_remove=True,
             )
-            _put_docker_config_into_container(container)
+            _put_docker_config_into_container(container, volumes)
             dockerpty.start(docker_client.api, container.id)
             output = 'Shell end'
         else:
-            container = docker_client.containers.create(
-                image_id,
-                command=command,
-                environment=environment_variables,
-                detach=True,
-                volumes=volumes,
-                working_dir=project_root,
-            )
-            _put_docker_config_into_container(container)
-            container.start()
-            _print_logs(container)
+            with timed('container_create'):
+                container = docker_client.containers.create(
+                    image_id,
+                    command=command,
+                    environment=environment_variables,
+                    detach=True,
+                    volumes=volumes,
+                    working_dir=project_root,
+                )
+            with timed('credential_injection'):
+                _put_docker_config_into_container(container, volumes)
+            with timed('container_run'):
+                # Attaching before start means no early output can be missed.
+                output_stream = container.attach(
+                    stdout=True, stderr=True, stream=True, logs=True,
+                    demux=True,
+                )
+                container.start()
+                _track_container(container)
+                _print_output(output_stream, output_prefix)
             return handle_finished_container(container)
     except DockerException as error:
         exit_status = 1
         output = str(error)
+    finally:
+        _release_lock(plugin_cache_lock)
     return exit_status, output
 
 
-def _get_users_docker_config_location():
-    overridden_docker_config = os.getenv('DOCKER_CONFIG')
-    if overridden_docker_config:
-        logger.info(
-            'Users docker config overridden by DOCKER_CONFIG environment ' +
-            'variable set to \'{}\''.format(overridden_docker_config)
-        )
-        return overridden_docker_config
-    else:
-        return expanduser("~") + "/.docker/config.json"
+def _get_volumes(project_root, platform_config_paths):
+    volumes = {
+        project_root: {
+            'bind': project_root,
+            'mode': 'rw',
+        },
+        '/var/run/docker.sock': {
+            'bind': '/var/run/docker.sock',
+            'mode': 'ro',
+        }
+    }
+    for platform_config_path in platform_config_paths:
+        volumes[platform_config_path] = {
+            'bind': platform_config_path,
+            'mode': 'ro',
+        }
+    docker_config_mount_path = _get_docker_config_mount_path()
+    if docker_config_mount_path:
+        # Writable, so that `docker login` in the container can update it.
+        volumes[docker_config_mount_path] = {
+            'bind': DOCKER_CONFIG_CONTAINER_PATH,
+            'mode': 'rw',
+        }
+    return volumes
 
 
-def _put_docker_config_into_container(container):
-    tarstream = None
-    users_docker_config = _get_users_docker_config_location()
+def _mount_plugin_cache(docker_client, image_id, volumes, environment):
+    # Returns the lock on the claimed cache, to hold until the container has
+    # finished.
+    plugin_cache = get_plugin_cache(docker_client, image_id)
+    if not plugin_cache:
+        return None
+    plugin_cache, lock = _claim_plugin_cache(plugin_cache)
+    if lock is None:
+        return None
+    _add_plugin_cache_volume(plugin_cache, volumes, environment)
+    return lock
 
-    if os.getenv('DOCKERHUB_USERNAME') and \
-       os.getenv('DOCKERHUB_PASSWORD'):
-        logger.info(
-            'DOCKERHUB env vars found, using them to create a ' +
-            'docker config in the container'
-        )
-        auth_string = (
-            os.getenv('DOCKERHUB_USERNAME') + ':' +
+
+def _add_plugin_cache_volume(plugin_cache, volumes, environment):
+    volumes[plugin_cache] = {
+        'bind': TERRAFORM_PLUGIN_CACHE_PATH,
+        'mode': 'rw',
+    }
+    environment['TF_PLUGIN_CACHE_DIR'] = TERRAFORM_PLUGIN_CACHE_PATH
+
+
+def _claim_plugin_cache(plugin_cache):
+    # Terraform's plugin cache isn't safe for concurrent `init`, so each
+    # container locks the first free slot, across cdflow processes and the
+    # threads of a batch. Slots after the first get a cache of their own.
+    lock_dir = '{}/plugin-cache-locks'.format(_get_cache_dir())
+    try:
+        os.makedirs(lock_dir, exist_ok=True)
+        for slot in itertools.count():
+            lock = _try_lock('{}/{}-{}.lock'.format(
+                lock_dir, os.path.basename(plugin_cache), slot,
+            ))
+            if lock is not None:
+                return _plugin_cache_slot(plugin_cache, slot), lock
+    except (IOError, OSError, ImportError) as e:
+        logger.info('Not using the plugin cache, could not lock it: {}'.format(
+            e,
+        ))
+        return None, None
+
+
+def _plugin_cache_slot(plugin_cache, slot):
+    return '{}-{}'.format(plugin_cache, slot) if slot else plugin_cache
+
+
+def _try_lock(path):
+    import fcntl
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _release_lock(lock_file):
+    # Closing the file releases its lock.
+    if lock_file is not None:
+        lock_file.close()
+
+
+def get_plugin_cache(docker_client, image_id):
+    setting = os.getenv('CDFLOW_TERRAFORM_PLUGIN_CACHE') or ''
+    if setting.lower() in ('off', 'false', '0'):
+        return None
+    key = _get_plugin_cache_key(docker_client, image_id)
+    if not key:
+        return None
+    if setting.startswith('/'):
+        return '{}/{}'.format(setting.rstrip('/'), key)
+    return TERRAFORM_PLUGIN_CACHE_VOLUME_PREFIX + key
+
+
+def _get_plugin_cache_key(docker_client, image_id):
+    # Keyed by image digest, so each terraform version gets its own cache
+    # and a removed image's cache can be pruned with it. Deploys run a
+    # digest reference, which needs no lookup.
+    from docker.errors import ImageNotFound
+    if not image_id.partition('@')[2].startswith('sha256:'):
+        try:
+            image = docker_client.images.get(image_id)
+        except ImageNotFound:
+            return None
+        image_id = _get_image_digests(image)[0]
+    return _short_digest(image_id)
+
+
+def _get_image_digests(image):
+    return (image.attrs.get('RepoDigests') or []) + [image.id]
+
+
+def _short_digest(reference):
+    return reference.split(':')[-1][:12]
+
+
+def _get_users_docker_config_location():
+    overridden_docker_config = os.getenv('DOCKER_CONFIG')
+    if overridden_docker_config:
+        logger.info(
+            'Users docker config overridden by DOCKER_CONFIG environment ' +
+            'variable set to \'{}\''.format(overridden_docker_config)
+        )
+        return overridden_docker_config
+    else:
+        return expanduser("~") + "/.docker/config.json"
+
+
+def _put_docker_config_into_container(container, volumes={}):
+    if any(
+        volume['bind'] == DOCKER_CONFIG_CONTAINER_PATH
+        for volume in volumes.values()
+    ):
+        logger.info('docker config mounted into the container')
+        return
+    payload = _get_docker_config_payload()
+    if payload:
+        return container.put_archive(
+            '/root',
+            _get_docker_config_archive(payload)
+        )
+    else:
+        logger.info(
+            'WARNING - No dockerhub credentials have been added to the ' +
+            'container. It will have no auth and could hit pull limits. ' +
+            'Either: the DOCKERHUB environment vars for the credentials are '
+            'not set or the user has no docker config at ' +
+            '\'' + _get_users_docker_config_location() + '\''
+        )
+
+
+def _get_docker_config_payload():
+    users_docker_config = _get_users_docker_config_location()
+
+    if os.getenv('DOCKERHUB_USERNAME') and \
+       os.getenv('DOCKERHUB_PASSWORD'):
+        logger.info(
+            'DOCKERHUB env vars found, using them to create a ' +
+            'docker config in the container'
+        )
+        auth_string = (
+            os.getenv('DOCKERHUB_USERNAME') + ':' +
             os.getenv('DOCKERHUB_PASSWORD')
         ).encode('utf-8')
         base64data = base64.b64encode(auth_string).decode('utf-8')
-        json_data = json.dumps({
+        return json.dumps({
             "auths": {
                 "https://index.docker.io/v1/": {
                     "auth": base64data
@@ -351,81 +1456,415 @@ def _put_docker_config_into_container(container):
             }
         }).encode('utf-8')
 
+    logger.info(
+        'Looking for a docker config at \'{}\''.format(
+            users_docker_config
+        )
+    )
+    if isfile(users_docker_config):
+        logger.info('docker config found, copying it into the container')
+        with open(users_docker_config, 'rb') as config_file:
+            return config_file.read()
+
+
+def _get_docker_config_archive(payload):
+    # Built once per distinct config, so batch and daemon runs that inject
+    # the same credentials into many containers reuse the archive.
+    key = hashlib.sha256(payload).hexdigest()
+    if key not in _docker_config_archives:
         tarinfo = tarfile.TarInfo(name='.docker/config.json')
-        tarinfo.size = len(json_data)
+        tarinfo.size = len(payload)
         tarinfo.mtime = time.time()
         tarinfo.mode = int('0600', 8)
         tarinfo.uid = tarinfo.gid = 0
         tarinfo.uname = tarinfo.gname = "root"
         tarstream = BytesIO()
         tar = tarfile.TarFile(fileobj=tarstream, mode='w')
-        tar.addfile(tarinfo, BytesIO(json_data))
+        tar.addfile(tarinfo, BytesIO(payload))
         tar.close()
-        tarstream.seek(0)
-    else:
-        logger.info(
-            'Looking for a docker config at \'{}\''.format(
-                users_docker_config
-            )
-        )
-        if isfile(users_docker_config):
-            logger.info('docker config found, copying it into the container')
-            tarstream = BytesIO()
-            tar = tarfile.TarFile(fileobj=tarstream, mode='w')
-            tar.add(users_docker_config,
-                    arcname='.docker/config.json', filter=_reset_tar_perms)
-            tar.close()
-            tarstream.seek(0)
+        _docker_config_archives[key] = tarstream.getvalue()
+    return _docker_config_archives[key]
+
+
+def _get_docker_config_mount_path():
+    if os.getenv('CDFLOW_DOCKER_CONFIG_INJECTION') != 'mount':
+        return None
+    payload = _get_docker_config_payload()
+    if not payload:
+        return None
+    try:
+        return _write_runtime_file(payload)
+    except (IOError, OSError) as e:
+        logger.info('Could not write docker config to mount: {}'.format(e))
+        return None
 
-    if tarstream:
-        return container.put_archive(
-            '/root',
-            tarstream
-        )
-    else:
-        logger.info(
-            'WARNING - No dockerhub credentials have been added to the ' +
-            'container. It will have no auth and could hit pull limits. ' +
-            'Either: the DOCKERHUB environment vars for the credentials are '
-            'not set or the user has no docker config at ' +
-            '\'' + users_docker_config + '\''
-        )
+
+def _write_runtime_file(data):
+    # A private copy per run in the user's runtime directory, which is
+    # usually a tmpfs, removed when the wrapper exits so credentials don't
+    # stay on disk.
+    from tempfile import mkstemp
+    descriptor, path = mkstemp(
+        prefix='cdflow-docker-config-', suffix='.json',
+        dir=os.getenv('XDG_RUNTIME_DIR') or None,
+    )
+    atexit.register(_remove_file, path)
+    with os.fdopen(descriptor, 'wb') as runtime_file:
+        runtime_file.write(data)
+    return path
 
 
-def _reset_tar_perms(tarinfo):
-    tarinfo.uid = tarinfo.gid = 0
-    tarinfo.uname = tarinfo.gname = "root"
-    return tarinfo
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.debug('Could not remove {}: {}'.format(path, e))
 
 
+@timed_function('handle_finished_container')
 def handle_finished_container(container):
-    atexit.register(_remove_container, container)
-    container.reload()
-    exit_status = container.attrs['State']['ExitCode']
+    # Registered before waiting, so the container is still removed if the
+    # wait fails.
+    atexit.register(_remove_tracked_container, container)
+    exit_status = container.wait()['StatusCode']
+    _track_container(container, running=False)
     output = ''
     if exit_status != 0:
         output = ''
     return exit_status, output
 
 
-def _print_logs(container):
-    for message in container.logs(
-        stream=True, follow=True, stdout=True, stderr=True
-    ):
-        print(message.decode('utf-8'), end='')
+def _track_container(container, running=True):
+    with _running_containers_lock:
+        if running:
+            _running_containers.add(container)
+        else:
+            _running_containers.discard(container)
 
 
-def _remove_container(container):
+def _signal_running_containers(signum):
+    from docker.errors import DockerException
+    with _running_containers_lock:
+        containers = list(_running_containers)
+    for container in containers:
+        logger.info('Sending signal {} to container {}'.format(
+            signum, container.short_id,
+        ))
+        with _suppress(DockerException):
+            container.kill(signal=signum)
+
+
+def _print_output(output_stream, prefix=None):
+    stdout = OutputRelay(sys.stdout, prefix)
+    stderr = OutputRelay(sys.stderr, prefix)
     try:
-        container.stop()
-    # An HTTP timeout is thrown until this issue is addressed, then we can
-    # stop catching any exception:
-    # https://github.com/docker/docker-py/issues/1374
-    except ReadTimeout:
-        pass
+        for stdout_chunk, stderr_chunk in output_stream:
+            if stdout_chunk:
+                stdout.write(stdout_chunk)
+            if stderr_chunk:
+                stderr.write(stderr_chunk)
+    finally:
+        stdout.close()
+        stderr.close()
+
+
+class OutputRelay(object):
+    """Copies container output to a stream.
+
+    Bytes are written straight to the stream's binary buffer when it has one,
+    and are only decoded (incrementally, so multibyte characters split across
+    chunks survive) for text-only streams. Output is batched into large
+    writes, with a background thread flushing at least every
+    OUTPUT_FLUSH_INTERVAL seconds so quiet periods don't hold output back.
+
+    With a prefix, only whole lines are written, each starting with the
+    prefix, so output from containers running side by side can be told apart
+    and never interleaves mid-line.
+    """
+
+    def __init__(self, stream, prefix=None):
+        stream.flush()
+        self._stream = stream
+        self._prefix = prefix.encode('utf-8') if prefix else None
+        self._binary = getattr(stream, 'buffer', None)
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._pending = bytearray()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def write(self, chunk):
+        with self._lock:
+            self._pending += chunk
+            if len(self._pending) >= OUTPUT_BUFFER_SIZE:
+                self._flush()
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        with self._lock:
+            self._flush(final=True)
+
+    def _flush_periodically(self):
+        while not self._closed.wait(OUTPUT_FLUSH_INTERVAL):
+            with self._lock:
+                self._flush()
+
+    def _flush(self, final=False):
+        data = self._take_pending(final)
+        if not data and not final:
+            return
+        if self._binary is not None:
+            self._binary.write(data)
+            self._binary.flush()
+        else:
+            self._stream.write(self._decoder.decode(data, final))
+            self._stream.flush()
+
+    def _take_pending(self, final):
+        end = len(self._pending)
+        if self._prefix is not None and not final:
+            # Holds back the last, incomplete line.
+            end = self._pending.rfind(b'\n') + 1
+        data = bytes(self._pending[:end])
+        del self._pending[:end]
+        if self._prefix is None or not data:
+            return data
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        return b''.join(
+            self._prefix + line for line in data.splitlines(True)
+        )
+
+
+def _remove_container(container, exited=False):
+    from requests.exceptions import ReadTimeout
+    if not exited:
+        try:
+            container.stop()
+        # An HTTP timeout is thrown until this issue is addressed, then we can
+        # stop catching any exception:
+        # https://github.com/docker/docker-py/issues/1374
+        except ReadTimeout:
+            pass
+    if os.getenv('CDFLOW_BACKGROUND_CLEANUP') and \
+            _remove_container_in_background(container):
+        return
     container.remove()
 
 
+def _remove_tracked_container(container):
+    # A container is only known to have exited once its wait has returned
+    # and it is no longer tracked as running.
+    with _running_containers_lock:
+        running = container in _running_containers
+    _remove_container(container, exited=not running)
+
+
+def _remove_container_in_background(container):
+    try:
+        Popen(
+            ['docker', 'container', 'rm', container.id],
+            stdout=DEVNULL, stderr=DEVNULL, start_new_session=True,
+        )
+    except OSError as e:
+        logger.debug('Could not remove container in background: {}'.format(e))
+        return False
+    return True
+
+
+def run_command(
+    docker_client, image_id, command, project_root,
+    environment_variables, platform_config_paths=[],
+):
+    container = None
+    if _command(command) in DAEMON_COMMANDS and \
+            _daemon_started(project_root):
+        container = get_warm_container(
+            docker_client, image_id, project_root, platform_config_paths,
+        )
+    if container is None:
+        return docker_run(
+            docker_client, image_id, command, project_root,
+            environment_variables, platform_config_paths,
+        )
+    return exec_in_warm_container(
+        docker_client, container, command, project_root,
+        environment_variables,
+    )
+
+
+def _daemon_started(project_root):
+    # Only projects where `cdflow daemon start` has run pay for asking the
+    # docker daemon about warm containers.
+    return project_root in _read_json_cache(DAEMON_PROJECTS_CACHE)
+
+
+def _set_daemon_started(project_root, started):
+    projects = _read_json_cache(DAEMON_PROJECTS_CACHE)
+    if started:
+        projects[project_root] = time.time()
+    else:
+        projects.pop(project_root, None)
+    _write_json_cache(DAEMON_PROJECTS_CACHE, projects)
+
+
+def _list_warm_containers(docker_client, project_root):
+    return list(docker_client.containers.list(filters={'label': [
+        DAEMON_LABEL, '{}={}'.format(DAEMON_PROJECT_ROOT_LABEL, project_root),
+    ]}))
+
+
+def get_warm_container(
+    docker_client, image_id, project_root, platform_config_paths,
+):
+    warm_containers = _list_warm_containers(docker_client, project_root)
+    if not warm_containers:
+        # They have all exited after their idle timeout.
+        _set_daemon_started(project_root, False)
+        return None
+    local_image_id = docker_client.images.get(image_id).id
+    for container in warm_containers:
+        if container.labels.get(DAEMON_IMAGE_LABEL) == local_image_id and \
+                _has_mounts(container, platform_config_paths):
+            return container
+    # The project has opted in to daemon mode, so keep a warm container for
+    # this image too.
+    return start_warm_container(
+        docker_client, image_id, project_root, platform_config_paths,
+        int(warm_containers[0].labels[DAEMON_IDLE_TIMEOUT_LABEL]),
+    )
+
+
+def _mount_warm_plugin_cache(
+    docker_client, image_id, project_root, volumes, environment,
+):
+    # A warm container outlives the process that starts it, so it can't hold
+    # a slot's lock. It gets a cache of its own per project instead.
+    plugin_cache = get_plugin_cache(docker_client, image_id)
+    if plugin_cache:
+        _add_plugin_cache_volume('{}-daemon-{}'.format(
+            plugin_cache,
+            hashlib.sha256(project_root.encode('utf-8')).hexdigest()[:8],
+        ), volumes, environment)
+
+
+def _has_mounts(container, paths):
+    mounted = {mount['Destination'] for mount in container.attrs['Mounts']}
+    return set(paths) <= mounted
+
+
+def start_warm_container(
+    docker_client, image_id, project_root, platform_config_paths,
+    idle_timeout,
+):
+    image = docker_client.images.get(image_id)
+    logger.info('Starting warm container for {} in {}'.format(
+        image_id, project_root,
+    ))
+    volumes = _get_volumes(project_root, platform_config_paths)
+    # Commands exec'd in the container inherit its environment.
+    environment = {}
+    _mount_warm_plugin_cache(
+        docker_client, image_id, project_root, volumes, environment,
+    )
+    container = docker_client.containers.create(
+        image_id,
+        entrypoint=[
+            '/bin/sh', '-c', WARM_CONTAINER_SCRIPT, 'cdflow-daemon',
+            str(idle_timeout),
+        ],
+        command=[],
+        labels={
+            DAEMON_LABEL: '',
+            DAEMON_PROJECT_ROOT_LABEL: project_root,
+            DAEMON_IMAGE_LABEL: image.id,
+            DAEMON_IDLE_TIMEOUT_LABEL: str(idle_timeout),
+            DAEMON_ENTRYPOINT_LABEL: json.dumps(
+                image.attrs['Config']['Entrypoint'] or []
+            ),
+        },
+        detach=True,
+        environment=environment,
+        volumes=volumes,
+        working_dir=project_root,
+        auto_remove=True,
+    )
+    _put_docker_config_into_container(container, volumes)
+    container.start()
+    return container
+
+
+@timed_function('exec_in_warm_container')
+def exec_in_warm_container(
+    docker_client, container, command, project_root, environment_variables,
+):
+    logger.info('Running in warm container {}'.format(container.short_id))
+    entrypoint = json.loads(container.labels[DAEMON_ENTRYPOINT_LABEL])
+    exec_id = docker_client.api.exec_create(
+        container.id,
+        ['/bin/sh', '-c', WARM_EXEC_SCRIPT, 'cdflow'] + entrypoint + command,
+        environment=environment_variables,
+        workdir=project_root,
+    )['Id']
+    _print_output(docker_client.api.exec_start(
+        exec_id, stream=True, demux=True,
+    ))
+    return docker_client.api.exec_inspect(exec_id)['ExitCode'], ''
+
+
+def daemon(invocation):
+    action = _command(invocation.positional[1:])
+    if action == 'start':
+        return _start_daemon(invocation)
+    if action == 'stop':
+        return _stop_daemon()
+    print(
+        'usage: cdflow daemon start [--idle-timeout <seconds>] '
+        '[--platform-config <platform_config>]...\n'
+        '       cdflow daemon stop',
+        file=sys.stderr,
+    )
+    return 1
+
+
+def _start_daemon(invocation):
+    try:
+        idle_timeout = _get_idle_timeout(invocation.argv)
+    except ValueError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    docker_client = docker.from_env()
+    image_id = get_image_id(os.environ, get_manifest_data())
+    get_image_sha(docker_client, image_id)
+    platform_config_paths = []
+    if invocation.platform_config_paths:
+        platform_config_paths = get_platform_config_paths(invocation)
+    container = start_warm_container(
+        docker_client, image_id, os.getcwd(), platform_config_paths,
+        idle_timeout,
+    )
+    _set_daemon_started(os.getcwd(), True)
+    print('Started cdflow daemon {}'.format(container.short_id))
+    return 0
+
+
+def _get_idle_timeout(args):
+    return _parse_option(args, '--idle-timeout', DAEMON_IDLE_TIMEOUT, int)[0]
+
+
+def _stop_daemon():
+    docker_client = docker.from_env()
+    _set_daemon_started(os.getcwd(), False)
+    for container in _list_warm_containers(docker_client, os.getcwd()):
+        # The warm container is auto-removed once it has been killed.
+        container.kill()
+        print('Stopped cdflow daemon {}'.format(container.short_id))
+    return 0
+
+
 def get_environment():
     return {
         'AWS_ACCESS_KEY_ID': os.environ.get('AWS_ACCESS_KEY_ID'),
@@ -446,12 +1885,53 @@ def _command(argv):
         pass
 
 
-def get_manifest_data():
-    if not os.path.exists(MANIFEST_PATH):
+def get_manifest_data(manifest_path=MANIFEST_PATH):
+    try:
+        stat = os.stat(manifest_path)
+    except OSError:
         return {}
+    # Batch, daemon and prewarm runs read the same manifests repeatedly, so
+    # keep the parsed copy until the file changes.
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _manifests_lock:
+        cached = _manifests.get(manifest_path)
+    if not cached or cached[0] != version:
+        cached = (version, _parse_manifest(manifest_path))
+        with _manifests_lock:
+            _manifests[manifest_path] = cached
+    return dict(cached[1])
+
+
+def _parse_manifest(manifest_path):
+    with open(manifest_path) as config_file:
+        manifest = load_yaml(config_file.read()) or {}
+    if not isinstance(manifest, dict):
+        raise InvalidManifestError(
+            'error: {} must be a mapping'.format(manifest_path)
+        )
+    for key, types in MANIFEST_SCHEMA.items():
+        if key in manifest and not isinstance(manifest[key], types):
+            raise InvalidManifestError('error: {}: invalid {}: {!r}'.format(
+                manifest_path, key, manifest[key],
+            ))
+    if 'terraform-version' in manifest:
+        manifest['terraform-version'] = str(manifest['terraform-version'])
+    return manifest
+
 
-    with open(MANIFEST_PATH) as config_file:
-        return yaml.safe_load(config_file.read())
+def _require_manifest_keys(config, keys):
+    missing = [key for key in keys if key not in config]
+    if missing:
+        raise InvalidManifestError('error: {} is missing {}'.format(
+            MANIFEST_PATH, ', '.join(missing),
+        ))
+
+
+def load_yaml(text):
+    # The libyaml loader is several times faster than the pure Python one,
+    # but PyYAML can be built without it.
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(text, Loader=loader)
 
 
 def get_image_id(environment, config):
@@ -467,23 +1947,61 @@ def get_image_id(environment, config):
     return CDFLOW_IMAGE_ID
 
 
-def find_image_id_from_release(component_name, version, config):
-    session = Session()
-    s3_resource = session.resource('s3')
+def get_s3_resource():
+    # boto3 resources aren't thread-safe but clients are, so each thread gets
+    # its own resource, all sharing one client.
+    key = ('s3', threading.get_ident())
+    with _aws_resources_lock:
+        if key not in _aws_resources:
+            _aws_resources[key] = _create_s3_resource()
+        return _aws_resources[key]
+
+
+def _create_s3_resource():
+    from boto3.session import Session
+    from botocore.config import Config
+    if 'session' not in _aws_resources:
+        # One session and client per process, so repeated lookups reuse
+        # the resolved credentials and pooled connections.
+        _aws_resources['session'] = Session()
+        _aws_resources['s3_client'] = _aws_resources['session'].client(
+            's3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+        )
+    s3_resource = _aws_resources['session'].resource('s3')
+    s3_resource.meta.client = _aws_resources['s3_client']
+    return s3_resource
+
+
+def find_image_id_from_release(
+    component_name, version, config, component_flag_passed=False,
+):
+    s3_resource, release_bucket, kwargs = get_release_bucket(
+        component_name, config, component_flag_passed,
+    )
+    release_metadata = fetch_release_metadata(
+        s3_resource, release_bucket, component_name, version, **kwargs
+    )
+    return release_metadata['cdflow_image_digest']
+
+
+def get_release_bucket(component_name, config, component_flag_passed=False):
+    _require_manifest_keys(config, RELEASE_MANIFEST_KEYS)
+    s3_resource = get_s3_resource()
     account_scheme_url = config['account-scheme-url']
     bucket, key = parse_s3_url(account_scheme_url)
     team = config['team']
     account_scheme = fetch_account_scheme(
         s3_resource, bucket, key, team, component_name,
+        component_flag_passed=component_flag_passed,
     )
+    logger.debug('Account scheme cache: {} hit(s), {} miss(es)'.format(
+        account_scheme_cache_stats['hits'],
+        account_scheme_cache_stats['misses'],
+    ))
     kwargs = {}
     if not account_scheme.get('classic-metadata-handling'):
         kwargs['team_name'] = team
-    release_metadata = fetch_release_metadata(
-        s3_resource, account_scheme['release-bucket'], component_name, version,
-        **kwargs
-    )
-    return release_metadata['cdflow_image_digest']
+    return s3_resource, account_scheme['release-bucket'], kwargs
 
 
 def parse_s3_url(s3_url):
@@ -496,14 +2014,45 @@ def parse_s3_url(s3_url):
 
 
 def download_json_from_s3(s3_resource, bucket, key):
-    s3_object = s3_resource.Object(bucket, key)
-    with BytesIO() as f:
-        s3_object.download_fileobj(f)
-        f.seek(0)
-        return json.loads(f.read())
-
-
-def fetch_account_scheme(s3_resource, bucket, key, team, component):
+    from botocore.exceptions import ClientError
+    cache = _read_json_cache(ACCOUNT_SCHEME_CACHE)
+    cache_key = '{}/{}'.format(bucket, key)
+    cached = cache.get(cache_key)
+    try:
+        response = s3_resource.Object(bucket, key).get(
+            **_conditional_get_args(cached)
+        )
+    except ClientError as e:
+        if cached and _is_not_modified(e):
+            account_scheme_cache_stats['hits'] += 1
+            logger.debug('{} not modified, using cached copy'.format(
+                cache_key,
+            ))
+            return cached['data']
+        raise
+    account_scheme_cache_stats['misses'] += 1
+    data = json.loads(response['Body'].read())
+    cache[cache_key] = {'etag': response['ETag'], 'data': data}
+    _write_json_cache(ACCOUNT_SCHEME_CACHE, cache)
+    return data
+
+
+def _conditional_get_args(cached):
+    if cached:
+        return {'IfNoneMatch': cached['etag']}
+    return {}
+
+
+def _is_not_modified(client_error):
+    return client_error.response.get(
+        'ResponseMetadata', {}
+    ).get('HTTPStatusCode') == 304
+
+
+@timed_function('fetch_account_scheme')
+def fetch_account_scheme(
+    s3_resource, bucket, key, team, component, component_flag_passed=False,
+):
     account_scheme = download_json_from_s3(s3_resource, bucket, key)
     upgrade = account_scheme.get('upgrade-account-scheme')
 
@@ -517,8 +2066,6 @@ def fetch_account_scheme(s3_resource, bucket, key, team, component):
         )
         return team in team_whitelist or component in component_whitelist
 
-    component_flag_passed = _get_component_name_from_cli_args(sys.argv)
-
     if not component_flag_passed and upgrade and whitelisted(team, component):
         bucket, key = parse_s3_url(upgrade['new-url'])
         logger.debug(
@@ -531,47 +2078,649 @@ def fetch_account_scheme(s3_resource, bucket, key, team, component):
     return account_scheme
 
 
-def get_deploy_image_id(argv, config):
-    component_name = get_component_name(argv)
-    version = get_version(argv)
-    return find_image_id_from_release(
-        component_name, version, config
+@timed_function('get_deploy_image_id')
+def get_deploy_image_id(invocation, config):
+    component_name = get_component_name(invocation)
+    return find_release_image_id(
+        component_name, invocation.version, config,
+        component_flag_passed=invocation.component is not None,
     )
 
 
+def find_release_image_id(
+    component_name, version, config, component_flag_passed=False,
+):
+    image_id = lookup_release_index(config, component_name, version)
+    if image_id:
+        logger.debug('Found {} {} in the local release index: {}'.format(
+            component_name, version, image_id,
+        ))
+        return image_id
+    image_id = find_image_id_from_release(
+        component_name, version, config,
+        component_flag_passed=component_flag_passed,
+    )
+    record_release_index(config, component_name, version, image_id)
+    return image_id
+
+
+def _release_index_key(config, component_name, version):
+    return '{}/{}/{}'.format(config.get('team', ''), component_name, version)
+
+
+def lookup_release_index(config, component_name, version):
+    return _read_json_cache(RELEASE_INDEX_CACHE).get(
+        _release_index_key(config, component_name, version)
+    )
+
+
+def record_release_index(config, component_name, version, image_id):
+    record_release_index_entries(config, component_name, {version: image_id})
+
+
+def record_release_index_entries(config, component_name, image_ids):
+    # Batch deploys resolve releases from several threads, so serialise the
+    # read-modify-write of the index file.
+    with _release_index_lock:
+        index = _read_json_cache(RELEASE_INDEX_CACHE)
+        for version, image_id in image_ids.items():
+            index[_release_index_key(config, component_name, version)] = \
+                image_id
+        _write_json_cache(RELEASE_INDEX_CACHE, index)
+
+
+def _index_release(invocation, config, image_sha):
+    version = invocation.version
+    if not version or '@' not in image_sha:
+        return
+    try:
+        component_name = get_component_name(invocation)
+    except CDFlowWrapperException as e:
+        logger.debug('Not indexing release: {}'.format(e))
+        return
+    record_release_index(config, component_name, version, image_sha)
+
+
+def sync_index(invocation):
+    config = get_manifest_data()
+    try:
+        component_name = get_component_name(invocation)
+        versions, last = _parse_sync_index_args(invocation.positional[1:])
+    except (CDFlowWrapperException, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    s3_resource, release_bucket, kwargs = get_release_bucket(
+        component_name, config, invocation.component is not None,
+    )
+    if last:
+        versions += list_release_versions(
+            s3_resource, release_bucket, component_name, **kwargs
+        )[-last:]
+    with ThreadPoolExecutor(max_workers=SYNC_INDEX_CONCURRENCY) as executor:
+        results = list(executor.map(
+            lambda version: _fetch_release_image_id(
+                release_bucket, component_name, version, kwargs,
+            ),
+            versions,
+        ))
+    record_release_index_entries(config, component_name, {
+        version: image_id
+        for version, (image_id, _) in zip(versions, results) if image_id
+    })
+    return _report_sync_results(component_name, versions, results)
+
+
+def _parse_sync_index_args(args):
+    last = 0
+    versions = []
+    iterator = iter(args)
+    for arg in iterator:
+        if arg == '--last':
+            last = int(next(iterator, last))
+        elif arg.startswith('--last='):
+            last = int(arg.split('=', 1)[1])
+        else:
+            versions.append(arg)
+    if not versions and not last:
+        raise MissingReleaseVersionError()
+    return versions, last
+
+
+def _fetch_release_image_id(release_bucket, component_name, version, kwargs):
+    try:
+        # Looked up in the worker thread, which gets its own resource.
+        return fetch_release_metadata(
+            get_s3_resource(), release_bucket, component_name, version,
+            **kwargs
+        )['cdflow_image_digest'], None
+    except Exception as e:
+        logger.debug(e)
+        return None, 'could not resolve release: {}'.format(e)
+
+
+def _report_sync_results(component_name, versions, results):
+    for version, (image_id, error) in zip(versions, results):
+        if error:
+            print('{} {}: {}'.format(component_name, version, error),
+                  file=sys.stderr)
+        else:
+            print('{} {}: {}'.format(component_name, version, image_id))
+    return 1 if any(error for _, error in results) else 0
+
+
+def deploy_batch(invocation):
+    try:
+        manifest_path, concurrency, deploy_options = _parse_batch_args(
+            invocation.argv[1:],
+        )
+        items = _load_batch_manifest(manifest_path)
+    except (CDFlowWrapperException, IOError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    batch = BatchDeploy(
+        docker.from_env(), get_manifest_data(), concurrency, deploy_options,
+    )
+    return _report_batch_results(items, batch.run(items))
+
+
+class BatchDeploy(object):
+    """Drives a batch of deploys from one event loop.
+
+    Each item is resolved, pulled and run as soon as its own inputs are ready
+    rather than in lock-step phases. The Docker and S3 SDKs are blocking, so
+    their calls run on a bounded executor; the loop schedules them, shares
+    pulls of the same image, and forwards SIGINT/SIGTERM to the running
+    containers.
+    """
+
+    def __init__(self, docker_client, config, concurrency, deploy_options):
+        self.docker_client = docker_client
+        self.config = config
+        self.concurrency = concurrency
+        self.deploy_options = deploy_options
+        self.interrupted_by = None
+
+    def run(self, items):
+        return asyncio.run(self._run(items))
+
+    async def _run(self, items):
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.pulls = {}
+        self._handle_signals()
+        # Twice the run concurrency, so lookups and pulls for later items
+        # still get threads while the maximum number of deploys are running.
+        with ThreadPoolExecutor(max_workers=self.concurrency * 2) as executor:
+            self.executor = executor
+            return await asyncio.gather(*(
+                self._deploy(item) for item in items
+            ))
+
+    def _handle_signals(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            # Signal handlers can only be installed from the main thread.
+            with _suppress(NotImplementedError, RuntimeError, ValueError):
+                self.loop.add_signal_handler(signum, self._interrupt, signum)
+
+    def _interrupt(self, signum):
+        self.interrupted_by = signum
+        _signal_running_containers(signum)
+
+    def _call(self, function, *args):
+        return self.loop.run_in_executor(
+            self.executor, functools.partial(function, *args),
+        )
+
+    def _pull(self, image_id):
+        # Resolves to the reference to run, which is a mirror's when the
+        # image was pulled from one.
+        if image_id not in self.pulls:
+            self.pulls[image_id] = self._call(
+                ensure_image, self.docker_client, image_id,
+            )
+        return self.pulls[image_id]
+
+    async def _deploy(self, item):
+        image_id, error = await self._call(
+            _resolve_batch_item, item, self.config,
+        )
+        if error:
+            return 1, error
+        try:
+            local_image_id = await self._pull(image_id)
+        except Exception as e:
+            logger.debug(e)
+            return 1, 'could not pull {}: {}'.format(image_id, e)
+        async with self.semaphore:
+            if self.interrupted_by:
+                return 1, 'not started, interrupted by signal {}'.format(
+                    self.interrupted_by,
+                )
+            return await self._run_item(item, local_image_id)
+
+    async def _run_item(self, item, image_id):
+        try:
+            return await self._call(
+                _run_batch_item, self.docker_client, item, image_id,
+                self.deploy_options,
+            )
+        except Exception as e:
+            # One item failing, e.g. losing the connection to the docker
+            # daemon mid-run, is reported without aborting the rest.
+            logger.debug(e)
+            return 1, 'could not run deploy: {}'.format(e)
+
+
+def _parse_batch_args(args):
+    concurrency, positional = _parse_concurrency(args, BATCH_CONCURRENCY)
+    if not positional:
+        raise MissingBatchManifestError()
+    return positional[0], concurrency, positional[1:]
+
+
+def _parse_concurrency(args, concurrency):
+    concurrency, positional = _parse_option(
+        args, '--concurrency', concurrency, int,
+    )
+    if concurrency < 1:
+        raise ValueError('--concurrency must be at least 1')
+    return concurrency, positional
+
+
+def _parse_option(args, option, value, convert):
+    positional = []
+    iterator = iter(args)
+    for arg in iterator:
+        if arg == option:
+            value = convert(next(iterator, value))
+        elif arg.startswith(option + '='):
+            value = convert(arg.split('=', 1)[1])
+        else:
+            positional.append(arg)
+    return value, positional
+
+
+def _load_batch_manifest(manifest_path):
+    with open(manifest_path) as manifest_file:
+        items = load_yaml(manifest_file.read()) or []
+    if not isinstance(items, list):
+        raise InvalidBatchManifestError(
+            'error: the batch manifest must be a list of items'
+        )
+    for item in items:
+        if not isinstance(item, dict) or \
+                not {'component', 'environment', 'version'} <= set(item):
+            raise InvalidBatchManifestError(
+                'error: every batch item needs a component, environment '
+                'and version: {}'.format(item)
+            )
+    return items
+
+
+def _resolve_batch_item(item, config):
+    try:
+        return find_release_image_id(
+            item['component'], str(item['version']), config,
+            component_flag_passed=True,
+        ), None
+    except Exception as e:
+        logger.debug(e)
+        return None, 'could not resolve release: {}'.format(e)
+
+
+def _run_batch_item(docker_client, item, image_id, deploy_options):
+    argv = [
+        'deploy', item['environment'], str(item['version']),
+        '--component', item['component'],
+    ] + deploy_options
+    return docker_run(
+        docker_client, image_id, argv, os.getcwd(), get_environment(),
+        # Deploys run side by side, so each line says which one it is from.
+        output_prefix='{} {}: '.format(item['component'], item['environment']),
+    )
+
+
+def _report_batch_results(items, results):
+    for item, (exit_status, output) in zip(items, results):
+        print('{} {} {}: exit status {}{}'.format(
+            item['component'], item['environment'], item['version'],
+            exit_status, ' ({})'.format(output) if exit_status else '',
+        ))
+    return 1 if any(exit_status for exit_status, _ in results) else 0
+
+
+def prewarm(invocation):
+    try:
+        concurrency, roots = _parse_concurrency(
+            invocation.positional[1:], PREWARM_CONCURRENCY,
+        )
+    except ValueError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    image_ids = find_manifest_image_ids(roots or ['.'])
+    if not image_ids:
+        print('No {} manifests found'.format(MANIFEST_PATH))
+        return 0
+    docker_client = docker.from_env()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(_prewarm_image, docker_client, image_id)
+            for image_id in image_ids
+        ]
+        results = []
+        for count, future in enumerate(as_completed(futures), 1):
+            pulled, message = future.result()
+            print('[{}/{}] {}'.format(count, len(futures), message))
+            results.append(pulled)
+    return 0 if all(results) else 1
+
+
+def find_manifest_image_ids(roots):
+    image_ids = set()
+    for manifest_path in _find_manifests(roots):
+        try:
+            config = get_manifest_data(manifest_path) or {}
+        except (IOError, yaml.YAMLError, InvalidManifestError) as e:
+            logger.info('Skipping {}: {}'.format(manifest_path, e))
+            continue
+        image_ids.add(get_image_id(os.environ, config))
+    return sorted(image_ids)
+
+
+def _find_manifests(roots):
+    for root in roots:
+        for directory, subdirectories, files in os.walk(root):
+            # Hidden directories include .git and .terraform, which can be
+            # large and never hold a project's manifest.
+            subdirectories[:] = [
+                subdirectory for subdirectory in subdirectories
+                if not subdirectory.startswith('.')
+                and subdirectory not in PREWARM_SKIPPED_DIRECTORIES
+            ]
+            if MANIFEST_PATH in files:
+                yield '{}/{}'.format(directory, MANIFEST_PATH)
+
+
+def _prewarm_image(docker_client, image_id):
+    start = time.time()
+    try:
+        image_sha = get_image_sha(docker_client, image_id)
+    except Exception as e:
+        logger.debug(e)
+        return False, 'could not pull {}: {}'.format(image_id, e)
+    # Counts as a use, so that `cdflow gc` doesn't remove what was just
+    # pulled ahead of the deploys that need it.
+    record_image_usage(image_id)
+    return True, 'pulled {} ({}) in {:.1f}s'.format(
+        image_id, image_sha, time.time() - start,
+    )
+
+
+def gc_images(invocation):
+    try:
+        options = _parse_gc_args(invocation.positional[1:])
+    except ValueError as e:
+        print('error: {}'.format(e), file=sys.stderr)
+        return 1
+    repositories = [CDFLOW_IMAGE_NAME] + _get_mirror_image_ids(
+        CDFLOW_IMAGE_NAME, get_registry_mirrors(),
+    )
+    dry_run = options['dry_run']
+    docker_client = docker.from_env()
+    cutoff = time.time() - options['max_age'] * 24 * 60 * 60
+    keep, remove = select_gc_images(
+        list_cdflow_images(docker_client, repositories),
+        _read_json_cache(IMAGE_USAGE_CACHE), cutoff,
+        options['max_size'] * 1e9,
+    )
+    removed = [
+        _remove_image(docker_client, image, repositories, dry_run)
+        for image in remove
+    ]
+    if not dry_run:
+        _prune_image_usage(cutoff)
+    _report_gc_results(keep, remove, removed, dry_run)
+    pruned = prune_plugin_caches(
+        docker_client, keep, options['max_plugin_cache_size'] * 1e9, dry_run,
+    )
+    return 0 if all(removed + pruned) else 1
+
+
+def _parse_gc_args(args):
+    max_age, args = _parse_option(args, '--max-age', GC_MAX_AGE_DAYS, float)
+    max_size, args = _parse_option(args, '--max-size', GC_MAX_SIZE_GB, float)
+    max_plugin_cache_size, args = _parse_option(
+        args, '--max-plugin-cache-size', GC_MAX_PLUGIN_CACHE_SIZE_GB, float,
+    )
+    return {
+        'max_age': max_age,
+        'max_size': max_size,
+        'max_plugin_cache_size': max_plugin_cache_size,
+        'dry_run': '--dry-run' in args,
+    }
+
+
+def list_cdflow_images(docker_client, repositories):
+    images = {}
+    for repository in repositories:
+        for image in docker_client.images.list(name=repository):
+            images[image.id] = image
+    return list(images.values())
+
+
+def select_gc_images(images, usage, cutoff, max_size):
+    # Most recently used first, so whatever is past the cutoff or over the
+    # size budget is the least recently used.
+    images = sorted(
+        images, key=lambda image: _get_last_used(image, usage), reverse=True,
+    )
+    size = 0
+    for index, image in enumerate(images):
+        size += image.attrs['Size']
+        if _get_last_used(image, usage) < cutoff or size > max_size:
+            return images[:index], images[index:]
+    return images, []
+
+
+def _get_image_references(image):
+    return (image.attrs.get('RepoTags') or []) + \
+        (image.attrs.get('RepoDigests') or [])
+
+
+def _get_last_used(image, usage):
+    return max(
+        (usage.get(reference, 0) for reference in
+         _get_image_references(image)),
+        default=0,
+    )
+
+
+def _remove_image(docker_client, image, repositories, dry_run):
+    from docker.errors import APIError
+    from docker.utils import parse_repository_tag
+    # Only our references are removed, so an image someone has tagged
+    # under another name is kept under that name.
+    references = [
+        reference for reference in _get_image_references(image)
+        if parse_repository_tag(reference)[0] in repositories
+    ]
+    try:
+        if not dry_run:
+            for reference in references:
+                docker_client.images.remove(reference)
+    except APIError as e:
+        # Most likely a container still uses the image.
+        logger.debug(e)
+        print('could not remove {}: {}'.format(', '.join(references), e))
+        return False
+    print('{} {} ({:.1f} MB)'.format(
+        'would remove' if dry_run else 'removed', ', '.join(references),
+        image.attrs['Size'] / 1e6,
+    ))
+    return True
+
+
+def prune_plugin_caches(docker_client, keep, max_size, dry_run):
+    volumes = docker_client.volumes.list(
+        filters={'name': TERRAFORM_PLUGIN_CACHE_VOLUME_PREFIX},
+    )
+    if not volumes:
+        return []
+    sizes = {
+        volume['Name']: max(volume.get('UsageData', {}).get('Size', 0), 0)
+        for volume in docker_client.df().get('Volumes') or []
+    }
+    remove = select_plugin_caches(
+        [volume.name for volume in volumes], keep, sizes, max_size,
+    )
+    return [
+        _remove_plugin_cache(volume, sizes.get(volume.name, 0), dry_run)
+        for volume in volumes if volume.name in remove
+    ]
+
+
+def select_plugin_caches(volume_names, keep, sizes, max_size):
+    # Caches of removed images go, then those of the least recently used
+    # images until the rest fit in the budget.
+    kept = set()
+    size = 0
+    for image in keep:
+        keys = {
+            _short_digest(digest) for digest in _get_image_digests(image)
+        }
+        names = {
+            name for name in volume_names
+            if _get_volume_plugin_cache_key(name) in keys
+        }
+        size += sum(sizes.get(name, 0) for name in names)
+        if size > max_size:
+            break
+        kept |= names
+    return [name for name in volume_names if name not in kept]
+
+
+def _get_volume_plugin_cache_key(volume_name):
+    # Strips the prefix and any slot or daemon suffix.
+    return volume_name[len(TERRAFORM_PLUGIN_CACHE_VOLUME_PREFIX):].split(
+        '-',
+    )[0]
+
+
+def _remove_plugin_cache(volume, size, dry_run):
+    from docker.errors import APIError
+    try:
+        if not dry_run:
+            volume.remove()
+    except APIError as e:
+        # Most likely a warm container still has it mounted.
+        logger.debug(e)
+        print('could not remove {}: {}'.format(volume.name, e))
+        return False
+    print('{} {} ({:.1f} MB)'.format(
+        'would remove' if dry_run else 'removed', volume.name, size / 1e6,
+    ))
+    return True
+
+
+def _prune_image_usage(cutoff):
+    with _image_usage_lock:
+        usage = _read_json_cache(IMAGE_USAGE_CACHE)
+        _write_json_cache(IMAGE_USAGE_CACHE, {
+            image_id: last_used for image_id, last_used in usage.items()
+            if last_used >= cutoff
+        })
+
+
+def _report_gc_results(keep, remove, removed, dry_run):
+    reclaimed = sum(
+        image.attrs['Size'] for image, ok in zip(remove, removed) if ok
+    )
+    print('{} {} of {} images ({:.1f} MB), kept {} ({:.1f} MB)'.format(
+        'Would remove' if dry_run else 'Removed', sum(removed), len(remove),
+        reclaimed / 1e6, len(keep),
+        sum(image.attrs['Size'] for image in keep) / 1e6,
+    ))
+
+
+WRAPPER_COMMANDS = {
+    'clear-image-cache': clear_image_cache,
+    'deploy-batch': deploy_batch,
+    'daemon': daemon,
+    'sync-index': sync_index,
+    'prewarm': prewarm,
+    'gc': gc_images,
+}
+
+
 def main(argv):
-    toggle_verbose_logging(argv)
+    invocation = parse_invocation(argv)
+    toggle_verbose_logging(invocation)
+    start_trace()
+    with timed('main', span_id=_trace['root_span_id']):
+        exit_status = _dispatch(invocation)
+    report_timings(invocation, exit_status)
+    export_trace(invocation, exit_status)
+    return exit_status
+
+
+def _dispatch(invocation):
+    try:
+        if invocation.command in WRAPPER_COMMANDS:
+            return WRAPPER_COMMANDS[invocation.command](invocation)
+        return run_in_container(invocation)
+    except CDFlowWrapperException as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+
+def run_in_container(invocation):
     docker_client = docker.from_env()
-    environment_variables = get_environment()
     config = get_manifest_data()
-    image_id = get_image_id(os.environ, config)
-    command = _command(argv)
 
     kwargs = {
         'docker_client': docker_client,
-        'image_id': image_id,
-        'command': argv,
+        'image_id': get_image_id(os.environ, config),
+        'command': list(invocation.argv),
         'project_root': os.getcwd(),
-        'environment_variables': environment_variables,
+        'environment_variables': get_environment(),
     }
 
     try:
-        image_sha = get_image_sha(docker_client, image_id)
-        if command == 'release':
-            kwargs['platform_config_paths'] = get_platform_config_paths(argv)
-            environment_variables['CDFLOW_IMAGE_DIGEST'] = image_sha
-        elif command == 'deploy':
-            kwargs['image_id'] = get_deploy_image_id(argv, config)
+        image_sha = _prepare_image(invocation, config, kwargs)
     except CDFlowWrapperException as e:
         print(str(e), file=sys.stderr)
         return 1
 
-    exit_status, output = docker_run(**kwargs)
+    set_trace_attribute('cdflow.image_digest', image_sha)
+    if tracing_enabled():
+        # Lets the cdflow-commands image attach its spans to this trace.
+        kwargs['environment_variables']['TRACEPARENT'] = get_traceparent()
+
+    exit_status, output = run_command(**kwargs)
+    if exit_status == 0 and invocation.command == 'release':
+        _index_release(invocation, config, image_sha)
 
     print(output, file=sys.stderr if exit_status else sys.stdout)
     return exit_status
 
 
+def _prepare_image(invocation, config, kwargs):
+    docker_client = kwargs['docker_client']
+    command = invocation.command
+    if command == 'deploy':
+        # Deploy runs the image pinned by the release, so resolve that first
+        # and only pull the image that will actually run.
+        image_id = get_deploy_image_id(invocation, config)
+        kwargs['image_id'] = ensure_image(docker_client, image_id)
+        return image_id
+    image_sha = get_image_sha(docker_client, kwargs['image_id'])
+    if command == 'release':
+        kwargs['platform_config_paths'] = \
+            get_platform_config_paths(invocation)
+        kwargs['environment_variables']['CDFLOW_IMAGE_DIGEST'] = image_sha
+    return image_sha
+
+
 def run():
     sys.exit(main(sys.argv[1:]))
 
@@ -0,0 +1,68 @@
+"""Throughput of _print_output against a synthetic high-volume log container.
+
+Run with:
+
+    python -m test.benchmark_print_logs [lines]
+
+Compares the buffered byte relay with the previous decode-and-print-per-chunk
+loop, writing to /dev/null.
+"""
+from __future__ import print_function
+
+import io
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+from cdflow import _print_output
+
+LINE = (
+    '  # aws_ecs_service.service will be updated in-place ✔ '
+    '~ task_definition = "arn:aws:ecs:eu-west-1:123456789012:task/x:41"\n'
+).encode('utf-8')
+
+
+def synthetic_container(lines):
+    container = MagicMock()
+    container.attach.side_effect = \
+        lambda **kwargs: ((LINE, None) for _ in range(lines))
+    return container
+
+
+def print_per_chunk(container):
+    for stdout_chunk, _ in container.attach(
+        stdout=True, stderr=True, stream=True, logs=True, demux=True,
+    ):
+        print(stdout_chunk.decode('utf-8'), end='')
+
+
+def relay(container):
+    _print_output(container.attach(
+        stdout=True, stderr=True, stream=True, logs=True, demux=True,
+    ))
+
+
+def measure(print_logs, lines):
+    with open('/dev/null', 'wb') as devnull:
+        stdout = io.TextIOWrapper(io.BufferedWriter(devnull))
+        with patch('sys.stdout', stdout):
+            start = time.time()
+            print_logs(synthetic_container(lines))
+            stdout.flush()
+            return time.time() - start
+
+
+def main(lines):
+    megabytes = lines * len(LINE) / 1024.0 / 1024.0
+    for name, print_logs in (
+        ('print per chunk', print_per_chunk),
+        ('buffered relay', relay),
+    ):
+        elapsed = measure(print_logs, lines)
+        print('{:<16} {:>8.3f}s {:>10.1f} MB/s {:>12.0f} lines/s'.format(
+            name, elapsed, megabytes / elapsed, lines / elapsed,
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -0,0 +1,51 @@
+import os
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+
+from docker.models.containers import Container
+from docker.models.images import Image
+
+from cdflow import main
+
+
+def make_image(image_id, size=0, tags=(), digests=()):
+    image = MagicMock(spec=Image)
+    image.id = image_id
+    image.short_id = image_id[:10]
+    image.attrs = {
+        'Size': size, 'RepoTags': list(tags), 'RepoDigests': list(digests),
+    }
+    return image
+
+
+def make_docker_client(repo_digest, exit_code=0):
+    # The local image is up to date and every container exits with
+    # exit_code.
+    docker_client = MagicMock()
+    docker_client.images.get.return_value = make_image(
+        'sha256:local', digests=[repo_digest],
+    )
+    docker_client.images.get_registry_data.return_value.id = 'sha256:remote'
+    container = MagicMock(spec=Container)
+    container.wait.return_value = {'StatusCode': exit_code}
+    docker_client.containers.create.return_value = container
+    return docker_client
+
+
+def run_main(argv, docker_client, config={}, find_image=None, environment={}):
+    # Returns the exit status along with the mocked print and release lookup.
+    # The cache goes to a temporary directory unless environment names one.
+    with patch('cdflow.docker') as docker, \
+            patch('cdflow.print') as print_, \
+            patch('cdflow.get_manifest_data', return_value=config), \
+            patch('cdflow.find_image_id_from_release') as find_image_id, \
+            patch('cdflow.abspath', side_effect=lambda path: '/' + path), \
+            patch.dict(os.environ, {'CDFLOW_CACHE_DIR': mkdtemp()}), \
+            patch.dict(os.environ, environment):
+        docker.from_env.return_value = docker_client
+        if find_image:
+            find_image_id.side_effect = \
+                lambda component, version, config, **kwargs: \
+                find_image(component, version)
+        exit_status = main(argv)
+    return exit_status, print_, find_image_id
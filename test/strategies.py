@@ -5,6 +5,12 @@ from hypothesis.strategies import composite, lists, text
 
 VALID_ALPHABET = ascii_letters + digits + '-._'
 
+# Arguments the wrapper treats as options, which can't be positional values.
+OPTION_TOKENS = (
+    '-c', '--component', '--platform-config', '-p', '--plan-only', '-v',
+    '--verbose', '--timings',
+)
+
 
 @composite
 def s3_bucket_and_key(draw):
@@ -0,0 +1,254 @@
+import os
+import signal
+import threading
+import unittest
+from io import BytesIO, TextIOWrapper
+from tempfile import NamedTemporaryFile
+from unittest.mock import ANY, MagicMock, patch
+
+import yaml
+from requests.exceptions import ConnectionError
+from docker.client import DockerClient
+from docker.models.containers import Container
+
+from cdflow import TERRAFORM_PLUGIN_CACHE_PATH, main
+from test.helpers import run_main
+
+
+class TestDeployBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            'account-scheme-url': 's3://bucket/key',
+            'team': 'a-team',
+        }
+        self.items = [
+            {'component': 'foo', 'environment': 'aslive', 'version': 42},
+            {'component': 'foo', 'environment': 'live', 'version': 42},
+            {'component': 'bar', 'environment': 'aslive', 'version': '7'},
+        ]
+        self.digests = {
+            'foo': 'mergermarket/cdflow-commands@sha256:1',
+            'bar': 'mergermarket/cdflow-commands@sha256:2',
+        }
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.container = MagicMock(spec=Container)
+        self.container.wait.return_value = {'StatusCode': 0}
+        self.docker_client.containers.create.return_value = self.container
+
+    def write_manifest(self, items):
+        manifest = NamedTemporaryFile(mode='w', suffix='.yml', delete=False)
+        manifest.write(yaml.dump(items))
+        manifest.close()
+        return manifest.name
+
+    def run_batch(self, argv):
+        exit_status, print_, self.find_image = run_main(
+            argv, self.docker_client, self.config,
+            find_image=lambda component, version: self.digests[component],
+        )
+        self.printed = [call[0][0] for call in print_.call_args_list]
+        return exit_status
+
+    def test_deploys_every_item(self):
+        manifest = self.write_manifest(self.items)
+
+        exit_status = self.run_batch(['deploy-batch', manifest, '-p'])
+
+        assert exit_status == 0
+        self.find_image.assert_any_call(
+            'foo', '42', self.config, component_flag_passed=True,
+        )
+        self.find_image.assert_any_call(
+            'bar', '7', self.config, component_flag_passed=True,
+        )
+        self.docker_client.containers.create.assert_any_call(
+            self.digests['foo'],
+            command=['deploy', 'live', '42', '--component', 'foo', '-p'],
+            environment=ANY,
+            detach=True,
+            volumes=ANY,
+            working_dir=ANY,
+        )
+        assert self.docker_client.containers.create.call_count == 3
+        assert 'bar aslive 7: exit status 0' in self.printed
+
+    def test_image_pulls_are_deduplicated(self):
+        manifest = self.write_manifest(self.items)
+
+        self.run_batch(['deploy-batch', manifest, '--concurrency', '2'])
+
+        fetched = sorted(
+            call[0][0] for call in self.docker_client.images.get.call_args_list
+        )
+        assert fetched == sorted(self.digests.values())
+
+    def test_failed_resolution_is_reported_per_item(self):
+        self.digests = {'foo': self.digests['foo']}
+        manifest = self.write_manifest(self.items)
+
+        exit_status = self.run_batch(['deploy-batch', manifest])
+
+        assert exit_status == 1
+        assert self.docker_client.containers.create.call_count == 2
+        assert 'foo live 42: exit status 0' in self.printed
+        assert any(
+            line.startswith('bar aslive 7: exit status 1')
+            for line in self.printed
+        )
+
+    def test_items_do_not_wait_for_other_resolutions(self):
+        started = threading.Event()
+        self.docker_client.containers.create.side_effect = \
+            lambda *args, **kwargs: started.set() or self.container
+        resolve = self.digests.__getitem__
+
+        def find_image_id(component):
+            if component == 'bar':
+                # Only resolves once a foo deploy has started.
+                assert started.wait(5)
+            return resolve(component)
+
+        self.digests = MagicMock()
+        self.digests.__getitem__.side_effect = find_image_id
+        manifest = self.write_manifest(self.items)
+
+        assert self.run_batch(['deploy-batch', manifest]) == 0
+        assert self.docker_client.containers.create.call_count == 3
+
+    def test_concurrent_deploys_get_their_own_plugin_cache(self):
+        # Every item waits for the others, so all three run at once.
+        barrier = threading.Barrier(3, timeout=5)
+
+        def wait():
+            barrier.wait()
+            return {'StatusCode': 0}
+
+        self.container.wait.side_effect = wait
+        manifest = self.write_manifest(self.items)
+
+        assert self.run_batch(['deploy-batch', manifest]) == 0
+
+        plugin_caches = [
+            name
+            for call in self.docker_client.containers.create.call_args_list
+            for name, volume in call[1]['volumes'].items()
+            if volume['bind'] == TERRAFORM_PLUGIN_CACHE_PATH
+        ]
+        assert len(plugin_caches) == 3
+        assert len(set(plugin_caches)) == 3
+
+    def test_failed_pull_is_reported_per_item(self):
+        self.docker_client.images.get.side_effect = \
+            lambda image_id: self.fail_pull(image_id)
+        manifest = self.write_manifest(self.items)
+
+        exit_status = self.run_batch(['deploy-batch', manifest])
+
+        assert exit_status == 1
+        assert self.docker_client.containers.create.call_count == 2
+        assert any(
+            line.startswith('bar aslive 7: exit status 1 (could not pull')
+            for line in self.printed
+        )
+
+    def test_output_is_prefixed_per_item(self):
+        self.container.attach.side_effect = \
+            lambda **kwargs: iter([(b'Plan: 1 to add\n', None)])
+        stdout = TextIOWrapper(BytesIO())
+        manifest = self.write_manifest(self.items)
+
+        with patch('sys.stdout', stdout):
+            self.run_batch(['deploy-batch', manifest])
+
+        assert sorted(stdout.buffer.getvalue().splitlines()) == [
+            b'bar aslive: Plan: 1 to add',
+            b'foo aslive: Plan: 1 to add',
+            b'foo live: Plan: 1 to add',
+        ]
+
+    def test_failed_run_is_reported_per_item(self):
+        def create(image_id, **kwargs):
+            if image_id == self.digests['bar']:
+                raise ConnectionError('connection aborted')
+            return self.container
+
+        self.docker_client.containers.create.side_effect = create
+        manifest = self.write_manifest(self.items)
+
+        exit_status = self.run_batch(['deploy-batch', manifest])
+
+        assert exit_status == 1
+        assert 'foo live 42: exit status 0' in self.printed
+        assert 'bar aslive 7: exit status 1 (could not run deploy: ' \
+            'connection aborted)' in self.printed
+
+    def fail_pull(self, image_id):
+        if image_id == self.digests['bar']:
+            raise RuntimeError('registry unavailable')
+
+    def test_signal_is_forwarded_to_running_containers(self):
+        killed = threading.Event()
+        self.container.kill.side_effect = lambda **kwargs: killed.set()
+
+        def wait():
+            os.kill(os.getpid(), signal.SIGTERM)
+            assert killed.wait(5)
+            return {'StatusCode': 143}
+
+        self.container.wait.side_effect = wait
+        manifest = self.write_manifest(self.items)
+
+        exit_status = self.run_batch(
+            ['deploy-batch', manifest, '--concurrency', '1'],
+        )
+
+        assert exit_status == 1
+        self.container.kill.assert_called_once_with(signal=signal.SIGTERM)
+        assert self.docker_client.containers.create.call_count == 1
+        assert sum(
+            'not started, interrupted by signal' in line
+            for line in self.printed
+        ) == 2
+
+    def test_invalid_manifest(self):
+        manifest = self.write_manifest([{'component': 'foo'}])
+
+        with patch('cdflow.print') as print_:
+            exit_status = main(['deploy-batch', manifest])
+
+        assert exit_status == 1
+        assert 'every batch item needs' in print_.call_args[0][0]
+
+    def test_manifest_items_must_be_mappings(self):
+        for items in ([5], {'component': 'foo'}):
+            manifest = self.write_manifest(items)
+
+            with patch('cdflow.print') as print_:
+                exit_status = main(['deploy-batch', manifest])
+
+            assert exit_status == 1
+            assert print_.call_args[0][0].startswith('error: ')
+
+    def test_invalid_concurrency(self):
+        manifest = self.write_manifest(self.items)
+
+        with patch('cdflow.print') as print_:
+            exit_status = main(
+                ['deploy-batch', manifest, '--concurrency', '-1'],
+            )
+
+        assert exit_status == 1
+        print_.assert_called_once_with(
+            '--concurrency must be at least 1', file=ANY,
+        )
+        self.docker_client.containers.create.assert_not_called()
+
+    def test_missing_manifest_argument(self):
+        with patch('cdflow.print') as print_:
+            exit_status = main(['deploy-batch'])
+
+        assert exit_status == 1
+        print_.assert_called_once_with(
+            'error: deploy-batch requires a manifest path', file=ANY,
+        )
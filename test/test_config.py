@@ -1,11 +1,17 @@
+import os
 import unittest
-from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
 from string import printable
+from tempfile import mkdtemp
 import json
 
 from cdflow import (
-    CDFLOW_IMAGE_ID, InvalidURLError, fetch_account_scheme, get_image_id,
-    parse_s3_url
+    CDFLOW_IMAGE_ID, InvalidManifestError, InvalidURLError, _aws_resources,
+    account_scheme_cache_stats, download_json_from_s3, fetch_account_scheme,
+    get_image_id, get_manifest_data, get_release_bucket, get_s3_resource,
+    parse_s3_url,
+    S3_MAX_POOL_CONNECTIONS,
 )
 import boto3
 from moto import mock_s3
@@ -51,6 +57,82 @@ class TestGetReleaseCommandsImage(unittest.TestCase):
             f'mergermarket/cdflow-commands:terraform{terraform_version}'
 
 
+class TestGetManifestData(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest_path = '{}/cdflow.yml'.format(mkdtemp())
+
+    def write_manifest(self, content):
+        with open(self.manifest_path, 'w') as manifest:
+            manifest.write(content)
+
+    def test_missing_manifest(self):
+        assert get_manifest_data(self.manifest_path) == {}
+
+    def test_empty_manifest(self):
+        self.write_manifest('')
+
+        assert get_manifest_data(self.manifest_path) == {}
+
+    def test_parsed_manifest_is_cached_until_it_changes(self):
+        self.write_manifest('team: a-team\n')
+
+        with patch('cdflow.yaml') as yaml:
+            yaml.load.return_value = {'team': 'a-team'}
+            first = get_manifest_data(self.manifest_path)
+            first['team'] = 'mutated'
+            second = get_manifest_data(self.manifest_path)
+            self.write_manifest('team: another-team\n')
+            third = get_manifest_data(self.manifest_path)
+
+        assert second == {'team': 'a-team'}
+        assert third == {'team': 'a-team'}
+        assert yaml.load.call_count == 2
+
+    def test_terraform_version_is_normalised(self):
+        self.write_manifest('terraform-version: 1\n')
+
+        config = get_manifest_data(self.manifest_path)
+
+        assert config == {'terraform-version': '1'}
+        assert get_image_id({}, config) == \
+            'mergermarket/cdflow-commands:terraform1'
+
+    def test_invalid_values_are_rejected(self):
+        self.write_manifest('team: [a, b]\n')
+
+        self.assertRaisesRegex(
+            InvalidManifestError, 'invalid team',
+            get_manifest_data, self.manifest_path,
+        )
+
+    def test_manifest_must_be_a_mapping(self):
+        self.write_manifest('- team\n')
+
+        self.assertRaisesRegex(
+            InvalidManifestError, 'must be a mapping',
+            get_manifest_data, self.manifest_path,
+        )
+
+
+class TestGetReleaseBucket(unittest.TestCase):
+
+    @patch('cdflow.get_s3_resource')
+    def test_manifest_must_name_account_scheme_and_team(
+        self, get_s3_resource,
+    ):
+        self.assertRaisesRegex(
+            InvalidManifestError, 'missing account-scheme-url, team',
+            get_release_bucket, 'a-component', {},
+        )
+        self.assertRaisesRegex(
+            InvalidManifestError, 'missing team$',
+            get_release_bucket, 'a-component',
+            {'account-scheme-url': 's3://bucket/key'},
+        )
+        get_s3_resource.assert_not_called()
+
+
 class TestParseS3Url(unittest.TestCase):
 
     @given(s3_bucket_and_key())
@@ -79,13 +161,54 @@ class TestParseS3Url(unittest.TestCase):
         )
 
 
+class TestGetS3Resource(unittest.TestCase):
+
+    def setUp(self):
+        _aws_resources.clear()
+        self.addCleanup(_aws_resources.clear)
+
+    def get_s3_resources(self):
+        with patch('boto3.session.Session') as Session:
+            Session.return_value.resource.side_effect = \
+                lambda *args, **kwargs: MagicMock()
+            resources = [get_s3_resource(), get_s3_resource()]
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                resources.append(executor.submit(get_s3_resource).result())
+        self.Session = Session
+        return resources
+
+    def test_session_and_client_are_created_once(self):
+        first, second, _ = self.get_s3_resources()
+
+        assert first is second
+        self.Session.assert_called_once_with()
+        self.Session.return_value.client.assert_called_once()
+
+    def test_threads_get_their_own_resource_on_one_client(self):
+        first, _, other_thread = self.get_s3_resources()
+
+        assert first is not other_thread
+        client = self.Session.return_value.client.return_value
+        assert first.meta.client is client
+        assert other_thread.meta.client is client
+
+    def test_connection_pool_is_configured(self):
+        self.get_s3_resources()
+
+        config = self.Session.return_value.client.call_args[1]['config']
+        assert config.max_pool_connections == S3_MAX_POOL_CONNECTIONS
+
+
 class TestFetchAccountScheme(unittest.TestCase):
 
     def setUp(self):
         self.mock_s3 = mock_s3()
         self.mock_s3.start()
+        self.environ = patch.dict(os.environ, {'CDFLOW_CACHE_DIR': mkdtemp()})
+        self.environ.start()
 
     def tearDown(self):
+        self.environ.stop()
         self.mock_s3.stop()
 
     @given(fixed_dictionaries({
@@ -323,18 +446,13 @@ class TestFetchAccountScheme(unittest.TestCase):
 
         assert account_scheme['release-bucket'] == new_bucket
 
-    @patch('cdflow.sys')
-    def test_does_not_forward_account_scheme_if_component_flag_passed(
-        self, mock_sys,
-    ):
+    def test_does_not_forward_account_scheme_if_component_flag_passed(self):
         s3_client = boto3.client('s3')
         s3_resource = boto3.resource('s3')
 
         team = 'a-team'
         component = 'a-component'
 
-        mock_sys.argv = ['--component', component]
-
         old_bucket = 'releases'
         old_key = 'account-scheme.json'
 
@@ -377,6 +495,7 @@ class TestFetchAccountScheme(unittest.TestCase):
 
         account_scheme = fetch_account_scheme(
             s3_resource, old_bucket, old_key, team, component,
+            component_flag_passed=True,
         )
 
         expected_keys = sorted(old_account_scheme_content.keys())
@@ -384,3 +503,50 @@ class TestFetchAccountScheme(unittest.TestCase):
         assert list(sorted(account_scheme.keys())) == expected_keys
 
         assert account_scheme['release-bucket'] == old_bucket
+
+
+class TestAccountSchemeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_s3 = mock_s3()
+        self.mock_s3.start()
+        self.environ = patch.dict(os.environ, {'CDFLOW_CACHE_DIR': mkdtemp()})
+        self.environ.start()
+
+        boto3.client('s3').create_bucket(Bucket='releases')
+        self.s3_resource = boto3.resource('s3')
+        self.s3_object = self.s3_resource.Object(
+            'releases', 'account-scheme.json',
+        )
+        self.s3_object.put(Body=b'{"release-bucket": "a-bucket"}')
+        account_scheme_cache_stats.clear()
+
+    def tearDown(self):
+        self.environ.stop()
+        self.mock_s3.stop()
+
+    def test_unchanged_account_scheme_is_served_from_cache(self):
+        download_json_from_s3(
+            self.s3_resource, 'releases', 'account-scheme.json',
+        )
+        account_scheme = download_json_from_s3(
+            self.s3_resource, 'releases', 'account-scheme.json',
+        )
+
+        assert account_scheme == {'release-bucket': 'a-bucket'}
+        assert account_scheme_cache_stats['misses'] == 1
+        assert account_scheme_cache_stats['hits'] == 1
+
+    def test_changed_account_scheme_is_downloaded_again(self):
+        download_json_from_s3(
+            self.s3_resource, 'releases', 'account-scheme.json',
+        )
+        self.s3_object.put(Body=b'{"release-bucket": "another-bucket"}')
+
+        account_scheme = download_json_from_s3(
+            self.s3_resource, 'releases', 'account-scheme.json',
+        )
+
+        assert account_scheme == {'release-bucket': 'another-bucket'}
+        assert account_scheme_cache_stats['misses'] == 2
+        assert account_scheme_cache_stats['hits'] == 0
@@ -0,0 +1,235 @@
+import json
+import os
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import ANY, MagicMock, patch
+
+from docker.client import DockerClient
+from docker.models.containers import Container
+from docker.models.images import Image
+
+from cdflow import (
+    DAEMON_ENTRYPOINT_LABEL, DAEMON_IDLE_TIMEOUT, DAEMON_IDLE_TIMEOUT_LABEL,
+    DAEMON_IMAGE_LABEL, DAEMON_LABEL, DAEMON_PROJECT_ROOT_LABEL,
+    DAEMON_PROJECTS_CACHE, TERRAFORM_PLUGIN_CACHE_PATH, _set_daemon_started,
+    main, run_command,
+)
+
+
+class DaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        environ = patch.dict(os.environ, {'CDFLOW_CACHE_DIR': self.cache_dir})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def started_projects(self):
+        with open('{}/{}'.format(self.cache_dir, DAEMON_PROJECTS_CACHE)) \
+                as projects_file:
+            return list(json.load(projects_file))
+
+
+class TestWarmContainer(DaemonTestCase):
+
+    def setUp(self):
+        super(TestWarmContainer, self).setUp()
+        self.project_root = '/tmp/project'
+        _set_daemon_started(self.project_root, True)
+        self.image_id = 'mergermarket/cdflow-commands@sha256:12345'
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.api = MagicMock()
+
+        self.image = MagicMock(spec=Image)
+        self.image.id = 'sha256:abcdef'
+        self.image.attrs = {'Config': {'Entrypoint': ['cdflow-commands']}}
+        self.docker_client.images.get.return_value = self.image
+
+        self.warm_container = self.make_warm_container(self.image.id)
+        self.docker_client.api.exec_create.return_value = {'Id': 'exec-id'}
+        self.docker_client.api.exec_start.return_value = iter([])
+        self.docker_client.api.exec_inspect.return_value = {'ExitCode': 3}
+
+    def make_warm_container(self, image_id, mounts=()):
+        container = MagicMock(spec=Container)
+        container.id = 'warm-id'
+        container.labels = {
+            DAEMON_LABEL: '',
+            DAEMON_PROJECT_ROOT_LABEL: self.project_root,
+            DAEMON_IMAGE_LABEL: image_id,
+            DAEMON_IDLE_TIMEOUT_LABEL: '600',
+            DAEMON_ENTRYPOINT_LABEL: json.dumps(['cdflow-commands']),
+        }
+        container.attrs = {'Mounts': [
+            {'Destination': destination}
+            for destination in (self.project_root,) + tuple(mounts)
+        ]}
+        return container
+
+    def run_command(self, command, platform_config_paths=[]):
+        with patch('cdflow.docker_run') as docker_run:
+            docker_run.return_value = (0, '')
+            result = run_command(
+                self.docker_client, self.image_id, command,
+                self.project_root, {'AWS_ACCESS_KEY_ID': 'x'},
+                platform_config_paths,
+            )
+        self.docker_run = docker_run
+        return result
+
+    def test_runs_normally_without_warm_containers(self):
+        self.docker_client.containers.list.return_value = []
+
+        assert self.run_command(['deploy', 'aslive', '42']) == (0, '')
+
+        self.docker_run.assert_called_once()
+        self.docker_client.api.exec_create.assert_not_called()
+        assert self.started_projects() == []
+
+    def test_no_lookup_unless_daemon_started(self):
+        _set_daemon_started(self.project_root, False)
+
+        self.run_command(['deploy', 'aslive', '42'])
+
+        self.docker_run.assert_called_once()
+        self.docker_client.containers.list.assert_not_called()
+
+    def test_execs_in_matching_warm_container(self):
+        self.docker_client.containers.list.return_value = [
+            self.warm_container,
+        ]
+
+        exit_status, _ = self.run_command(['deploy', 'aslive', '42'])
+
+        assert exit_status == 3
+        self.docker_run.assert_not_called()
+        self.docker_client.containers.list.assert_called_once_with(
+            filters={'label': [
+                DAEMON_LABEL,
+                '{}={}'.format(DAEMON_PROJECT_ROOT_LABEL, self.project_root),
+            ]},
+        )
+        self.docker_client.api.exec_create.assert_called_once_with(
+            'warm-id',
+            ['/bin/sh', '-c', ANY, 'cdflow', 'cdflow-commands',
+             'deploy', 'aslive', '42'],
+            environment={'AWS_ACCESS_KEY_ID': 'x'},
+            workdir=self.project_root,
+        )
+        self.docker_client.api.exec_start.assert_called_once_with(
+            'exec-id', stream=True, demux=True,
+        )
+
+    def test_shell_never_uses_warm_container(self):
+        self.docker_client.containers.list.return_value = [
+            self.warm_container,
+        ]
+
+        self.run_command(['shell', 'aslive'])
+
+        self.docker_run.assert_called_once()
+        self.docker_client.containers.list.assert_not_called()
+
+    def test_starts_warm_container_for_new_image(self):
+        self.docker_client.containers.list.return_value = [
+            self.make_warm_container('sha256:another-image'),
+        ]
+        new_container = self.make_warm_container(self.image.id)
+        self.docker_client.containers.create.return_value = new_container
+
+        self.run_command(['deploy', 'aslive', '42'])
+
+        self.docker_client.containers.create.assert_called_once_with(
+            self.image_id,
+            entrypoint=['/bin/sh', '-c', ANY, 'cdflow-daemon', '600'],
+            command=[],
+            labels={
+                DAEMON_LABEL: '',
+                DAEMON_PROJECT_ROOT_LABEL: self.project_root,
+                DAEMON_IMAGE_LABEL: self.image.id,
+                DAEMON_IDLE_TIMEOUT_LABEL: '600',
+                DAEMON_ENTRYPOINT_LABEL: '["cdflow-commands"]',
+            },
+            detach=True,
+            environment={'TF_PLUGIN_CACHE_DIR': TERRAFORM_PLUGIN_CACHE_PATH},
+            volumes=ANY,
+            working_dir=self.project_root,
+            auto_remove=True,
+        )
+        volumes = self.docker_client.containers.create.call_args[1]['volumes']
+        # Keyed by project, as no slot lock outlives this process.
+        assert volumes['cdflow-terraform-plugins-12345-daemon-f630ad93'] == {
+            'bind': TERRAFORM_PLUGIN_CACHE_PATH, 'mode': 'rw',
+        }
+        new_container.start.assert_called_once_with()
+        assert self.docker_client.api.exec_create.call_args[0][0] == \
+            new_container.id
+
+    def test_starts_warm_container_when_platform_config_not_mounted(self):
+        self.docker_client.containers.list.return_value = [
+            self.warm_container,
+        ]
+        self.docker_client.containers.create.return_value = \
+            self.make_warm_container(self.image.id, ['/config'])
+
+        self.run_command(
+            ['release', '--platform-config', '/config', '42'], ['/config'],
+        )
+
+        volumes = self.docker_client.containers.create.call_args[1]['volumes']
+        assert '/config' in volumes
+
+
+@patch('cdflow.print')
+@patch('cdflow.docker')
+class TestDaemonCommand(DaemonTestCase):
+
+    def test_start(self, docker, print_):
+        docker_client = docker.from_env.return_value
+        docker_client.images.get.return_value.attrs = {
+            'Config': {'Entrypoint': None},
+        }
+
+        with patch('cdflow.get_image_sha'):
+            assert main(['daemon', 'start', '--idle-timeout', '60']) == 0
+
+        create_kwargs = docker_client.containers.create.call_args[1]
+        assert create_kwargs['entrypoint'][-1] == '60'
+        assert create_kwargs['labels'][DAEMON_ENTRYPOINT_LABEL] == '[]'
+        docker_client.containers.create.return_value.start.\
+            assert_called_once_with()
+        assert self.started_projects() == [os.getcwd()]
+
+    def test_invalid_idle_timeout(self, docker, print_):
+        assert main(['daemon', 'start', '--idle-timeout', 'soon']) == 1
+
+        assert print_.call_args[0][0].startswith('error: ')
+        docker.from_env.assert_not_called()
+
+    def test_idle_timeout_without_value_uses_default(self, docker, print_):
+        docker_client = docker.from_env.return_value
+        docker_client.images.get.return_value.attrs = {
+            'Config': {'Entrypoint': None},
+        }
+
+        with patch('cdflow.get_image_sha'):
+            assert main(['daemon', 'start', '--idle-timeout']) == 0
+
+        create_kwargs = docker_client.containers.create.call_args[1]
+        assert create_kwargs['entrypoint'][-1] == str(DAEMON_IDLE_TIMEOUT)
+
+    def test_stop(self, docker, print_):
+        warm_container = MagicMock(spec=Container)
+        docker.from_env.return_value.containers.list.return_value = [
+            warm_container,
+        ]
+
+        _set_daemon_started(os.getcwd(), True)
+
+        assert main(['daemon', 'stop']) == 0
+
+        warm_container.kill.assert_called_once_with()
+        assert self.started_projects() == []
+
+    def test_usage(self, docker, print_):
+        assert main(['daemon']) == 1
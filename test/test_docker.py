@@ -1,4 +1,9 @@
+import json
+import os
+import stat
+import tarfile
 import unittest
+from io import BytesIO, StringIO, TextIOWrapper
 from hashlib import sha256
 from string import printable
 from copy import deepcopy
@@ -9,10 +14,15 @@ from docker.errors import DockerException, ImageNotFound
 from docker.models.containers import Container
 from docker.models.images import Image
 from requests.exceptions import ReadTimeout
+from tempfile import mkdtemp
+from time import sleep
 
 from cdflow import (
-    _remove_container, docker_run, get_environment, get_image_sha,
-    CDFLOW_IMAGE_ID,
+    _remove_container, _remove_tracked_container, clear_image_cache,
+    docker_run, ensure_image, get_environment, get_image_sha,
+    CDFLOW_IMAGE_ID, OutputRelay,
+    _docker_config_archives, _put_docker_config_into_container,
+    ImagePullError, parse_invocation,
 )
 from hypothesis import assume, given
 from hypothesis.strategies import (
@@ -61,7 +71,11 @@ class TestImage(unittest.TestCase):
             'RepoDigests': [image_sha]
         }
 
-        docker_client.images.pull.return_value = image
+        docker_client.api = MagicMock()
+        docker_client.api.pull.return_value = iter([])
+        docker_client.images.get.return_value = image
+        docker_client.images.get_registry_data.return_value.id = \
+            'sha256:remote'
 
         fetched_image_sha = get_image_sha(docker_client, image_id)
 
@@ -76,7 +90,8 @@ class TestImage(unittest.TestCase):
             'RepoDigests': []
         }
 
-        docker_client.images.pull.side_effect = ImageNotFound(image_id)
+        docker_client.api = MagicMock()
+        docker_client.api.pull.side_effect = ImageNotFound(image_id)
         docker_client.images.get.return_value = image
 
         fetched_image_sha = get_image_sha(docker_client, image_id)
@@ -84,8 +99,260 @@ class TestImage(unittest.TestCase):
         assert fetched_image_sha == image_id
 
 
+class TestEnsureImage(unittest.TestCase):
+
+    def setUp(self):
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.api = MagicMock()
+        self.docker_client.api.pull.return_value = iter([])
+        self.docker_client.images.get_registry_data.return_value.id = \
+            'sha256:remote'
+        self.image_id = 'mergermarket/cdflow-commands@sha256:12345'
+
+    def test_local_digest_is_not_pulled(self):
+        ensure_image(self.docker_client, self.image_id)
+
+        self.docker_client.images.get.assert_called_once_with(self.image_id)
+        self.docker_client.api.pull.assert_not_called()
+
+    def test_missing_digest_is_pulled(self):
+        image = MagicMock(spec=Image)
+        image.attrs = {'RepoDigests': [self.image_id]}
+        self.docker_client.images.get.side_effect = [
+            ImageNotFound(self.image_id), image,
+        ]
+
+        ensure_image(self.docker_client, self.image_id)
+
+        self.docker_client.api.pull.assert_called_once_with(
+            'mergermarket/cdflow-commands', tag='sha256:12345', stream=True,
+            decode=True,
+        )
+        self.docker_client.images.get.assert_called_with(self.image_id)
+
+    def test_tag_is_pulled(self):
+        image = MagicMock(spec=Image)
+        image.attrs = {'RepoDigests': []}
+        self.docker_client.images.get.return_value = image
+
+        ensure_image(self.docker_client, CDFLOW_IMAGE_ID)
+
+        self.docker_client.api.pull.assert_called_once_with(
+            'mergermarket/cdflow-commands', tag='latest', stream=True,
+            decode=True,
+        )
+
+
+class TestImageDigestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = patch.dict(os.environ, {
+            'CDFLOW_CACHE_DIR': mkdtemp(),
+            'CDFLOW_IMAGE_CACHE_TTL': '60',
+        })
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+
+        self.image_id = 'mergermarket/cdflow-commands:latest'
+        self.image_sha = 'mergermarket/cdflow-commands@sha256:12345'
+        self.image = MagicMock(spec=Image)
+        self.image.attrs = {
+            'RepoDigests': [self.image_sha]
+        }
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.api = MagicMock()
+        self.docker_client.api.pull.side_effect = lambda *args, **kwargs: \
+            iter([])
+        self.docker_client.images.get.return_value = self.image
+        self.docker_client.images.get_registry_data.return_value.id = \
+            'sha256:remote'
+
+    def assert_pulled_once(self):
+        self.docker_client.api.pull.assert_called_once_with(
+            'mergermarket/cdflow-commands', tag='latest', stream=True,
+            decode=True,
+        )
+
+    def test_fresh_entry_skips_pull(self):
+        get_image_sha(self.docker_client, self.image_id)
+        self.docker_client.api.pull.reset_mock()
+        self.docker_client.images.get.reset_mock()
+
+        image_sha = get_image_sha(self.docker_client, self.image_id)
+
+        assert image_sha == self.image_sha
+        self.docker_client.api.pull.assert_not_called()
+        self.docker_client.images.get.assert_called_once_with(self.image_id)
+
+    def test_stale_entry_pulls(self):
+        with patch('cdflow.time') as time:
+            time.time.return_value = 1000
+            get_image_sha(self.docker_client, self.image_id)
+            time.time.return_value = 1061
+            self.docker_client.api.pull.reset_mock()
+
+            get_image_sha(self.docker_client, self.image_id)
+
+        self.assert_pulled_once()
+
+    def test_missing_local_image_pulls(self):
+        get_image_sha(self.docker_client, self.image_id)
+        self.docker_client.api.pull.reset_mock()
+        self.docker_client.images.get.side_effect = [
+            ImageNotFound(self.image_id), ImageNotFound(self.image_id),
+            self.image,
+        ]
+
+        image_sha = get_image_sha(self.docker_client, self.image_id)
+
+        assert image_sha == self.image_sha
+        self.assert_pulled_once()
+
+    def test_cache_disabled_without_ttl(self):
+        with patch.dict(os.environ, {'CDFLOW_IMAGE_CACHE_TTL': ''}):
+            get_image_sha(self.docker_client, self.image_id)
+            get_image_sha(self.docker_client, self.image_id)
+
+        assert self.docker_client.api.pull.call_count == 2
+
+    def test_clear_image_cache(self):
+        get_image_sha(self.docker_client, self.image_id)
+        self.docker_client.api.pull.reset_mock()
+
+        with patch('cdflow.print'):
+            assert clear_image_cache(
+                parse_invocation(['clear-image-cache', self.image_id]),
+            ) == 0
+        get_image_sha(self.docker_client, self.image_id)
+
+        self.assert_pulled_once()
+
+
+class TestRemoteDigestCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.image_id = 'mergermarket/cdflow-commands:latest'
+        self.image = MagicMock(spec=Image)
+        self.image.attrs = {
+            'RepoDigests': ['mergermarket/cdflow-commands@sha256:12345'],
+        }
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.api = MagicMock()
+        self.docker_client.api.pull.return_value = iter([])
+        self.docker_client.images.get.return_value = self.image
+
+    def get_image_sha(self, remote_digest):
+        self.docker_client.images.get_registry_data.return_value.id = \
+            remote_digest
+        with patch('cdflow._get_auth_config', return_value=None):
+            return get_image_sha(self.docker_client, self.image_id)
+
+    def test_current_image_is_not_pulled(self):
+        image_sha = self.get_image_sha('sha256:12345')
+
+        assert image_sha == 'mergermarket/cdflow-commands@sha256:12345'
+        self.docker_client.images.get_registry_data.assert_called_once_with(
+            self.image_id, auth_config=None,
+        )
+        self.docker_client.api.pull.assert_not_called()
+
+    def test_changed_tag_is_pulled(self):
+        self.get_image_sha('sha256:67890')
+
+        self.docker_client.api.pull.assert_called_once()
+
+    def test_missing_image_skips_remote_check(self):
+        self.docker_client.images.get.side_effect = [
+            ImageNotFound(self.image_id), self.image,
+        ]
+
+        self.get_image_sha('sha256:12345')
+
+        self.docker_client.images.get_registry_data.assert_not_called()
+        self.docker_client.api.pull.assert_called_once()
+
+    def test_unreachable_registry_falls_back_to_pull(self):
+        self.docker_client.images.get_registry_data.side_effect = \
+            DockerException('registry unavailable')
+
+        with patch('cdflow._get_auth_config', return_value=None):
+            get_image_sha(self.docker_client, self.image_id)
+
+        self.docker_client.api.pull.assert_called_once()
+
+
+class TestImagePull(unittest.TestCase):
+
+    def setUp(self):
+        self.image_id = 'mergermarket/cdflow-commands:latest'
+        self.image = MagicMock(spec=Image)
+        self.image.attrs = {'RepoDigests': ['image@sha256:12345']}
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.api = MagicMock()
+        self.docker_client.images.get.return_value = self.image
+        self.docker_client.images.get_registry_data.return_value.id = \
+            'sha256:remote'
+
+    def pull(self):
+        with patch('cdflow._get_auth_config', return_value=None), \
+                patch('cdflow.time.sleep') as self.sleep:
+            return get_image_sha(self.docker_client, self.image_id)
+
+    def test_error_event_is_retried(self):
+        self.docker_client.api.pull.side_effect = [
+            iter([{'error': 'unexpected EOF'}]),
+            iter([{'status': 'Pull complete', 'id': 'a'}]),
+        ]
+
+        assert self.pull() == 'image@sha256:12345'
+        assert self.docker_client.api.pull.call_count == 2
+        self.sleep.assert_called_once_with(2)
+
+    def test_gives_up_after_repeated_failures(self):
+        self.docker_client.api.pull.side_effect = \
+            lambda *args, **kwargs: iter([{'error': 'unexpected EOF'}])
+
+        self.assertRaises(ImagePullError, self.pull)
+        assert self.docker_client.api.pull.call_count == 3
+        assert [call[0][0] for call in self.sleep.call_args_list] == [2, 4]
+
+    def test_missing_image_is_not_retried(self):
+        self.docker_client.api.pull.side_effect = ImageNotFound('missing')
+
+        assert self.pull() == 'image@sha256:12345'
+        assert self.docker_client.api.pull.call_count == 1
+        self.sleep.assert_not_called()
+
+    def test_throughput_is_logged(self):
+        self.docker_client.api.pull.return_value = iter([
+            {'status': 'Pulling fs layer', 'id': 'a', 'progressDetail': {}},
+            {
+                'status': 'Downloading', 'id': 'a',
+                'progressDetail': {'current': 1000000, 'total': 2000000},
+            },
+            {'status': 'Download complete', 'id': 'a', 'progressDetail': {}},
+            {'status': 'Pull complete', 'id': 'a', 'progressDetail': {}},
+        ])
+
+        with self.assertLogs('cdflow', level='INFO') as logs:
+            self.pull()
+
+        assert any(
+            'Pulled {}: 2.0 MB in'.format(self.image_id) in line
+            for line in logs.output
+        )
+
+
 class TestDockerRun(unittest.TestCase):
 
+    def setUp(self):
+        environ = patch.dict(os.environ, {
+            'CDFLOW_CACHE_DIR': mkdtemp(),
+            'CDFLOW_TERRAFORM_PLUGIN_CACHE': 'off',
+        })
+        environ.start()
+        self.addCleanup(environ.stop)
+
     @given(fixed_dictionaries({
         'environment_variables': fixed_dictionaries({
             'AWS_ACCESS_KEY_ID': text(alphabet=printable, min_size=10),
@@ -109,11 +376,7 @@ class TestDockerRun(unittest.TestCase):
         environment_variables = fixtures['environment_variables']
 
         container = MagicMock(spec=Container)
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
+        container.wait.return_value = {'StatusCode': 0}
         docker_client.containers.create.return_value = container
 
         exit_status, output = docker_run(
@@ -177,11 +440,7 @@ class TestDockerRun(unittest.TestCase):
         environment_variables = fixtures['environment_variables']
 
         container = MagicMock(spec=Container)
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
+        container.wait.return_value = {'StatusCode': 0}
         docker_client.containers.create.return_value = container
 
         exit_status, output = docker_run(
@@ -235,11 +494,7 @@ class TestDockerRun(unittest.TestCase):
         environment_variables = fixtures['environment_variables']
 
         container = MagicMock(spec=Container)
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
+        container.wait.return_value = {'StatusCode': 0}
         docker_client.containers.create.return_value = container
 
         with patch('cdflow.dockerpty') as dockerpty, patch(
@@ -282,6 +537,7 @@ class TestDockerRun(unittest.TestCase):
             working_dir=project_root,
             tty=True,
             stdin_open=True,
+            auto_remove=True,
         )
 
     @given(fixed_dictionaries({
@@ -331,41 +587,37 @@ class TestDockerRun(unittest.TestCase):
             min_size=1,
         ),
     }))
-    def test_follow_container_logs(self, fixtures):
+    def test_follow_container_output(self, fixtures):
         docker_client = MagicMock(spec=DockerClient)
 
         container = MagicMock(spec=Container)
-        logs = MagicMock()
-        messages = [m.encode('utf-8') for m in ('Running', 'the', 'command')]
-        logs.__iter__.return_value = iter(messages)
-        container.logs.return_value = logs
-
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
+        container.attach.return_value = iter([
+            (b'Running', None),
+            (None, b'Warning'),
+            (b'the command', None),
+        ])
+        container.wait.return_value = {'StatusCode': 0}
 
         docker_client.containers.create.return_value = container
 
-        with patch('cdflow.print') as print_:
+        stdout = TextIOWrapper(BytesIO())
+        stderr = TextIOWrapper(BytesIO())
+        with patch('cdflow.sys') as sys:
+            sys.stdout = stdout
+            sys.stderr = stderr
             docker_run(
                 docker_client, fixtures['image_id'], fixtures['command'],
                 fixtures['project_root'], fixtures['environment_variables'],
                 fixtures['platform_config_paths'],
             )
 
-            container.logs.assert_called_once_with(
-                stream=True, follow=True, stdout=True, stderr=True
-            )
-
-            assert print_.call_args_list[0][1]['end'] == ''
-            assert print_.call_args_list[0][0][0] == messages[0]\
-                .decode('utf-8')
-            assert print_.call_args_list[1][0][0] == messages[1]\
-                .decode('utf-8')
-            assert print_.call_args_list[2][0][0] == messages[2]\
-                .decode('utf-8')
+        container.attach.assert_called_once_with(
+            stdout=True, stderr=True, stream=True, logs=True, demux=True,
+        )
+        called = [name for name, _, _ in container.mock_calls]
+        assert called.index('attach') < called.index('start')
+        assert stdout.buffer.getvalue() == b'Runningthe command'
+        assert stderr.buffer.getvalue() == b'Warning'
 
     @given(fixed_dictionaries({
         'image_id': image_id(),
@@ -379,13 +631,10 @@ class TestDockerRun(unittest.TestCase):
         ),
     }))
     def test_container_can_be_removed_at_script_exit(self, fixtures):
+        assume(fixtures['command'][:1] != ['shell'])
         docker_client = MagicMock(spec=DockerClient)
         container = MagicMock(spec=Container)
-        container.attrs = {
-            'State': {
-                'ExitCode': 0
-            }
-        }
+        container.wait.return_value = {'StatusCode': 0}
 
         docker_client.containers.create.return_value = container
 
@@ -397,9 +646,31 @@ class TestDockerRun(unittest.TestCase):
             )
 
             atexit.register.assert_called_once_with(
-                _remove_container, container
+                _remove_tracked_container, container,
+            )
+        _remove_tracked_container(container)
+        container.stop.assert_not_called()
+        container.remove.assert_called_once_with()
+
+    def test_container_is_removed_if_wait_fails(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.wait.side_effect = ReadTimeout
+        docker_client.containers.create.return_value = container
+
+        with patch('cdflow.atexit') as atexit, \
+                self.assertRaises(ReadTimeout):
+            docker_run(
+                docker_client, 'image', ['release', '42'], '/project', {},
             )
 
+        atexit.register.assert_called_once_with(
+            _remove_tracked_container, container,
+        )
+        _remove_tracked_container(container)
+        container.stop.assert_called_once_with()
+        container.remove.assert_called_once_with()
+
     def test_remove_container(self):
         container = MagicMock(spec=Container)
 
@@ -421,6 +692,37 @@ class TestDockerRun(unittest.TestCase):
         container.stop.assert_called_once_with()
         container.remove.assert_called_once_with()
 
+    def test_remove_exited_container_skips_stop(self):
+        container = MagicMock(spec=Container)
+
+        _remove_container(container, exited=True)
+
+        container.stop.assert_not_called()
+        container.remove.assert_called_once_with()
+
+    def test_remove_container_in_background(self):
+        container = MagicMock(spec=Container)
+        container.id = 'abc123'
+
+        with patch.dict(os.environ, {'CDFLOW_BACKGROUND_CLEANUP': '1'}), \
+                patch('cdflow.Popen') as Popen:
+            _remove_container(container, exited=True)
+
+        assert Popen.call_args[0][0] == [
+            'docker', 'container', 'rm', 'abc123',
+        ]
+        container.remove.assert_not_called()
+
+    def test_remove_container_without_docker_cli(self):
+        container = MagicMock(spec=Container)
+
+        with patch.dict(os.environ, {'CDFLOW_BACKGROUND_CLEANUP': '1'}), \
+                patch('cdflow.Popen') as Popen:
+            Popen.side_effect = OSError
+            _remove_container(container, exited=True)
+
+        container.remove.assert_called_once_with()
+
     @given(fixed_dictionaries({
         'image_id': image_id(),
         'command': lists(text(alphabet=printable)),
@@ -438,11 +740,7 @@ class TestDockerRun(unittest.TestCase):
         docker_client = MagicMock(spec=DockerClient)
         container = MagicMock(spec=Container)
 
-        container.attrs = {
-            'State': {
-                'ExitCode': fixtures['exit_code'],
-            }
-        }
+        container.wait.return_value = {'StatusCode': fixtures['exit_code']}
 
         docker_client.containers.create.return_value = container
 
@@ -454,3 +752,125 @@ class TestDockerRun(unittest.TestCase):
 
         assert exit_status == fixtures['exit_code']
         assert output == ''
+
+
+class TestOutputRelay(unittest.TestCase):
+
+    def test_writes_raw_bytes_to_binary_buffer(self):
+        stdout = TextIOWrapper(BytesIO())
+        stdout.write('before\n')
+
+        relay = OutputRelay(stdout)
+        relay.write(b'caf\xc3')
+        relay.write(b'\xa9\n')
+        relay.close()
+
+        assert stdout.buffer.getvalue() == 'before\ncaf\xe9\n'.encode('utf-8')
+
+    def test_decodes_split_characters_for_text_streams(self):
+        stdout = StringIO()
+
+        relay = OutputRelay(stdout)
+        relay.write(b'caf\xc3')
+        relay.write(b'\xa9\n')
+        relay.close()
+
+        assert stdout.getvalue() == 'caf\xe9\n'
+
+    def test_flushes_while_stream_is_quiet(self):
+        stdout = StringIO()
+
+        relay = OutputRelay(stdout)
+        relay.write(b'partial line')
+        sleep(0.5)
+        flushed = stdout.getvalue()
+        relay.close()
+
+        assert flushed == 'partial line'
+
+    def test_prefixes_whole_lines(self):
+        stdout = TextIOWrapper(BytesIO())
+
+        relay = OutputRelay(stdout, 'foo live: ')
+        relay.write(b'first\nsec')
+        relay._flush()
+        flushed = stdout.buffer.getvalue()
+        relay.write(b'ond\nlast')
+        relay.close()
+
+        assert flushed == b'foo live: first\n'
+        assert stdout.buffer.getvalue() == (
+            b'foo live: first\nfoo live: second\nfoo live: last\n'
+        )
+
+
+class TestDockerConfigInjection(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = patch.dict(os.environ, {
+            'CDFLOW_CACHE_DIR': mkdtemp(),
+            'DOCKERHUB_USERNAME': 'user',
+            'DOCKERHUB_PASSWORD': 'secret',
+        })
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+        _docker_config_archives.clear()
+        self.addCleanup(_docker_config_archives.clear)
+
+    def test_archive_contains_docker_config(self):
+        container = MagicMock(spec=Container)
+
+        _put_docker_config_into_container(container)
+
+        path, archive = container.put_archive.call_args[0]
+        assert path == '/root'
+        with tarfile.open(fileobj=BytesIO(archive)) as tar:
+            member = tar.getmember('.docker/config.json')
+            config = json.load(tar.extractfile(member))
+        assert member.mode == 0o600
+        assert config['auths']['https://index.docker.io/v1/']['auth'] == \
+            'dXNlcjpzZWNyZXQ='
+
+    def test_archive_is_built_once_per_config(self):
+        first, second = MagicMock(spec=Container), MagicMock(spec=Container)
+
+        _put_docker_config_into_container(first)
+        _put_docker_config_into_container(second)
+
+        assert len(_docker_config_archives) == 1
+        assert first.put_archive.call_args[0][1] is \
+            second.put_archive.call_args[0][1]
+
+    def test_config_is_mounted_at_create_time(self):
+        docker_client = MagicMock(spec=DockerClient)
+        container = MagicMock(spec=Container)
+        container.wait.return_value = {'StatusCode': 0}
+        docker_client.containers.create.return_value = container
+
+        runtime_dir = mkdtemp()
+
+        with patch.dict(os.environ, {
+            'CDFLOW_DOCKER_CONFIG_INJECTION': 'mount',
+            'XDG_RUNTIME_DIR': runtime_dir,
+        }), patch('cdflow.atexit') as atexit:
+            docker_run(
+                docker_client, 'image', ['release', '42'], '/project', {},
+            )
+
+        volumes = docker_client.containers.create.call_args[1]['volumes']
+        mounted = [
+            (path, volume['mode']) for path, volume in volumes.items()
+            if volume['bind'] == '/root/.docker/config.json'
+        ]
+        assert len(mounted) == 1
+        path, mode = mounted[0]
+        assert mode == 'rw'
+        assert os.path.dirname(path) == runtime_dir
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        with open(path) as config_file:
+            assert 'auths' in json.load(config_file)
+        container.put_archive.assert_not_called()
+
+        for call in atexit.register.call_args_list:
+            call[0][0](*call[0][1:], **call[1])
+        assert not os.path.exists(path)
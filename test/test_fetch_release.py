@@ -1,28 +1,37 @@
+import os
 import unittest
 from random import shuffle
 from itertools import chain
+from tempfile import mkdtemp
 
 from cdflow import (
-    fetch_release_metadata, get_component_name, get_version,
-    get_platform_config_paths, MissingPlatformConfigError,
+    _git_remote_urls, fetch_release_metadata, get_component_name,
+    get_platform_config_paths, MissingPlatformConfigError, parse_invocation,
 )
 from hypothesis import given
 from hypothesis.strategies import fixed_dictionaries, lists, sampled_from, text
 from mock import Mock, patch
-from test.strategies import VALID_ALPHABET, filepath
+from test.strategies import OPTION_TOKENS, VALID_ALPHABET, filepath
 
 
 class TestGetComponentName(unittest.TestCase):
 
     def setUp(self):
-        self.argv = ['deploy', '42']
+        self.invocation = parse_invocation(['deploy', '42'])
+        # Exercise the fallback to `git config` rather than this checkout's
+        # own .git/config.
+        self.find_git_dir = patch('cdflow._find_git_dir', return_value=None)
+        self.find_git_dir.start()
+
+    def tearDown(self):
+        self.find_git_dir.stop()
 
     @given(text(
         alphabet=VALID_ALPHABET, min_size=1, max_size=100
     ))
     def test_get_component_name_passed_in(self, expected_component_name):
         argv = ['deploy', '42', '-c', expected_component_name]
-        actual_component_name = get_component_name(argv)
+        actual_component_name = get_component_name(parse_invocation(argv))
 
         assert actual_component_name == expected_component_name
 
@@ -33,7 +42,7 @@ class TestGetComponentName(unittest.TestCase):
         self, expected_component_name
     ):
         argv = ['deploy', '42', '--component', expected_component_name]
-        actual_component_name = get_component_name(argv)
+        actual_component_name = get_component_name(parse_invocation(argv))
 
         assert actual_component_name == expected_component_name
 
@@ -45,7 +54,7 @@ class TestGetComponentName(unittest.TestCase):
             check_output.return_value = 'git@github.com:org/{}.git\n'.format(
                 component_name
             ).encode('utf-8')
-            extraced_component_name = get_component_name(self.argv)
+            extraced_component_name = get_component_name(self.invocation)
 
             assert extraced_component_name == component_name
 
@@ -59,7 +68,7 @@ class TestGetComponentName(unittest.TestCase):
             check_output.return_value = 'git@github.com:org/{}\n'.format(
                 component_name
             ).encode('utf-8')
-            extraced_component_name = get_component_name(self.argv)
+            extraced_component_name = get_component_name(self.invocation)
 
             assert extraced_component_name == component_name
 
@@ -73,7 +82,7 @@ class TestGetComponentName(unittest.TestCase):
             check_output.return_value = 'git@github.com:org/{}/\n'.format(
                 component_name
             ).encode('utf-8')
-            extraced_component_name = get_component_name(self.argv)
+            extraced_component_name = get_component_name(self.invocation)
 
             assert extraced_component_name == component_name
 
@@ -88,7 +97,7 @@ class TestGetComponentName(unittest.TestCase):
             check_output.return_value = repo_template.format(
                 component_name
             ).encode('utf-8')
-            extraced_component_name = get_component_name(self.argv)
+            extraced_component_name = get_component_name(self.invocation)
 
             assert extraced_component_name == component_name
 
@@ -102,37 +111,127 @@ class TestGetComponentName(unittest.TestCase):
             check_output.return_value = 'https://github.com/org/{}\n'.format(
                 component_name
             ).encode('utf-8')
-            extraced_component_name = get_component_name(self.argv)
+            extraced_component_name = get_component_name(self.invocation)
 
             assert extraced_component_name == component_name
 
 
+class TestGetComponentNameFromGitConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.invocation = parse_invocation(['deploy', '42'])
+        _git_remote_urls.clear()
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as output:
+            output.write(content)
+
+    def get_component_name(self, directory=''):
+        with patch('cdflow.os.getcwd') as getcwd, \
+                patch('cdflow.check_output') as check_output:
+            getcwd.return_value = os.path.join(self.root, directory)
+            check_output.return_value = b'git@github.com:org/from-git.git\n'
+            component_name = get_component_name(self.invocation)
+        self.check_output = check_output
+        return component_name
+
+    def test_reads_origin_from_git_config(self):
+        self.write('repo/.git/config', (
+            '[core]\n'
+            '\tbare = false\n'
+            '[remote "upstream"]\n'
+            '\turl = git@github.com:org/upstream.git\n'
+            '[remote "origin"]\n'
+            '\t# a comment\n'
+            '\tURL = git@github.com:org/my-component.git\n'
+            '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'
+        ))
+
+        assert self.get_component_name('repo/a/b') == 'my-component'
+        self.check_output.assert_not_called()
+
+    def test_follows_worktree_gitdir(self):
+        self.write('repo/.git/config', (
+            '[remote "origin"]\n'
+            '\turl = https://github.com/org/my-component\n'
+        ))
+        self.write('repo/.git/worktrees/wt/commondir', '../..\n')
+        self.write('wt/.git', 'gitdir: ../repo/.git/worktrees/wt\n')
+
+        assert self.get_component_name('wt') == 'my-component'
+        self.check_output.assert_not_called()
+
+    def test_follows_submodule_gitdir(self):
+        self.write('repo/.git/modules/sub/config', (
+            '[remote "origin"]\n'
+            '\turl = git@github.com:org/sub.git\n'
+        ))
+        self.write('repo/sub/.git', 'gitdir: ../.git/modules/sub\n')
+
+        assert self.get_component_name('repo/sub') == 'sub'
+
+    def test_falls_back_to_git_for_unsupported_config(self):
+        self.write('repo/.git/config', (
+            '[include]\n'
+            '\tpath = ~/.gitconfig-work\n'
+            '[remote "origin"]\n'
+            '\turl = git@github.com:org/my-component.git\n'
+        ))
+
+        assert self.get_component_name('repo') == 'from-git'
+        self.check_output.assert_called_once_with(
+            ['git', 'config', 'remote.origin.url'],
+        )
+
+    def test_falls_back_to_git_without_origin(self):
+        self.write('repo/.git/config', '[core]\n\tbare = false\n')
+
+        assert self.get_component_name('repo') == 'from-git'
+
+    def test_result_is_cached_per_repository(self):
+        self.write('repo/.git/config', (
+            '[remote "origin"]\n'
+            '\turl = git@github.com:org/first.git\n'
+        ))
+        assert self.get_component_name('repo') == 'first'
+
+        self.write('repo/.git/config', (
+            '[remote "origin"]\n'
+            '\turl = git@github.com:org/second.git\n'
+        ))
+
+        assert self.get_component_name('repo/subdirectory') == 'first'
+
+
 class TestGetVersion(unittest.TestCase):
 
     @given(
         text(alphabet=VALID_ALPHABET, min_size=1)
-        .filter(lambda v: not v == '-v')
+        .filter(lambda v: v not in OPTION_TOKENS)
     )
     def test_get_version_during_deploy(self, version):
         argv = ['deploy', 'test', version]
-        found_version = get_version(argv)
+        found_version = parse_invocation(argv).version
 
         assert found_version == version
 
     @given(
         text(alphabet=VALID_ALPHABET, min_size=1)
-        .filter(lambda v: not v == '-v')
+        .filter(lambda v: v not in OPTION_TOKENS)
     )
     def test_get_version_during_release(self, version):
         argv = ['release', version]
-        found_version = get_version(argv)
+        found_version = parse_invocation(argv).version
 
         assert found_version == version
 
     @given(fixed_dictionaries({
         'version': (
             text(alphabet=VALID_ALPHABET, min_size=1)
-            .filter(lambda v: not v == '-v')
+            .filter(lambda v: v not in OPTION_TOKENS)
         ),
         'options': lists(
             elements=sampled_from((
@@ -153,18 +252,18 @@ class TestGetVersion(unittest.TestCase):
 
         argv = ['release'] + list(extra)
 
-        assert version == get_version(argv)
+        assert version == parse_invocation(argv).version
 
     def test_missing_version_returns_nothing(self):
         argv = ['release']
-        found_version = get_version(argv)
+        found_version = parse_invocation(argv).version
 
         assert found_version is None
 
     @given(fixed_dictionaries({
         'version': (
             text(alphabet=VALID_ALPHABET, min_size=1)
-            .filter(lambda v: not v == '-v')
+            .filter(lambda v: v not in OPTION_TOKENS)
         ),
         'path': filepath(),
     }))
@@ -173,7 +272,7 @@ class TestGetVersion(unittest.TestCase):
         path = fixtures['path']
         argv = ['release', '--platform-config', path, version]
 
-        found_version = get_version(argv)
+        found_version = parse_invocation(argv).version
 
         assert found_version == version
 
@@ -192,19 +291,20 @@ class TestGetPlatformConfigPathFromArgs(unittest.TestCase):
                 '42'
             ]
 
-            assert get_platform_config_paths(args) == [
+            assert get_platform_config_paths(parse_invocation(args)) == [
                 '{}/{}'.format(prefix, path_a), '{}/{}'.format(prefix, path_b)
             ]
 
     def test_raises_exception_when_missing_flag(self):
         self.assertRaises(
-            MissingPlatformConfigError, get_platform_config_paths, []
+            MissingPlatformConfigError, get_platform_config_paths,
+            parse_invocation([]),
         )
 
     def test_raises_exception_when_missing_value(self):
         self.assertRaises(
             MissingPlatformConfigError, get_platform_config_paths,
-            ['--platform-config'],
+            parse_invocation(['--platform-config']),
         )
 
 
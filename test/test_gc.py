@@ -0,0 +1,155 @@
+import json
+import os
+import time
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+
+from docker.client import DockerClient
+from docker.errors import APIError
+
+from cdflow import IMAGE_USAGE_CACHE, docker_run, select_gc_images
+from test.helpers import make_image, run_main
+
+DAY = 24 * 60 * 60
+
+
+class TestGarbageCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.environ = patch.dict(os.environ, {
+            'CDFLOW_CACHE_DIR': self.cache_dir,
+            'CDFLOW_REGISTRY_MIRRORS': '',
+        })
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+        self.now = time.time()
+        self.recent = make_image(
+            'sha256:1', 1e9, tags=['mergermarket/cdflow-commands:latest'],
+        )
+        self.pinned = make_image(
+            'sha256:2', 1e9,
+            digests=['mergermarket/cdflow-commands@sha256:pinned'],
+        )
+        self.stale = make_image(
+            'sha256:3', 1e9,
+            tags=[
+                'mergermarket/cdflow-commands:terraform0.11.0',
+                'myorg/terraform:0.11',
+            ],
+        )
+        self.usage = {
+            'mergermarket/cdflow-commands:latest': self.now,
+            'mergermarket/cdflow-commands@sha256:pinned': self.now - DAY,
+            'mergermarket/cdflow-commands:terraform0.11.0':
+                self.now - 60 * DAY,
+        }
+
+    def write_usage(self):
+        with open('{}/{}'.format(self.cache_dir, IMAGE_USAGE_CACHE), 'w') \
+                as usage_file:
+            json.dump(self.usage, usage_file)
+
+    def read_usage(self):
+        with open('{}/{}'.format(self.cache_dir, IMAGE_USAGE_CACHE)) \
+                as usage_file:
+            return json.load(usage_file)
+
+    def run_gc(self, argv, remove=None):
+        self.write_usage()
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.images.remove.side_effect = remove
+        self.docker_client.volumes.list.return_value = []
+        self.docker_client.images.list.return_value = [
+            self.recent, self.pinned, self.stale,
+        ]
+        exit_status, print_, _ = run_main(
+            ['gc'] + argv, self.docker_client,
+            environment={'CDFLOW_CACHE_DIR': self.cache_dir},
+        )
+        self.printed = [call[0][0] for call in print_.call_args_list]
+        return exit_status
+
+    def removed(self):
+        return [
+            call[0][0]
+            for call in self.docker_client.images.remove.call_args_list
+        ]
+
+    def test_removes_images_unused_within_max_age(self):
+        assert self.run_gc([]) == 0
+
+        self.docker_client.images.list.assert_called_once_with(
+            name='mergermarket/cdflow-commands',
+        )
+        assert self.removed() == [
+            'mergermarket/cdflow-commands:terraform0.11.0',
+        ]
+        assert self.printed[-1] == \
+            'Removed 1 of 1 images (1000.0 MB), kept 2 (2000.0 MB)'
+        assert 'mergermarket/cdflow-commands:terraform0.11.0' not in \
+            self.read_usage()
+
+    def test_size_budget_removes_least_recently_used(self):
+        self.run_gc(['--max-size', '1.5', '--max-age=90'])
+
+        assert self.removed() == [
+            'mergermarket/cdflow-commands@sha256:pinned',
+            'mergermarket/cdflow-commands:terraform0.11.0',
+        ]
+
+    def test_dry_run_removes_nothing(self):
+        assert self.run_gc(['--dry-run']) == 0
+
+        self.docker_client.images.remove.assert_not_called()
+        assert self.printed[-1].startswith('Would remove 1 of 1 images')
+        assert 'mergermarket/cdflow-commands:terraform0.11.0' in \
+            self.read_usage()
+
+    def test_image_in_use_is_reported(self):
+        self.usage = {}
+
+        def remove(reference):
+            if reference == 'mergermarket/cdflow-commands:latest':
+                raise APIError('conflict: image is being used')
+
+        assert self.run_gc([], remove=remove) == 1
+        assert any(
+            line.startswith(
+                'could not remove mergermarket/cdflow-commands:latest',
+            )
+            for line in self.printed
+        )
+
+    def test_never_used_images_are_least_recent(self):
+        keep, remove = select_gc_images(
+            [self.stale, self.recent], {
+                'mergermarket/cdflow-commands:latest': self.now,
+            },
+            self.now - DAY, 10e9,
+        )
+
+        assert keep == [self.recent]
+        assert remove == [self.stale]
+
+    def test_invalid_option(self):
+        assert self.run_gc(['--max-age', 'soon']) == 1
+
+
+class TestImageUsage(unittest.TestCase):
+
+    def test_docker_run_records_image_usage(self):
+        cache_dir = mkdtemp()
+        docker_client = MagicMock(spec=DockerClient)
+        docker_client.containers.create.side_effect = APIError('failed')
+
+        with patch.dict(os.environ, {'CDFLOW_CACHE_DIR': cache_dir}), \
+                patch('cdflow._get_volumes', return_value={}):
+            docker_run(
+                docker_client, 'mergermarket/cdflow-commands:latest',
+                ['release', '42'], '/project', {},
+            )
+
+        with open('{}/{}'.format(cache_dir, IMAGE_USAGE_CACHE)) as usage:
+            assert 'mergermarket/cdflow-commands:latest' in json.load(usage)
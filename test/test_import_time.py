@@ -0,0 +1,109 @@
+import unittest
+import subprocess
+import sys
+from os import path
+from tempfile import mkdtemp
+
+PROJECT_ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+IMPORT_BUDGET_MICROSECONDS = 200000
+# From importing cdflow to the container having run, with docker mocked.
+RUN_BUDGET_MICROSECONDS = 500000
+
+HEAVY_MODULES = (
+    'asyncio', 'boto3', 'botocore', 'docker', 'dockerpty', 'yaml',
+)
+
+RUN_COMMAND = '''
+import sys
+import time
+from unittest.mock import patch
+start = time.perf_counter()
+import cdflow
+with patch('docker.from_env'), \\
+        patch('cdflow.find_image_id_from_release', return_value='digest'), \\
+        patch('cdflow.print'):
+    cdflow.main(sys.argv[1:])
+print(int((time.perf_counter() - start) * 1000000))
+print(' '.join(sorted(sys.modules)))
+'''
+
+
+def _python(*args):
+    return subprocess.run(
+        [sys.executable] + list(args),
+        cwd=mkdtemp(),
+        env={'PYTHONPATH': PROJECT_ROOT, 'CDFLOW_CACHE_DIR': mkdtemp()},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+
+def _run_cdflow(argv):
+    # Returns how long the run took in microseconds and the modules loaded.
+    lines = _python('-c', RUN_COMMAND, *argv).stdout.strip().splitlines()
+    return int(lines[-2]), {
+        module.split('.')[0] for module in lines[-1].split(' ')
+    }
+
+
+def _loaded_modules(argv):
+    return _run_cdflow(argv)[1]
+
+
+def _run_time(argv):
+    return _run_cdflow(argv)[0]
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_import_does_not_load_heavy_dependencies(self):
+        output = _python(
+            '-c', 'import sys, cdflow; print(" ".join(sys.modules))'
+        ).stdout
+        loaded = {module.split('.')[0] for module in output.split()}
+
+        assert not loaded & set(HEAVY_MODULES)
+
+    def test_import_within_budget(self):
+        stderr = _python('-X', 'importtime', '-c', 'import cdflow').stderr
+        cumulative = [
+            int(line.split('|')[1])
+            for line in stderr.splitlines()
+            if line.split('|')[-1].strip() == 'cdflow'
+        ]
+
+        assert cumulative[0] < IMPORT_BUDGET_MICROSECONDS
+
+    def test_release_does_not_load_boto3_or_dockerpty(self):
+        loaded = _loaded_modules([
+            'release', '--platform-config', 'path/to/config', '42',
+        ])
+
+        assert 'docker' in loaded
+        assert not loaded & {'boto3', 'botocore', 'dockerpty', 'yaml'}
+
+    def test_deploy_does_not_load_dockerpty(self):
+        loaded = _loaded_modules(['deploy', 'aslive', '42', '-c', 'foo'])
+
+        assert 'dockerpty' not in loaded
+
+    def test_destroy_does_not_load_boto3_or_dockerpty(self):
+        loaded = _loaded_modules(['destroy', 'aslive', '-c', 'foo'])
+
+        assert not loaded & {'boto3', 'botocore', 'dockerpty', 'yaml'}
+
+    def test_release_within_budget(self):
+        assert _run_time([
+            'release', '--platform-config', 'path/to/config', '42',
+        ]) < RUN_BUDGET_MICROSECONDS
+
+    def test_deploy_within_budget(self):
+        assert _run_time(['deploy', 'aslive', '42', '-c', 'foo']) \
+            < RUN_BUDGET_MICROSECONDS
+
+    def test_destroy_within_budget(self):
+        assert _run_time(['destroy', 'aslive', '-c', 'foo']) \
+            < RUN_BUDGET_MICROSECONDS
@@ -3,13 +3,15 @@ from unittest.mock import ANY, MagicMock, Mock, patch
 from string import printable
 from _io import TextIOWrapper
 import logging
+import json
+from io import BytesIO
 
 import yaml
 from docker.client import DockerClient
 from docker.models.containers import Container
 from docker.models.images import Image
 
-from cdflow import main, logger
+from cdflow import TERRAFORM_PLUGIN_CACHE_PATH, main, logger
 from hypothesis import given
 from hypothesis.strategies import dictionaries, fixed_dictionaries, text
 
@@ -27,12 +29,15 @@ class TestIntegration(unittest.TestCase):
         with patch('cdflow.docker') as docker, \
                 patch('cdflow.os') as os, \
                 patch('cdflow.abspath') as abspath, \
-                patch('cdflow.open') as open_:
+                patch('cdflow.open') as open_, \
+                patch('cdflow._try_lock'):
             abs_path_to_config = '/root/path/to/config'
             abspath.return_value = abs_path_to_config
 
             image = MagicMock(spec=Image)
-            docker.from_env.return_value.images.pull.return_value = image
+            docker.from_env.return_value.images.get.return_value = image
+            docker.from_env.return_value.images.\
+                get_registry_data.return_value.id = 'sha256:remote'
             image.attrs = {
                 'RepoDigests': ['hash']
             }
@@ -40,11 +45,7 @@ class TestIntegration(unittest.TestCase):
             container = MagicMock(spec=Container)
             docker.from_env.return_value.containers.create.return_value \
                 = container
-            container.attrs = {
-                'State': {
-                    'ExitCode': 0
-                }
-            }
+            container.wait.return_value = {'StatusCode': 0}
 
             os.getcwd.return_value = project_root
             os.getenv.return_value = False
@@ -60,8 +61,9 @@ class TestIntegration(unittest.TestCase):
         assert exit_status == 0
 
         docker.from_env.assert_called_once()
-        docker.from_env.return_value.images.pull.assert_called_once_with(
-            'mergermarket/cdflow-commands:latest',
+        docker.from_env.return_value.api.pull.assert_called_once_with(
+            'mergermarket/cdflow-commands', tag='latest', stream=True,
+            decode=True,
         )
         docker.from_env.return_value.containers.create.assert_called_once_with(
             'mergermarket/cdflow-commands:latest',
@@ -76,6 +78,7 @@ class TestIntegration(unittest.TestCase):
                 'DATADOG_APP_KEY': ANY,
                 'DATADOG_API_KEY': ANY,
                 'CDFLOW_IMAGE_DIGEST': 'hash',
+                'TF_PLUGIN_CACHE_DIR': TERRAFORM_PLUGIN_CACHE_PATH,
             },
             detach=True,
             volumes={
@@ -91,6 +94,10 @@ class TestIntegration(unittest.TestCase):
                     'bind': abs_path_to_config,
                     'mode': 'ro',
                 },
+                'cdflow-terraform-plugins-hash': {
+                    'bind': TERRAFORM_PLUGIN_CACHE_PATH,
+                    'mode': 'rw',
+                },
             },
             working_dir=project_root
         )
@@ -98,12 +105,13 @@ class TestIntegration(unittest.TestCase):
         docker.from_env.return_value.containers.create.return_value.start.\
             assert_called_once()
 
-        docker.from_env.return_value.containers.create.return_value.logs.\
+        docker.from_env.return_value.containers.create.return_value.attach.\
             assert_called_once_with(
-                stream=True,
-                follow=True,
                 stdout=True,
                 stderr=True,
+                stream=True,
+                logs=True,
+                demux=True,
             )
 
     @given(fixed_dictionaries({
@@ -125,23 +133,22 @@ class TestIntegration(unittest.TestCase):
         with patch('cdflow.docker') as docker, \
                 patch('cdflow.os') as os, \
                 patch('cdflow.abspath') as abspath, \
-                patch('cdflow.open') as open_:
+                patch('cdflow.open') as open_, \
+                patch('cdflow._try_lock'):
             abs_path_to_config = '/root/path/to/config'
             abspath.return_value = abs_path_to_config
 
             image = MagicMock(spec=Image)
-            docker.from_env.return_value.images.pull.return_value = image
+            docker.from_env.return_value.images.get.return_value = image
+            docker.from_env.return_value.images.\
+                get_registry_data.return_value.id = 'sha256:remote'
             image.attrs = {
                 'RepoDigests': ['hash']
             }
             container = MagicMock(spec=Container)
             docker.from_env.return_value.containers.create.return_value \
                 = container
-            container.attrs = {
-                'State': {
-                    'ExitCode': 0
-                }
-            }
+            container.wait.return_value = {'StatusCode': 0}
 
             os.getcwd.return_value = project_root
             os.getenv.return_value = False
@@ -158,8 +165,8 @@ class TestIntegration(unittest.TestCase):
 
         assert exit_status == 0
 
-        docker.from_env.return_value.images.pull.assert_called_once_with(
-            pinned_image_id
+        docker.from_env.return_value.api.pull.assert_called_once_with(
+            ANY, tag=ANY, stream=True, decode=True,
         )
         docker.from_env.return_value.containers.create.assert_called_once_with(
             pinned_image_id,
@@ -174,6 +181,7 @@ class TestIntegration(unittest.TestCase):
                 'LOGENTRIES_ACCOUNT_KEY': ANY,
                 'DATADOG_APP_KEY': ANY,
                 'DATADOG_API_KEY': ANY,
+                'TF_PLUGIN_CACHE_DIR': TERRAFORM_PLUGIN_CACHE_PATH,
             },
             detach=True,
             volumes={
@@ -189,6 +197,10 @@ class TestIntegration(unittest.TestCase):
                     'bind': '/var/run/docker.sock',
                     'mode': 'ro',
                 },
+                'cdflow-terraform-plugins-hash': {
+                    'bind': TERRAFORM_PLUGIN_CACHE_PATH,
+                    'mode': 'rw',
+                },
             },
             working_dir=project_root
         )
@@ -208,27 +220,28 @@ class TestIntegration(unittest.TestCase):
     def test_classic_deploy(self, fixtures):
         argv = ['deploy', 'aslive', '42']
 
-        with patch('cdflow.Session') as Session, \
-                patch('cdflow.BytesIO') as BytesIO, \
+        with patch('cdflow.get_s3_resource') as get_s3_resource, \
                 patch('cdflow.docker') as docker, \
                 patch('cdflow.os') as os, \
-                patch('cdflow.open') as open_:
+                patch('cdflow.open') as open_, \
+                patch('cdflow._try_lock'):
 
             s3_resource = Mock()
 
-            image_digest = 'sha:12345asdfg'
+            image_digest = 'mergermarket/cdflow-commands@sha256:12345'
             s3_resource.Object.return_value.metadata = {
                 'cdflow_image_digest': image_digest
             }
 
-            Session.return_value.resource.return_value = s3_resource
+            get_s3_resource.return_value = s3_resource
 
-            BytesIO.return_value.__enter__.return_value.read.return_value = '''
-                {{
-                    "release-bucket": "{}",
-                    "classic-metadata-handling": true
-                }}
-            '''.format(fixtures['release_bucket'])
+            s3_resource.Object.return_value.get.return_value = {
+                'ETag': '"etag"',
+                'Body': BytesIO(json.dumps({
+                    'release-bucket': fixtures['release_bucket'],
+                    'classic-metadata-handling': True,
+                }).encode('utf-8')),
+            }
 
             config_file = MagicMock(spec=TextIOWrapper)
             config_file.read.return_value = yaml.dump({
@@ -240,15 +253,14 @@ class TestIntegration(unittest.TestCase):
             open_.return_value.__enter__.return_value = config_file
 
             docker_client = MagicMock(spec=DockerClient)
+            docker_client.api = MagicMock()
+            docker_client.images.get_registry_data.return_value.id = \
+                'sha256:remote'
             docker.from_env.return_value = docker_client
             container = MagicMock(spec=Container)
             docker.from_env.return_value.containers.create.return_value \
                 = container
-            container.attrs = {
-                'State': {
-                    'ExitCode': 0
-                }
-            }
+            container.wait.return_value = {'StatusCode': 0}
 
             project_root = fixtures['project_root']
             os.getcwd.return_value = project_root
@@ -258,6 +270,9 @@ class TestIntegration(unittest.TestCase):
 
             assert exit_status == 0
 
+            docker_client.images.get.assert_called_once_with(image_digest)
+            docker_client.api.pull.assert_not_called()
+
             s3_resource.Object.assert_any_call(
                 fixtures['s3_bucket_and_key'][0],
                 fixtures['s3_bucket_and_key'][1],
@@ -270,7 +285,8 @@ class TestIntegration(unittest.TestCase):
                 detach=True,
                 volumes={
                     project_root: ANY,
-                    '/var/run/docker.sock': ANY
+                    '/var/run/docker.sock': ANY,
+                    'cdflow-terraform-plugins-12345': ANY,
                 },
                 working_dir=project_root,
             )
@@ -278,13 +294,13 @@ class TestIntegration(unittest.TestCase):
             docker.from_env.return_value.containers.create.return_value.start.\
                 assert_called_once()
 
-            docker.from_env.return_value.containers.create.return_value.logs.\
-                assert_called_once_with(
-                    stream=True,
-                    follow=True,
-                    stdout=True,
-                    stderr=True,
-                )
+            container.attach.assert_called_once_with(
+                stdout=True,
+                stderr=True,
+                stream=True,
+                logs=True,
+                demux=True,
+            )
 
     @given(fixed_dictionaries({
         'project_root': filepath(),
@@ -310,26 +326,27 @@ class TestIntegration(unittest.TestCase):
         component_name = fixtures['component_name']
         argv = ['deploy', 'aslive', version, '--component', component_name]
 
-        with patch('cdflow.Session') as Session, \
-                patch('cdflow.BytesIO') as BytesIO, \
+        with patch('cdflow.get_s3_resource') as get_s3_resource, \
                 patch('cdflow.docker') as docker, \
                 patch('cdflow.os') as os, \
-                patch('cdflow.open') as open_:
+                patch('cdflow.open') as open_, \
+                patch('cdflow._try_lock'):
 
             s3_resource = Mock()
 
-            image_digest = 'sha:12345asdfg'
+            image_digest = 'mergermarket/cdflow-commands@sha256:12345'
             s3_resource.Object.return_value.metadata = {
                 'cdflow_image_digest': image_digest
             }
 
-            Session.return_value.resource.return_value = s3_resource
+            get_s3_resource.return_value = s3_resource
 
-            BytesIO.return_value.__enter__.return_value.read.return_value = '''
-                {{
-                    "release-bucket": "{}"
-                }}
-            '''.format(fixtures['release_bucket'])
+            s3_resource.Object.return_value.get.return_value = {
+                'ETag': '"etag"',
+                'Body': BytesIO(json.dumps({
+                    'release-bucket': fixtures['release_bucket'],
+                }).encode('utf-8')),
+            }
 
             config_file = MagicMock(spec=TextIOWrapper)
             config_file.read.return_value = yaml.dump({
@@ -341,15 +358,14 @@ class TestIntegration(unittest.TestCase):
             open_.return_value.__enter__.return_value = config_file
 
             docker_client = MagicMock(spec=DockerClient)
+            docker_client.api = MagicMock()
+            docker_client.images.get_registry_data.return_value.id = \
+                'sha256:remote'
             docker.from_env.return_value = docker_client
             container = MagicMock(spec=Container)
             docker.from_env.return_value.containers.create.return_value \
                 = container
-            container.attrs = {
-                'State': {
-                    'ExitCode': 0
-                }
-            }
+            container.wait.return_value = {'StatusCode': 0}
 
             project_root = fixtures['project_root']
             os.getcwd.return_value = project_root
@@ -359,6 +375,9 @@ class TestIntegration(unittest.TestCase):
 
             assert exit_status == 0
 
+            docker_client.images.get.assert_called_once_with(image_digest)
+            docker_client.api.pull.assert_not_called()
+
             s3_resource.Object.assert_any_call(
                 fixtures['s3_bucket_and_key'][0],
                 fixtures['s3_bucket_and_key'][1],
@@ -381,7 +400,8 @@ class TestIntegration(unittest.TestCase):
                 detach=True,
                 volumes={
                     project_root: ANY,
-                    '/var/run/docker.sock': ANY
+                    '/var/run/docker.sock': ANY,
+                    'cdflow-terraform-plugins-12345': ANY,
                 },
                 working_dir=project_root,
             )
@@ -389,19 +409,20 @@ class TestIntegration(unittest.TestCase):
             docker.from_env.return_value.containers.create.return_value.start.\
                 assert_called_once()
 
-            docker.from_env.return_value.containers.create.return_value.logs.\
-                assert_called_once_with(
-                    stream=True,
-                    follow=True,
-                    stdout=True,
-                    stderr=True,
-                )
+            container.attach.assert_called_once_with(
+                stdout=True,
+                stderr=True,
+                stream=True,
+                logs=True,
+                demux=True,
+            )
 
 
 @patch('cdflow.docker')
 @patch('cdflow.os')
 @patch('cdflow.abspath')
 @patch('cdflow.open')
+@patch('cdflow._try_lock', MagicMock())
 class TestVerboseLogging(unittest.TestCase):
 
     def setup_mocks(self, open_, abspath, os, docker):
@@ -415,7 +436,9 @@ class TestVerboseLogging(unittest.TestCase):
         abspath.return_value = abs_path_to_config
 
         image = MagicMock(spec=Image)
-        docker.from_env.return_value.images.pull.return_value = image
+        docker.from_env.return_value.images.get.return_value = image
+        docker.from_env.return_value.images.\
+            get_registry_data.return_value.id = 'sha256:remote'
         image.attrs = {
             'RepoDigests': ['hash']
         }
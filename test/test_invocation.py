@@ -0,0 +1,167 @@
+import unittest
+from contextlib import suppress
+from copy import copy
+from itertools import chain
+from os.path import abspath
+
+from cdflow import (
+    Invocation, MissingPlatformConfigError, get_platform_config_paths,
+    parse_invocation,
+)
+from hypothesis import given
+from hypothesis.strategies import (
+    booleans, composite, lists, none, one_of, permutations, sampled_from,
+    text,
+)
+from test.strategies import OPTION_TOKENS, VALID_ALPHABET, filepath
+
+
+# The argv helpers as they were before parse_invocation, kept as the
+# reference the single-pass parser is checked against.
+
+def legacy_get_version(argv):
+    local_argv = legacy_remove_argv_options(argv)
+    command = local_argv[0]
+    if command == 'deploy':
+        version_index = 2
+    elif command == 'release':
+        version_index = 1
+    try:
+        return local_argv[version_index]
+    except IndexError:
+        pass
+
+
+def legacy_remove_argv_options(argv):
+    local_argv = copy(argv)
+    for flag in ('-p', '-v', '--plan-only', '--verbose'):
+        with suppress(ValueError):
+            local_argv.remove(flag)
+    for option in ('-c', '--component', '--platform-config'):
+        with suppress(ValueError):
+            option_index = local_argv.index(option)
+            del local_argv[option_index:option_index+2]
+    return local_argv
+
+
+def legacy_get_component_name_from_cli_args(argv):
+    component_flag_index = -1
+    for flag in ('-c', '--component'):
+        try:
+            component_flag_index = argv.index(flag)
+        except ValueError:
+            pass
+    if component_flag_index > -1:
+        return argv[component_flag_index + 1]
+
+
+def legacy_platform_config_arg(iterator):
+    try:
+        return next(iterator)
+    except StopIteration:
+        raise MissingPlatformConfigError()
+
+
+def legacy_get_platform_config_paths(argv):
+    paths = []
+    iterator = iter(argv)
+    for arg in iterator:
+        if arg == '--platform-config':
+            paths.append(abspath(legacy_platform_config_arg(iterator)))
+        elif arg.startswith('--platform-config='):
+            paths.append(abspath(arg.split('=', 1)[1]))
+    if len(paths) == 0:
+        raise MissingPlatformConfigError()
+    return paths
+
+
+def legacy_main_argv(argv):
+    return [arg for arg in argv if arg != '--timings']
+
+
+def legacy_verbose(argv):
+    return bool({'-v', '--verbose'} & set(argv))
+
+
+def argument():
+    return text(alphabet=VALID_ALPHABET, min_size=1).filter(
+        lambda arg: arg not in OPTION_TOKENS
+        and not arg.startswith('--platform-config')
+    )
+
+
+@composite
+def invocation_argv(draw, platform_configs=lists(filepath(), max_size=1)):
+    command = draw(sampled_from(('deploy', 'release', 'destroy', 'shell')))
+    units = [[arg] for arg in draw(lists(argument(), max_size=3))]
+    component = draw(one_of(none(), argument()))
+    if component is not None:
+        units.append([draw(sampled_from(('-c', '--component'))), component])
+    units.extend(
+        ['--platform-config', path] for path in draw(platform_configs)
+    )
+    units.extend([flag] for flag in draw(lists(
+        sampled_from(('-p', '--plan-only', '-v', '--verbose', '--timings')),
+        unique=True,
+    )))
+    return [command] + list(chain.from_iterable(draw(permutations(units))))
+
+
+class TestParseInvocation(unittest.TestCase):
+
+    @given(invocation_argv())
+    def test_matches_legacy_parsing(self, argv):
+        invocation = parse_invocation(argv)
+        command_argv = legacy_main_argv(argv)
+
+        assert isinstance(invocation, Invocation)
+        assert list(invocation.argv) == command_argv
+        assert invocation.command == command_argv[0]
+        if invocation.command in ('deploy', 'release'):
+            assert invocation.version == legacy_get_version(command_argv)
+        else:
+            assert invocation.version is None
+        assert invocation.component == \
+            legacy_get_component_name_from_cli_args(command_argv)
+        assert invocation.verbose == legacy_verbose(argv)
+        assert invocation.timings == ('--timings' in argv)
+
+    @given(invocation_argv(platform_configs=lists(filepath(), min_size=1)))
+    def test_matches_legacy_platform_config_paths(self, argv):
+        assert get_platform_config_paths(parse_invocation(argv)) == \
+            legacy_get_platform_config_paths(argv)
+
+    @given(lists(filepath(), min_size=1), booleans())
+    def test_platform_config_equals_form(self, paths, equals_form):
+        argv = ['release', '42']
+        for path in paths:
+            argv += ['--platform-config={}'.format(path)] if equals_form \
+                else ['--platform-config', path]
+
+        invocation = parse_invocation(argv)
+
+        assert invocation.version == '42'
+        assert get_platform_config_paths(invocation) == \
+            legacy_get_platform_config_paths(argv)
+
+    def test_empty_argv(self):
+        for argv in ([], ['--timings']):
+            invocation = parse_invocation(argv)
+
+            assert invocation.command is None
+            assert invocation.version is None
+            assert invocation.argv == ()
+
+    def test_option_values_are_not_flags(self):
+        argv = ['deploy', 'aslive', '42', '-c', '--timings', '--timings']
+
+        invocation = parse_invocation(argv)
+
+        assert invocation.component == '--timings'
+        assert invocation.timings
+        assert invocation.argv == tuple(argv[:-1])
+
+    def test_invocation_is_immutable(self):
+        invocation = parse_invocation(['deploy', 'aslive', '42'])
+
+        self.assertRaises(AttributeError, setattr, invocation, 'version', '1')
@@ -0,0 +1,178 @@
+import os
+import time
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+
+from docker.client import DockerClient
+from docker.errors import APIError
+from docker.models.volumes import Volume
+
+from cdflow import (
+    TERRAFORM_PLUGIN_CACHE_PATH, _claim_plugin_cache, _release_lock,
+    docker_run, get_plugin_cache,
+)
+from test.helpers import make_image, run_main
+
+
+def make_volume(name):
+    volume = MagicMock(spec=Volume)
+    volume.name = name
+    return volume
+
+
+class TestPluginCacheMount(unittest.TestCase):
+
+    def setUp(self):
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.images.get.return_value = make_image(
+            'sha256:0123456789abcdef', 1,
+            digests=['mergermarket/cdflow-commands@sha256:fedcba9876543210'],
+        )
+
+    def get_plugin_cache(self, image_id, setting=''):
+        with patch.dict(
+            os.environ, {'CDFLOW_TERRAFORM_PLUGIN_CACHE': setting},
+        ):
+            return get_plugin_cache(self.docker_client, image_id)
+
+    def test_digest_reference_needs_no_lookup(self):
+        assert self.get_plugin_cache(
+            'mergermarket/cdflow-commands@sha256:1234567890abcdef',
+        ) == 'cdflow-terraform-plugins-1234567890ab'
+        self.docker_client.images.get.assert_not_called()
+
+    def test_tag_is_keyed_by_its_digest(self):
+        assert self.get_plugin_cache('mergermarket/cdflow-commands:latest') \
+            == 'cdflow-terraform-plugins-fedcba987654'
+
+    def test_host_directory(self):
+        assert self.get_plugin_cache(
+            'mergermarket/cdflow-commands:latest', '/var/cache/terraform/',
+        ) == '/var/cache/terraform/fedcba987654'
+
+    def test_disabled(self):
+        assert self.get_plugin_cache(
+            'mergermarket/cdflow-commands:latest', 'off',
+        ) is None
+
+    def test_docker_run_mounts_cache(self):
+        environment = {}
+        with patch.dict(os.environ, {
+            'CDFLOW_CACHE_DIR': mkdtemp(),
+            'CDFLOW_TERRAFORM_PLUGIN_CACHE': '',
+        }), patch('cdflow._get_docker_config_mount_path', return_value=None):
+            self.docker_client.containers.create.side_effect = \
+                APIError('stop here')
+            docker_run(
+                self.docker_client, 'mergermarket/cdflow-commands:latest',
+                ['release', '42'], '/project', environment,
+            )
+
+        create_kwargs = self.docker_client.containers.create.call_args[1]
+        assert create_kwargs['volumes'][
+            'cdflow-terraform-plugins-fedcba987654'
+        ] == {'bind': TERRAFORM_PLUGIN_CACHE_PATH, 'mode': 'rw'}
+        assert environment['TF_PLUGIN_CACHE_DIR'] == \
+            TERRAFORM_PLUGIN_CACHE_PATH
+
+
+class TestPluginCacheSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = patch.dict(os.environ, {'CDFLOW_CACHE_DIR': mkdtemp()})
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+
+    def claim(self):
+        plugin_cache, lock = _claim_plugin_cache('cdflow-terraform-plugins-a')
+        self.addCleanup(_release_lock, lock)
+        return plugin_cache, lock
+
+    def test_first_slot_uses_the_cache(self):
+        assert self.claim()[0] == 'cdflow-terraform-plugins-a'
+
+    def test_locked_slot_gets_its_own_cache(self):
+        self.claim()
+
+        assert self.claim()[0] == 'cdflow-terraform-plugins-a-1'
+
+    def test_released_slot_is_reused(self):
+        _release_lock(self.claim()[1])
+
+        assert self.claim()[0] == 'cdflow-terraform-plugins-a'
+
+    def test_cache_is_skipped_when_it_cannot_be_locked(self):
+        with patch('cdflow._try_lock', side_effect=OSError('no locks')):
+            assert self.claim() == (None, None)
+
+
+class TestPluginCachePruning(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = patch.dict(os.environ, {
+            'CDFLOW_CACHE_DIR': mkdtemp(),
+            'CDFLOW_REGISTRY_MIRRORS': '',
+        })
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.images.list.return_value = [
+            make_image('sha256:aaaaaaaaaaaa1', 1, tags=[
+                'mergermarket/cdflow-commands:latest',
+            ]),
+            make_image('sha256:bbbbbbbbbbbb2', 1, digests=[
+                'mergermarket/cdflow-commands@sha256:cccccccccccc3',
+            ]),
+        ]
+        self.volumes = {
+            name: make_volume(name) for name in (
+                'cdflow-terraform-plugins-aaaaaaaaaaaa',
+                'cdflow-terraform-plugins-cccccccccccc',
+                'cdflow-terraform-plugins-dddddddddddd',
+                'cdflow-terraform-plugins-aaaaaaaaaaaa-1',
+            )
+        }
+        self.docker_client.volumes.list.return_value = \
+            list(self.volumes.values())
+        self.docker_client.df.return_value = {'Volumes': [
+            {'Name': name, 'UsageData': {'Size': 1e9}}
+            for name in self.volumes
+        ]}
+
+    def run_gc(self, argv):
+        usage = {
+            'mergermarket/cdflow-commands:latest': time.time(),
+            'mergermarket/cdflow-commands@sha256:cccccccccccc3':
+                time.time() - 60,
+        }
+        with patch('cdflow._read_json_cache', return_value=usage):
+            return run_main(['gc'] + argv, self.docker_client)[0]
+
+    def removed(self):
+        return sorted(
+            name for name, volume in self.volumes.items()
+            if volume.remove.called
+        )
+
+    def test_caches_of_missing_images_are_removed(self):
+        assert self.run_gc([]) == 0
+
+        self.docker_client.volumes.list.assert_called_once_with(
+            filters={'name': 'cdflow-terraform-plugins-'},
+        )
+        assert self.removed() == ['cdflow-terraform-plugins-dddddddddddd']
+
+    def test_size_budget_removes_least_recently_used(self):
+        self.run_gc(['--max-plugin-cache-size', '2.5'])
+
+        assert self.removed() == [
+            'cdflow-terraform-plugins-cccccccccccc',
+            'cdflow-terraform-plugins-dddddddddddd',
+        ]
+
+    def test_mounted_cache_is_reported(self):
+        self.volumes['cdflow-terraform-plugins-dddddddddddd'].remove.\
+            side_effect = APIError('volume is in use')
+
+        assert self.run_gc([]) == 1
@@ -0,0 +1,124 @@
+import os
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+
+from docker.errors import ImageNotFound
+from docker.models.images import Image
+
+from cdflow import CDFLOW_IMAGE_ID, find_manifest_image_ids, main
+
+
+class TestPrewarm(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.environ = patch.dict(os.environ, {'CDFLOW_CACHE_DIR': mkdtemp()})
+        self.environ.start()
+        os.environ.pop('CDFLOW_IMAGE_ID', None)
+
+    def tearDown(self):
+        self.environ.stop()
+
+    def write_manifest(self, directory, content):
+        path = '{}/{}'.format(self.root, directory)
+        os.makedirs(path, exist_ok=True)
+        with open('{}/cdflow.yml'.format(path), 'w') as manifest:
+            manifest.write(content)
+
+    def test_collects_distinct_image_ids(self):
+        self.write_manifest('a', 'team: a\nterraform-version: 0.12.29\n')
+        self.write_manifest('b/nested', 'terraform-version: 0.12.29\n')
+        self.write_manifest('c', 'team: c\n')
+        self.write_manifest('d', '')
+        self.write_manifest('e', 'terraform-version: 1.0.0\n')
+
+        assert find_manifest_image_ids([self.root]) == [
+            CDFLOW_IMAGE_ID,
+            'mergermarket/cdflow-commands:terraform0.12.29',
+            'mergermarket/cdflow-commands:terraform1.0.0',
+        ]
+
+    def test_skips_hidden_and_dependency_directories(self):
+        self.write_manifest('.git/a', 'terraform-version: 0.11.0\n')
+        self.write_manifest('a/node_modules/b', 'terraform-version: 0.11.0\n')
+        self.write_manifest('a/.terraform', 'terraform-version: 0.11.0\n')
+
+        assert find_manifest_image_ids([self.root]) == []
+
+    def test_skips_invalid_manifests(self):
+        self.write_manifest('a', 'team: [a\n')
+        self.write_manifest('b', 'terraform-version: 1.0.0\n')
+
+        assert find_manifest_image_ids([self.root]) == [
+            'mergermarket/cdflow-commands:terraform1.0.0',
+        ]
+
+    def run_prewarm(self, argv, missing=()):
+        def pull(repository, tag, **kwargs):
+            if '{}:{}'.format(repository, tag) in missing:
+                raise ImageNotFound(repository)
+            return iter([])
+
+        def get(image_id):
+            if image_id in missing:
+                raise ImageNotFound(image_id)
+            image = MagicMock(spec=Image)
+            image.attrs = {'RepoDigests': [image_id + '@sha256:1']}
+            return image
+
+        with patch('cdflow.docker') as docker, \
+                patch('cdflow.print') as print_, \
+                patch('cdflow._get_auth_config', return_value=None):
+            docker.from_env.return_value.api.pull.side_effect = pull
+            docker.from_env.return_value.images.get.side_effect = get
+            docker.from_env.return_value.images.\
+                get_registry_data.return_value.id = 'sha256:remote'
+            exit_status = main(['prewarm'] + argv)
+
+        self.pulled = [
+            '{}:{}'.format(call[0][0], call[1]['tag'])
+            for call in docker.from_env.return_value.api.pull.call_args_list
+        ]
+        self.printed = [call[0][0] for call in print_.call_args_list]
+        return exit_status
+
+    def test_pulls_every_image(self):
+        self.write_manifest('a', 'terraform-version: 0.12.29\n')
+        self.write_manifest('b', 'terraform-version: 1.0.0\n')
+
+        exit_status = self.run_prewarm([self.root, '--concurrency', '2'])
+
+        assert exit_status == 0
+        assert sorted(self.pulled) == [
+            'mergermarket/cdflow-commands:terraform0.12.29',
+            'mergermarket/cdflow-commands:terraform1.0.0',
+        ]
+        assert self.printed[0].startswith('[1/2] pulled ')
+        assert self.printed[1].startswith('[2/2] pulled ')
+
+    def test_reports_failed_pulls(self):
+        self.write_manifest('a', 'terraform-version: 0.12.29\n')
+        self.write_manifest('b', 'terraform-version: 1.0.0\n')
+
+        exit_status = self.run_prewarm(
+            [self.root],
+            missing=('mergermarket/cdflow-commands:terraform1.0.0',),
+        )
+
+        assert exit_status == 1
+        assert any(
+            'could not pull mergermarket/cdflow-commands:terraform1.0.0'
+            in line for line in self.printed
+        )
+
+    def test_no_manifests(self):
+        assert self.run_prewarm([self.root]) == 0
+        assert self.printed == ['No cdflow.yml manifests found']
+        assert self.pulled == []
+
+    def test_invalid_concurrency(self):
+        assert self.run_prewarm([self.root, '--concurrency', '0']) == 1
+        assert self.printed == [
+            'error: --concurrency must be at least 1',
+        ]
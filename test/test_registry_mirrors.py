@@ -0,0 +1,236 @@
+import base64
+import json
+import os
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+
+from docker.client import DockerClient
+from docker.errors import ImageNotFound
+from docker.models.images import Image
+
+from cdflow import (
+    _cache_image_sha, _get_auth_config, _registry_latencies, ensure_image,
+    get_image_sha, get_registry_mirrors, rank_registry_mirrors,
+)
+
+MIRROR = 'localhost:5000'
+DIGEST = 'sha256:abc'
+
+
+class MirrorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        _registry_latencies.clear()
+        self.environ = patch.dict(os.environ, {
+            'CDFLOW_CACHE_DIR': mkdtemp(),
+            'CDFLOW_REGISTRY_MIRRORS': 'http://{}'.format(MIRROR),
+        })
+        self.environ.start()
+        self.addCleanup(self.environ.stop)
+        self.probe = patch('cdflow._probe_registry', return_value=0.01)
+        self.probe.start()
+        self.addCleanup(self.probe.stop)
+        auth = patch('cdflow._get_auth_config', return_value=None)
+        auth.start()
+        self.addCleanup(auth.stop)
+
+        self.docker_client = MagicMock(spec=DockerClient)
+        self.docker_client.api = MagicMock()
+        self.docker_client.api.pull.side_effect = \
+            lambda *args, **kwargs: iter([])
+        self.docker_client.images.get_registry_data.return_value.id = DIGEST
+
+    def image(self, *repo_digests):
+        image = MagicMock(spec=Image)
+        image.attrs = {'RepoDigests': list(repo_digests)}
+        return image
+
+
+class TestRegistryMirrorConfig(MirrorTestCase):
+
+    def test_mirrors_from_environment(self):
+        with patch.dict(os.environ, {
+            'CDFLOW_REGISTRY_MIRRORS': 'a:5000, https://b/ ,',
+        }):
+            assert get_registry_mirrors() == ['a:5000', 'https://b']
+
+    def test_mirrors_from_manifest(self):
+        with patch.dict(os.environ, {'CDFLOW_REGISTRY_MIRRORS': ''}), \
+                patch('cdflow.get_manifest_data') as get_manifest_data:
+            get_manifest_data.return_value = {'registry-mirrors': ['a:5000']}
+
+            assert get_registry_mirrors() == ['a:5000']
+
+    def test_mirrors_are_ranked_by_latency(self):
+        latencies = {'slow': 0.5, 'fast': 0.01, 'down': None}
+
+        with patch('cdflow._probe_registry', side_effect=latencies.get) \
+                as probe:
+            assert rank_registry_mirrors(['slow', 'fast', 'down']) == \
+                ['fast', 'slow']
+            rank_registry_mirrors(['slow', 'fast', 'down'])
+
+        assert probe.call_count == 3
+
+
+class TestMirrorPull(MirrorTestCase):
+
+    def test_tag_is_pulled_from_mirror(self):
+        image = self.image('{}/mergermarket/cdflow-commands@{}'.format(
+            MIRROR, DIGEST,
+        ))
+        self.docker_client.images.get.side_effect = [
+            ImageNotFound('mergermarket/cdflow-commands:latest'), image, image,
+        ]
+
+        image_sha = get_image_sha(
+            self.docker_client, 'mergermarket/cdflow-commands:latest',
+        )
+
+        assert image_sha == 'mergermarket/cdflow-commands@{}'.format(DIGEST)
+        self.docker_client.api.pull.assert_called_once_with(
+            '{}/mergermarket/cdflow-commands'.format(MIRROR), tag='latest',
+            stream=True, decode=True,
+        )
+        image.tag.assert_called_once_with(
+            'mergermarket/cdflow-commands', 'latest',
+        )
+
+    def test_stale_tag_digest_is_looked_up_once(self):
+        image = self.image('{}/mergermarket/cdflow-commands@{}'.format(
+            MIRROR, DIGEST,
+        ))
+        self.docker_client.images.get.side_effect = [
+            self.image('mergermarket/cdflow-commands@sha256:old'),
+            image, image,
+        ]
+
+        image_sha = get_image_sha(
+            self.docker_client, 'mergermarket/cdflow-commands:latest',
+        )
+
+        assert image_sha == 'mergermarket/cdflow-commands@{}'.format(DIGEST)
+        self.docker_client.images.get_registry_data.assert_called_once_with(
+            'mergermarket/cdflow-commands:latest', auth_config=None,
+        )
+
+    def test_cached_digest_matches_mirror_copy(self):
+        image_sha = 'mergermarket/cdflow-commands@{}'.format(DIGEST)
+        self.docker_client.images.get.return_value = self.image(
+            '{}/{}'.format(MIRROR, image_sha),
+        )
+
+        with patch.dict(os.environ, {'CDFLOW_IMAGE_CACHE_TTL': '60'}):
+            _cache_image_sha(
+                'mergermarket/cdflow-commands:latest', image_sha,
+            )
+            assert get_image_sha(
+                self.docker_client, 'mergermarket/cdflow-commands:latest',
+            ) == image_sha
+
+        self.docker_client.images.get_registry_data.assert_not_called()
+        self.docker_client.api.pull.assert_not_called()
+
+    def test_mismatched_mirror_falls_back_to_canonical(self):
+        self.docker_client.images.get.side_effect = [
+            ImageNotFound('mergermarket/cdflow-commands:latest'),
+            self.image('{}/mergermarket/cdflow-commands@sha256:old'.format(
+                MIRROR,
+            )),
+            self.image('mergermarket/cdflow-commands@{}'.format(DIGEST)),
+        ]
+
+        image_sha = get_image_sha(
+            self.docker_client, 'mergermarket/cdflow-commands:latest',
+        )
+
+        assert image_sha == 'mergermarket/cdflow-commands@{}'.format(DIGEST)
+        assert [
+            call[0][0] for call in self.docker_client.api.pull.call_args_list
+        ] == [
+            '{}/mergermarket/cdflow-commands'.format(MIRROR),
+            'mergermarket/cdflow-commands',
+        ]
+
+    def test_canonical_pull_ignores_mirror_digest(self):
+        self.docker_client.images.get.side_effect = [
+            ImageNotFound('mergermarket/cdflow-commands:latest'),
+            ImageNotFound('mirror image'),
+            self.image(
+                '{}/mergermarket/cdflow-commands@sha256:old'.format(MIRROR),
+                'mergermarket/cdflow-commands@{}'.format(DIGEST),
+            ),
+        ]
+
+        image_sha = get_image_sha(
+            self.docker_client, 'mergermarket/cdflow-commands:latest',
+        )
+
+        assert image_sha == 'mergermarket/cdflow-commands@{}'.format(DIGEST)
+
+    def test_unverifiable_tag_is_pulled_from_canonical(self):
+        self.docker_client.images.get_registry_data.side_effect = \
+            Exception('offline')
+        self.docker_client.images.get.return_value = self.image()
+
+        get_image_sha(self.docker_client, 'mergermarket/cdflow-commands:1')
+
+        self.docker_client.api.pull.assert_called_once_with(
+            'mergermarket/cdflow-commands', tag='1', stream=True, decode=True,
+        )
+
+    def test_other_registries_are_not_mirrored(self):
+        self.docker_client.images.get.return_value = self.image()
+
+        get_image_sha(self.docker_client, 'ghcr.io/a/b:1')
+
+        self.docker_client.api.pull.assert_called_once_with(
+            'ghcr.io/a/b', tag='1', stream=True, decode=True,
+        )
+
+    def test_local_mirror_copy_of_digest_is_used(self):
+        image_id = 'mergermarket/cdflow-commands@{}'.format(DIGEST)
+        mirror_image_id = '{}/{}'.format(MIRROR, image_id)
+        self.docker_client.images.get.side_effect = [
+            ImageNotFound(image_id), self.image(mirror_image_id),
+        ]
+
+        assert ensure_image(self.docker_client, image_id) == mirror_image_id
+        self.docker_client.api.pull.assert_not_called()
+
+    def test_digest_is_pulled_from_mirror(self):
+        image_id = 'mergermarket/cdflow-commands@{}'.format(DIGEST)
+        mirror_image_id = '{}/{}'.format(MIRROR, image_id)
+        self.docker_client.images.get.side_effect = [
+            ImageNotFound(image_id), ImageNotFound(mirror_image_id),
+            self.image(mirror_image_id),
+        ]
+
+        assert ensure_image(self.docker_client, image_id) == mirror_image_id
+        self.docker_client.images.get_registry_data.assert_not_called()
+        self.docker_client.api.pull.assert_called_once_with(
+            '{}/mergermarket/cdflow-commands'.format(MIRROR), tag=DIGEST,
+            stream=True, decode=True,
+        )
+
+
+class TestRegistryAuth(unittest.TestCase):
+
+    def test_credentials_are_looked_up_per_host(self):
+        config_path = '{}/config.json'.format(mkdtemp())
+        with open(config_path, 'w') as config_file:
+            json.dump({'auths': {
+                'https://{}'.format(MIRROR): {
+                    'auth': base64.b64encode(b'user:pass').decode('utf-8'),
+                },
+            }}, config_file)
+
+        with patch(
+            'cdflow._get_users_docker_config_location',
+            return_value=config_path,
+        ):
+            assert _get_auth_config(MIRROR) == {
+                'username': 'user', 'password': 'pass',
+            }
+            assert _get_auth_config('other:5000') is None
@@ -0,0 +1,210 @@
+import json
+import os
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import MagicMock, patch
+
+import boto3
+from moto import mock_s3
+
+from cdflow import RELEASE_INDEX_CACHE, list_release_versions, main
+from test.helpers import make_docker_client, run_main
+
+
+class TestReleaseIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.config = {'account-scheme-url': 's3://bucket/key', 'team': 'a'}
+        self.exit_code = 0
+
+    def write_index(self, index):
+        with open('{}/{}'.format(self.cache_dir, RELEASE_INDEX_CACHE), 'w') \
+                as index_file:
+            json.dump(index, index_file)
+
+    def read_index(self):
+        with open('{}/{}'.format(self.cache_dir, RELEASE_INDEX_CACHE)) \
+                as index_file:
+            return json.load(index_file)
+
+    def run_main(self, argv):
+        docker_client = make_docker_client(
+            'image@sha256:released', self.exit_code,
+        )
+        exit_status, self.print_, self.find_image = run_main(
+            argv, docker_client, self.config,
+            find_image='image@sha256:{}-{}'.format,
+            environment={'CDFLOW_CACHE_DIR': self.cache_dir},
+        )
+        self.create = docker_client.containers.create
+        return exit_status
+
+    def test_deploy_uses_indexed_release_without_s3(self):
+        self.write_index({'a/foo/42': 'image@sha256:indexed'})
+
+        with patch('cdflow.get_s3_resource') as get_s3_resource:
+            exit_status = self.run_main(
+                ['deploy', 'aslive', '42', '-c', 'foo'],
+            )
+
+        assert exit_status == 0
+        get_s3_resource.assert_not_called()
+        self.find_image.assert_not_called()
+        assert self.create.call_args[0][0] == 'image@sha256:indexed'
+
+    def test_deploy_records_unindexed_release(self):
+        self.run_main(['deploy', 'aslive', '42', '-c', 'foo'])
+        self.find_image.assert_called_once()
+
+        self.run_main(['deploy', 'live', '42', '-c', 'foo'])
+        self.find_image.assert_not_called()
+        assert self.read_index() == {'a/foo/42': 'image@sha256:foo-42'}
+
+    def test_index_is_scoped_to_team(self):
+        self.write_index({'b/foo/42': 'image@sha256:other-team'})
+
+        self.run_main(['deploy', 'aslive', '42', '-c', 'foo'])
+
+        assert self.create.call_args[0][0] == 'image@sha256:foo-42'
+
+    def test_successful_release_is_indexed(self):
+        self.run_main([
+            'release', '--platform-config', 'config', '43', '-c', 'foo',
+        ])
+
+        assert self.read_index() == {'a/foo/43': 'image@sha256:released'}
+
+    def test_failed_release_is_not_indexed(self):
+        self.exit_code = 1
+
+        self.run_main([
+            'release', '--platform-config', 'config', '43', '-c', 'foo',
+        ])
+
+        assert not os.path.exists(
+            '{}/{}'.format(self.cache_dir, RELEASE_INDEX_CACHE)
+        )
+
+
+class TestSyncIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_s3 = mock_s3()
+        self.mock_s3.start()
+        self.cache_dir = mkdtemp()
+        self.environ = patch.dict(
+            os.environ, {'CDFLOW_CACHE_DIR': self.cache_dir},
+        )
+        self.environ.start()
+
+        self.s3_resource = boto3.resource('s3')
+        for bucket in ('account-scheme', 'releases'):
+            self.s3_resource.create_bucket(Bucket=bucket)
+        self.s3_resource.Object('account-scheme', 'scheme.json').put(
+            Body=b'{"release-bucket": "releases"}',
+        )
+        self.config = {
+            'account-scheme-url': 's3://account-scheme/scheme.json',
+            'team': 'a-team',
+        }
+
+    def tearDown(self):
+        self.environ.stop()
+        self.mock_s3.stop()
+
+    def put_release(self, key, digest):
+        self.s3_resource.Object('releases', key).put(
+            Body=b'', Metadata={'cdflow_image_digest': digest},
+        )
+
+    def sync_index(self, argv):
+        with patch('cdflow.get_s3_resource') as get_s3_resource, \
+                patch('cdflow.get_manifest_data') as get_manifest_data, \
+                patch('cdflow.print') as print_:
+            get_s3_resource.return_value = self.s3_resource
+            get_manifest_data.return_value = self.config
+
+            exit_status = main(['sync-index'] + argv)
+
+        self.printed = [call[0][0] for call in print_.call_args_list]
+        return exit_status
+
+    def read_index(self):
+        with open('{}/{}'.format(self.cache_dir, RELEASE_INDEX_CACHE)) \
+                as index_file:
+            return json.load(index_file)
+
+    def test_syncs_named_versions(self):
+        self.put_release('a-team/foo/foo-41.zip', 'image@sha256:41')
+        self.put_release('a-team/foo/foo-42.zip', 'image@sha256:42')
+
+        exit_status = self.sync_index(['-c', 'foo', '41', '42'])
+
+        assert exit_status == 0
+        assert self.read_index() == {
+            'a-team/foo/41': 'image@sha256:41',
+            'a-team/foo/42': 'image@sha256:42',
+        }
+        assert self.printed == [
+            'foo 41: image@sha256:41', 'foo 42: image@sha256:42',
+        ]
+
+    def test_syncs_most_recent_versions(self):
+        for version in range(1, 6):
+            self.put_release(
+                'a-team/foo/foo-{}.zip'.format(version),
+                'image@sha256:{}'.format(version),
+            )
+        self.put_release('a-team/foobar/foobar-9.zip', 'image@sha256:9')
+
+        exit_status = self.sync_index(['-c', 'foo', '--last', '2'])
+
+        assert exit_status == 0
+        assert self.read_index() == {
+            'a-team/foo/4': 'image@sha256:4',
+            'a-team/foo/5': 'image@sha256:5',
+        }
+
+    def test_versions_are_listed_oldest_first(self):
+        s3_resource = MagicMock()
+        s3_resource.Bucket.return_value.objects.filter.return_value = [
+            MagicMock(key='a-team/foo/foo-10.zip', last_modified=3),
+            MagicMock(key='a-team/foo/foo-9.zip', last_modified=2),
+            MagicMock(key='a-team/foo/foo-8.zip', last_modified=1),
+            MagicMock(key='a-team/foo/foo-8.json', last_modified=1),
+        ]
+
+        versions = list_release_versions(
+            s3_resource, 'releases', 'foo', team_name='a-team',
+        )
+
+        assert versions == ['8', '9', '10']
+        s3_resource.Bucket.assert_called_once_with('releases')
+        s3_resource.Bucket.return_value.objects.filter.\
+            assert_called_once_with(Prefix='a-team/foo/foo-')
+
+    def test_lists_classic_release_layout(self):
+        self.s3_resource.Object('account-scheme', 'scheme.json').put(
+            Body=b'{"release-bucket": "releases", '
+                 b'"classic-metadata-handling": true}',
+        )
+        self.put_release('foo/foo-1.zip', 'image@sha256:1')
+
+        self.sync_index(['-c', 'foo', '--last=5'])
+
+        assert self.read_index() == {'a-team/foo/1': 'image@sha256:1'}
+
+    def test_reports_unresolvable_versions(self):
+        self.put_release('a-team/foo/foo-41.zip', 'image@sha256:41')
+
+        exit_status = self.sync_index(['-c', 'foo', '41', '42'])
+
+        assert exit_status == 1
+        assert self.read_index() == {'a-team/foo/41': 'image@sha256:41'}
+
+    def test_requires_a_version(self):
+        assert self.sync_index(['-c', 'foo']) == 1
+        assert self.printed == [
+            'error: sync-index requires a version or --last <n>',
+        ]
@@ -0,0 +1,163 @@
+import json
+import re
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import patch
+
+from test.helpers import make_docker_client, run_main
+
+
+class ReleaseRunner(object):
+
+    def run_release(self, argv, environment={}):
+        docker_client = make_docker_client('hash')
+        exit_status, self.print_, _ = run_main(
+            argv, docker_client, environment=environment,
+        )
+        self.create = docker_client.containers.create
+        return exit_status
+
+
+class TestTimings(ReleaseRunner, unittest.TestCase):
+
+    def test_timings_flag_prints_report(self):
+        exit_status = self.run_release([
+            'release', '--platform-config', 'config', '--timings', '42',
+        ])
+
+        assert exit_status == 0
+        assert self.create.call_args[1]['command'] == [
+            'release', '--platform-config', 'config', '42',
+        ]
+        report = json.loads(self.print_.call_args[0][0])
+        assert report['command'] == 'release'
+        assert report['exit_status'] == 0
+        names = [span['name'] for span in report['spans']]
+        for name in (
+            'main', 'get_image_sha', 'docker_run', 'container_create',
+            'credential_injection', 'container_run',
+            'handle_finished_container',
+        ):
+            assert name in names
+        assert names[0] == 'main'
+
+    def test_timings_file_is_appended_to(self):
+        timings_file = '{}/timings.jsonl'.format(mkdtemp())
+        environment = {'CDFLOW_TIMINGS_FILE': timings_file}
+        argv = ['release', '--platform-config', 'config', '42']
+
+        self.run_release(argv, environment)
+        self.run_release(argv, environment)
+
+        with open(timings_file) as report_file:
+            reports = [json.loads(line) for line in report_file]
+        assert len(reports) == 2
+        for report in reports:
+            assert report['spans'][0]['start'] == 0
+            assert len(report['spans']) == len(reports[0]['spans'])
+
+    def test_unwritable_timings_file_keeps_exit_status(self):
+        exit_status = self.run_release(
+            ['release', '--platform-config', 'config', '42'],
+            {'CDFLOW_TIMINGS_FILE': '{}/missing/timings.jsonl'.format(
+                mkdtemp(),
+            )},
+        )
+
+        assert exit_status == 0
+
+    def test_no_report_by_default(self):
+        self.run_release(['release', '--platform-config', 'config', '42'])
+
+        for call in self.print_.call_args_list:
+            assert not call[0][0].startswith('{')
+
+
+class TestTraceExport(ReleaseRunner, unittest.TestCase):
+
+    def setUp(self):
+        self.trace_file = '{}/trace.jsonl'.format(mkdtemp())
+
+    def read_spans(self):
+        with open(self.trace_file) as trace_file:
+            payload = json.loads(trace_file.read())
+        return payload['resourceSpans'][0]['scopeSpans'][0]['spans']
+
+    def test_spans_are_exported_to_file(self):
+        self.run_release(
+            ['release', '--platform-config', 'config', '42', '-c', 'foo'],
+            {'CDFLOW_OTLP_FILE': self.trace_file},
+        )
+
+        spans = self.read_spans()
+        root = [span for span in spans if span['name'] == 'main'][0]
+        assert 'parentSpanId' not in root
+        attributes = {
+            attribute['key']: attribute['value']
+            for attribute in root['attributes']
+        }
+        assert attributes['cdflow.command'] == {'stringValue': 'release'}
+        assert attributes['cdflow.component'] == {'stringValue': 'foo'}
+        assert attributes['cdflow.version'] == {'stringValue': '42'}
+        assert attributes['cdflow.image_digest'] == {'stringValue': 'hash'}
+
+        by_id = {span['spanId']: span for span in spans}
+        create = [
+            span for span in spans if span['name'] == 'container_create'
+        ][0]
+        assert by_id[create['parentSpanId']]['name'] == 'docker_run'
+        assert len({span['traceId'] for span in spans}) == 1
+
+    def test_unwritable_trace_file_keeps_exit_status(self):
+        exit_status = self.run_release(
+            ['release', '--platform-config', 'config', '42', '-c', 'foo'],
+            {'CDFLOW_OTLP_FILE': '{}/missing/trace.jsonl'.format(mkdtemp())},
+        )
+
+        assert exit_status == 0
+
+    def test_trace_context_is_propagated_into_container(self):
+        self.run_release(
+            ['release', '--platform-config', 'config', '42', '-c', 'foo'],
+            {'CDFLOW_OTLP_FILE': self.trace_file},
+        )
+
+        traceparent = self.create.call_args[1]['environment']['TRACEPARENT']
+        root = [span for span in self.read_spans() if span['name'] == 'main']
+        assert traceparent == '00-{}-{}-01'.format(
+            root[0]['traceId'], root[0]['spanId'],
+        )
+
+    def test_incoming_trace_context_is_continued(self):
+        trace_id = '0af7651916cd43dd8448eb211c80319c'
+        self.run_release(
+            ['release', '--platform-config', 'config', '42', '-c', 'foo'],
+            {
+                'CDFLOW_OTLP_FILE': self.trace_file,
+                'TRACEPARENT': '00-{}-b7ad6b7169203331-01'.format(trace_id),
+            },
+        )
+
+        root = [span for span in self.read_spans() if span['name'] == 'main']
+        assert root[0]['traceId'] == trace_id
+        assert root[0]['parentSpanId'] == 'b7ad6b7169203331'
+
+    def test_spans_are_posted_to_collector(self):
+        with patch('urllib.request.urlopen') as urlopen:
+            self.run_release(
+                ['release', '--platform-config', 'config', '42', '-c', 'foo'],
+                {'OTEL_EXPORTER_OTLP_ENDPOINT': 'http://localhost:4318/'},
+            )
+
+        request = urlopen.call_args[0][0]
+        assert request.full_url == 'http://localhost:4318/v1/traces'
+        assert 'resourceSpans' in json.loads(request.data)
+
+    def test_no_trace_context_without_exporter(self):
+        self.run_release(['release', '--platform-config', 'config', '42'])
+
+        environment = self.create.call_args[1]['environment']
+        assert 'TRACEPARENT' not in environment
+        assert not any(
+            re.match('^00-', str(value)) for value in environment.values()
+        )